@@ -1,6 +1,7 @@
 from .utils.kusto.kusto_data_provider import KustoDataProvider
 import yaml
 import os
+from tsg_copilot.tracing import span
 
 with open('config.yaml', 'r') as config_file:
     config = yaml.safe_load(config_file)
@@ -38,7 +39,8 @@ except Exception as e:
 def query_kusto_api(query):
     if general_kusto_provider is None:
         return None
-    df = general_kusto_provider.query_dir(query)
+    with span("query_kusto_api"):
+        df = general_kusto_provider.query_dir(query)
     return df
 
 if __name__ == '__main__':   
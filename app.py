@@ -39,6 +39,16 @@ class TsgCopilotApp(object):
         content = json.loads(content)["response"]
         return content
 
+    def stream_message(self, message):
+        """Yield the (event, data) of a turn as the API sends them, see /api/tsg_copilot/stream."""
+        with requests.post("http://127.0.0.1:2000/api/tsg_copilot/stream", json=message, stream=True) as response:
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    yield event, json.loads(line[len("data: "):])
+
 app = TsgCopilotApp()   # initialize the app, come to 
 
 
@@ -54,22 +64,46 @@ async def start():
 async def main(message: cl.Message):
     user_session_id = cl.user_session.get("id")  # type: ignore
 
-    # display loader before sending message  make_async == send_message
-    async with cl.Step(name="", show_input=True, root=True) as root_step:
-        response_round = await cl.make_async(app.send_message)(
-            message = {
-                "conversation_id": user_session_id,
-                "query": message.content,
-            }
-        )
-
-    # asynchronous: after app responds, send it back
-    user_msg_content = response_round
-    # display
-    await cl.Message(
-        author="Nissist",
-        content=f"{user_msg_content}"
-    ).send()
+    events = app.stream_message(
+        message = {
+            "conversation_id": user_session_id,
+            "query": message.content,
+        }
+    )
+    answer = cl.Message(author="Nissist", content="")
+    user_msg_content = ""
+
+    # render the stages of the turn as they happen, and the planner's answer token by token
+    async with cl.Step(name="Nissist", root=True) as root_step:
+        while True:
+            # the http stream is read in a thread, make_async == next
+            item = await cl.make_async(next)(events, None)
+            if item is None:
+                break
+            event, data = item
+            if event == "retrieving":
+                root_step.output = f"Searching the troubleshooting guides for: {data['query']}"
+                await root_step.update()
+            elif event == "tsg_selected":
+                root_step.output = f"Following the troubleshooting guide: {data['title']}"
+                await root_step.update()
+            elif event == "generating" and data["agent"] == "planner_agent":
+                root_step.output += "\nPlanning the next steps..."
+                await root_step.update()
+            elif event == "field" and data["name"] == "NEXT":
+                # the intent agent decided the next step, before the rest of its reply is generated
+                root_step.output += f"\nNext: {data['value']}"
+                await root_step.update()
+            elif event == "response" and data["agent"] == "planner_agent":
+                await answer.stream_token(data["text"])
+            elif event == "result":
+                user_msg_content = data["response"]
+            elif event == "error":
+                user_msg_content = f"Nissist failed to answer: {data['error']}"
+
+    # the final answer replaces the streamed tokens
+    answer.content = f"{user_msg_content}"
+    await answer.send()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+"""Measure the retrieval throughput of one query per call against batched queries.
+
+Run from the repository root:
+    python -m benchmarks.batch_retrieval --tsg-path ./example_data/TSGs --batch-sizes 16 64 256
+"""
+import argparse
+import tempfile
+import time
+
+from benchmarks.common import build_node_db, embedding_function, load_queries
+from tsg_copilot.node_retrieve_utils import (
+    get_vector_backend,
+    migrate_chroma_to_numpy,
+    query_vector_db,
+    query_vector_db_in_batches,
+)
+
+COLLECTION = "all-tsg-nodes"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tsg-path", default="./example_data/TSGs")
+    parser.add_argument("--queries", default=None, help="a file with one query per line, default derived from the nodes")
+    parser.add_argument("--embedding-model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--vector-backend", default="chroma", choices=["chroma", "numpy"])
+    parser.add_argument("--n-results", type=int, default=5)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--limit", type=int, default=1000, help="maximum number of queries")
+    args = parser.parse_args()
+
+    embedding_fn = embedding_function(args.embedding_model)
+    with tempfile.TemporaryDirectory() as work_dir:
+        kv_map, _, db_path, _ = build_node_db(args.tsg_path, work_dir, embedding_fn, COLLECTION)
+        if args.vector_backend == "numpy":
+            migrate_chroma_to_numpy(db_path, COLLECTION)
+        collection = get_vector_backend(db_path, COLLECTION, args.vector_backend)
+        queries = load_queries(args.queries, kv_map, args.limit)
+        embedding_fn(queries[:1])
+
+        start = time.perf_counter()
+        single = [
+            query_vector_db([query], n_results=args.n_results, collection=collection, embedding_function=embedding_fn)
+            for query in queries
+        ]
+        elapsed = time.perf_counter() - start
+        print(f"one per call: {len(queries) / elapsed:.1f} queries/s")
+
+        for batch_size in args.batch_sizes:
+            stats = {}
+            batched = query_vector_db_in_batches(
+                queries,
+                n_results=args.n_results,
+                batch_size=batch_size,
+                stats=stats,
+                collection=collection,
+                embedding_function=embedding_fn,
+            )
+            same = sum(s["ids"][0] == ids for s, ids in zip(single, batched["ids"]))
+            print(
+                f"batch size {batch_size}: {stats['queries'] / stats['seconds']:.1f} queries/s, "
+                f"{stats['batches']} batches, {same}/{len(queries)} results identical to one per call"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from chromadb.utils import embedding_functions
+
+from tsg_copilot.node_retrieve_utils import create_vector_db_from_json_node
+from tsg_copilot.tracing import latency_summary
+
+
+def embedding_function(model: str = "all-MiniLM-L6-v2"):
+    """A local embedding function, so that the benchmarks do not need an AOAI deployment."""
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model)
+
+
+def build_node_db(tsg_path: str, work_dir: str, embedding_fn, collection_name: str = "all-tsg-nodes"):
+    """Build the kv map and the chroma node db of `tsg_path` under `work_dir`. Return the kv map, the paths and the
+    build time in seconds."""
+    kv_map_path = os.path.join(work_dir, "kv_map.nodes")
+    db_path = os.path.join(work_dir, "nodedb")
+    start = time.perf_counter()
+    _, kv_map = create_vector_db_from_json_node(
+        tsg_path=tsg_path,
+        kv_map_path=kv_map_path,
+        db_path=db_path,
+        collection_name=collection_name,
+        embedding_function=embedding_fn,
+    )
+    return kv_map, kv_map_path, db_path, time.perf_counter() - start
+
+
+def load_queries(path: Optional[str], kv_map, limit: int = 200) -> List[str]:
+    """Read one query per line from `path`. Without a file, the #title# and the start of the #action# of the nodes are
+    used, they mix natural language with the exact names engineers paste."""
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()][:limit]
+    queries = []
+    for _, node in kv_map.items():
+        action = node.get("#action#") or ""
+        action = action if isinstance(action, str) else json.dumps(action)
+        queries.append(f"{node.get('#title#', '')} {action[:80]}".strip())
+        if len(queries) >= limit:
+            break
+    return queries
+
+
+def print_table(rows: Dict[str, Dict[str, float]]):
+    for name, row in rows.items():
+        cells = [f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}" for key, value in row.items()]
+        print(f"{name:<16}" + "  ".join(cells))
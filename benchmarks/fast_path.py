@@ -0,0 +1,153 @@
+"""Measure the precision and recall of the fast path of the intent agent on replayed conversations.
+
+Each message of the user in the recorded conversations is labeled with the decision the intent llm made on it, and
+classified by the fast path. Conversations are read from a session db (SESSION_DB_PATH), a spill directory
+(CONVERSATION_SPILL_DIR) or a JSONL file of saved conversation states.
+
+Run from the repository root:
+    python -m benchmarks.fast_path --sessions ./sessions.sqlite3 --min-confidence 0.8 0.9 0.95
+"""
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import time
+import zlib
+from typing import Dict, Iterable, List, Tuple
+
+from benchmarks.common import latency_summary, print_table
+from tsg_copilot.fast_path import (
+    LABELS,
+    LLM,
+    REPLIES,
+    SEED_EXAMPLES,
+    TERMINATE,
+    FastPath,
+    NaiveBayesIntent,
+    load_examples,
+)
+from tsg_copilot.message_json import parse_message
+
+
+def load_conversations(sessions: List[str], spill_dirs: List[str], conversations: List[str]) -> Iterable[Dict]:
+    """Yield the saved conversation states, as dicts, of session dbs, spill directories and JSONL files."""
+    for path in sessions:
+        conn = sqlite3.connect(path)
+        try:
+            for (state,) in conn.execute("SELECT state FROM sessions"):
+                yield json.loads(zlib.decompress(state).decode("utf-8"))
+        finally:
+            conn.close()
+    for spill_dir in spill_dirs:
+        for path in glob.glob(os.path.join(spill_dir, "*.json.z")):
+            with open(path, "rb") as f:
+                yield json.loads(zlib.decompress(f.read()).decode("utf-8"))
+    for path in conversations:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def label_of(decision: Dict) -> str:
+    """The fast path label matching a decision of the intent agent. A MATCHED decision follows the plan in the chat
+    history, e.g. a [MITIGATE] step matched by the results the user reports, so it is left to the llm. The ends of
+    conversations never reach the intent agent, they are only labeled in --examples files."""
+    token = str(decision.get("TOKEN", ""))
+    if decision.get("DECISION") == "MATCHED":
+        return LLM
+    if decision.get("DECISION") == "MITIGATED" or "MITIGATE" in token:
+        return "MITIGATE"
+    if decision.get("DECISION") == "NOT_RELATED":
+        return "NOT_RELATED"
+    return LLM
+
+
+def replay_examples(state: Dict) -> Iterable[Tuple[str, str]]:
+    """Yield the (label, text) of the messages of the user in a conversation, labeled with the reply of the intent
+    agent that followed. Replies of the fast path itself, recorded with FAST_PATH on, are skipped."""
+    fast_path_replies = list(REPLIES.values())
+    messages = state.get("messages", [])
+    for message, reply in zip(messages, messages[1:]):
+        if message.get("name") != "user_proxy" or reply.get("name") != "intent_understanding_agent":
+            continue
+        text = message.get("content")
+        decision = parse_message(reply)
+        if not isinstance(text, str) or decision is None or decision in fast_path_replies:
+            continue
+        yield label_of(decision), text
+
+
+def evaluate(fast_path: FastPath, examples: List[Tuple[str, str]]) -> Tuple[Dict[str, Dict[str, float]], List[float]]:
+    """Return the precision and recall of each label decided locally, and the classification latencies."""
+    counts = {label: {"tp": 0, "fp": 0, "fn": 0} for label in LABELS if label != LLM}
+    latencies = []
+    decided = 0
+    for truth, text in examples:
+        start = time.perf_counter()
+        predicted, _, how = fast_path.label(text)
+        latencies.append(time.perf_counter() - start)
+        if predicted == TERMINATE and how != "rule":
+            # only the rules end a conversation, see `FastPath.terminates`
+            predicted = LLM
+        if predicted != LLM:
+            decided += 1
+        if predicted == truth and predicted != LLM:
+            counts[predicted]["tp"] += 1
+            continue
+        if predicted != LLM:
+            counts[predicted]["fp"] += 1
+        if truth != LLM:
+            counts[truth]["fn"] += 1
+    rows = {}
+    for label, c in counts.items():
+        rows[label] = {
+            "n": sum(1 for truth, _ in examples if truth == label),
+            "precision": c["tp"] / (c["tp"] + c["fp"]) if c["tp"] + c["fp"] else 1.0,
+            "recall": c["tp"] / (c["tp"] + c["fn"]) if c["tp"] + c["fn"] else 0.0,
+        }
+    wrong = sum(c["fp"] for c in counts.values())
+    rows["all"] = {
+        "n": len(examples),
+        "coverage": decided / len(examples) if examples else 0.0,
+        "precision": (decided - wrong) / decided if decided else 1.0,
+    }
+    return rows, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", nargs="*", default=[], help="session dbs of the sqlite session backend")
+    parser.add_argument("--spill-dirs", nargs="*", default=[], help="spill directories of the memory session backend")
+    parser.add_argument("--conversations", nargs="*", default=[], help="JSONL files of saved conversation states")
+    parser.add_argument("--examples", nargs="*", default=[], help="JSONL files of labeled messages evaluated too")
+    parser.add_argument("--train", default=None, help="a FAST_PATH_EXAMPLES file added to the training set")
+    parser.add_argument("--min-confidence", type=float, nargs="+", default=[0.9])
+    parser.add_argument("--dump-examples", default=None, help="write the replayed labeled messages to a JSONL file")
+    args = parser.parse_args()
+
+    examples = []
+    for state in load_conversations(args.sessions, args.spill_dirs, args.conversations):
+        examples.extend(replay_examples(state))
+    for path in args.examples:
+        examples.extend(load_examples(path))
+    if not examples:
+        parser.error("no labeled messages, give --sessions, --spill-dirs, --conversations or --examples")
+    if args.dump_examples:
+        with open(args.dump_examples, "w", encoding="utf-8") as f:
+            for label, text in examples:
+                f.write(json.dumps({"text": text, "label": label}, ensure_ascii=False) + "\n")
+
+    model = NaiveBayesIntent(SEED_EXAMPLES + (load_examples(args.train) if args.train else []))
+    labels = {label: sum(1 for truth, _ in examples if truth == label) for label in LABELS}
+    print(f"{len(examples)} messages: " + ", ".join(f"{label} {n}" for label, n in labels.items()))
+    for min_confidence in args.min_confidence:
+        rows, latencies = evaluate(FastPath(min_confidence=min_confidence, model=model), examples)
+        print(f"\nmin_confidence={min_confidence}")
+        print_table(rows)
+        print_table({"latency": latency_summary(latencies)})
+
+
+if __name__ == "__main__":
+    main()
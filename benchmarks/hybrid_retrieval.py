@@ -0,0 +1,67 @@
+"""Compare the hybrid BM25 + vector retrieval with the pure vector retrieval of the node db.
+
+Run from the repository root:
+    python -m benchmarks.hybrid_retrieval --tsg-path ./example_data/TSGs
+"""
+import argparse
+import tempfile
+import time
+
+from benchmarks.common import build_node_db, embedding_function, latency_summary, load_queries, print_table
+from tsg_copilot.lexical_index import LexicalIndex, default_lexical_index_path, reciprocal_rank_fusion
+from tsg_copilot.node_retrieve_utils import get_chroma_collection, query_vector_db
+from tsg_copilot.node_store import kv_map_signature
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tsg-path", default="./example_data/TSGs")
+    parser.add_argument("--queries", default=None, help="a file with one query per line, default derived from the nodes")
+    parser.add_argument("--embedding-model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--n-results", type=int, default=5)
+    parser.add_argument("--candidates", type=int, default=20, help="candidates from each index before fusion")
+    parser.add_argument("--limit", type=int, default=200, help="maximum number of queries")
+    args = parser.parse_args()
+
+    embedding_fn = embedding_function(args.embedding_model)
+    with tempfile.TemporaryDirectory() as work_dir:
+        kv_map, kv_map_path, db_path, vector_build = build_node_db(args.tsg_path, work_dir, embedding_fn)
+        start = time.perf_counter()
+        index = LexicalIndex.build(kv_map.items(), kv_map_signature(kv_map_path, kv_map))
+        index.save(default_lexical_index_path(kv_map_path))
+        lexical_build = time.perf_counter() - start
+        start = time.perf_counter()
+        LexicalIndex.load(default_lexical_index_path(kv_map_path))
+        lexical_load = time.perf_counter() - start
+
+        collection = get_chroma_collection(db_path, "all-tsg-nodes")
+        queries = load_queries(args.queries, kv_map, args.limit)
+        # embeddings are computed inside query_vector_db, warm the model up so the first query is not an outlier
+        embedding_fn(queries[:1])
+
+        latencies = {"vector": [], "lexical": [], "hybrid": []}
+        overlap = 0
+        for query in queries:
+            start = time.perf_counter()
+            vector = query_vector_db([query], n_results=args.n_results, collection=collection, embedding_function=embedding_fn)
+            latencies["vector"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            index.search(query, args.candidates)
+            latencies["lexical"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            candidates = query_vector_db([query], n_results=args.candidates, collection=collection, embedding_function=embedding_fn)
+            lexical_ids = [f"node_{id}" for id, _ in index.search(query, args.candidates)]
+            fused = reciprocal_rank_fusion([candidates["ids"][0], lexical_ids])[: args.n_results]
+            latencies["hybrid"].append(time.perf_counter() - start)
+            overlap += len(set(vector["ids"][0]) & {id for id, _ in fused})
+
+    print(f"{len(kv_map)} nodes, {len(queries)} queries")
+    print(f"build: vector {vector_build:.2f}s (embedding included), lexical {lexical_build:.3f}s, lexical load {lexical_load:.3f}s")
+    print_table({name: latency_summary(values) for name, values in latencies.items()})
+    print(f"hybrid top-{args.n_results} shares {overlap / (len(queries) * args.n_results):.0%} of the vector top-{args.n_results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Compare the latency and recall of the numpy vector backend with chromadb.
+
+The numpy backend is exact, so the recall is the share of its top k that chromadb's approximate hnsw search returns.
+Query embeddings are computed once up front, the latencies only cover the backends.
+
+Run from the repository root, on the node db of a tsg directory or on random vectors:
+    python -m benchmarks.vector_backend --tsg-path ./example_data/TSGs
+    python -m benchmarks.vector_backend --synthetic 50000 --dim 1536
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.common import build_node_db, embedding_function, latency_summary, load_queries, print_table
+from tsg_copilot.node_retrieve_utils import get_chroma_client, get_vector_backend, migrate_chroma_to_numpy
+
+COLLECTION = "all-tsg-nodes"
+
+
+def synthetic_node_db(work_dir: str, n: int, dim: int, n_monitors: int, n_queries: int, batch_size: int = 5000):
+    """Fill a chromadb collection with random unit vectors and monitor/isfirst metadata. Return the db path and query
+    embeddings close to random nodes."""
+    rng = np.random.default_rng(0)
+    db_path = os.path.join(work_dir, "nodedb")
+    collection = get_chroma_client(db_path).get_or_create_collection(COLLECTION)
+    embeddings = rng.normal(size=(n, dim)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    for start in range(0, n, batch_size):
+        end = min(start + batch_size, n)
+        collection.upsert(
+            ids=[f"node_{i}" for i in range(start, end)],
+            embeddings=embeddings[start:end].tolist(),
+            documents=[f"intent {i}" for i in range(start, end)],
+            metadatas=[
+                {"title": f"tsg {i // 10}", "monitor": str(i % n_monitors), "isfirst": i % 10 == 0}
+                for i in range(start, end)
+            ],
+        )
+    targets = rng.integers(0, n, size=n_queries)
+    queries = embeddings[targets] + rng.normal(scale=0.5 / np.sqrt(dim), size=(n_queries, dim)).astype(np.float32)
+    filters = [{"$and": [{"monitor": str(t % n_monitors)}, {"isfirst": True}]} for t in targets]
+    return db_path, queries.tolist(), filters
+
+
+def run(backends, queries, filters, n_results):
+    latencies = {}
+    results = {}
+    for name, backend in backends.items():
+        for filtered in (False, True):
+            key = f"{name}{' +where' if filtered else ''}"
+            latencies[key], results[key] = [], []
+            for query, where in zip(queries, filters):
+                start = time.perf_counter()
+                result = backend.query([query], n_results=n_results, where=where if filtered else None)
+                latencies[key].append(time.perf_counter() - start)
+                results[key].append(result["ids"][0])
+    return latencies, results
+
+
+def recall(approximate, exact):
+    hits = sum(len(set(a) & set(e)) for a, e in zip(approximate, exact))
+    return hits / max(sum(len(e) for e in exact), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tsg-path", default="./example_data/TSGs")
+    parser.add_argument("--queries", default=None, help="a file with one query per line, default derived from the nodes")
+    parser.add_argument("--embedding-model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--synthetic", type=int, default=0, help="number of random vectors instead of a tsg directory")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--monitors", type=int, default=500)
+    parser.add_argument("--n-results", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=200, help="number of queries")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.synthetic:
+            db_path, queries, filters = synthetic_node_db(work_dir, args.synthetic, args.dim, args.monitors, args.limit)
+        else:
+            embedding_fn = embedding_function(args.embedding_model)
+            kv_map, _, db_path, _ = build_node_db(args.tsg_path, work_dir, embedding_fn, COLLECTION)
+            texts = load_queries(args.queries, kv_map, args.limit)
+            queries = embedding_fn(texts)
+            filters = [{"isfirst": True}] * len(queries)
+
+        start = time.perf_counter()
+        migrate_chroma_to_numpy(db_path, COLLECTION)
+        migrate_time = time.perf_counter() - start
+        start = time.perf_counter()
+        numpy_backend = get_vector_backend(db_path, COLLECTION, "numpy")
+        open_time = time.perf_counter() - start
+        backends = {"chroma": get_vector_backend(db_path, COLLECTION, "chroma"), "numpy": numpy_backend}
+        # the first queries load the hnsw index and fault in the pages of the matrix
+        run(backends, queries[:5], filters[:5], args.n_results)
+        latencies, results = run(backends, queries, filters, args.n_results)
+
+    print(f"{numpy_backend.count()} vectors, {len(queries)} queries, top {args.n_results}")
+    print(f"numpy backend: copied from chromadb in {migrate_time:.2f}s, opened in {1000 * open_time:.1f}ms")
+    rows = {name: latency_summary(values) for name, values in latencies.items()}
+    for name in ("chroma", "chroma +where"):
+        rows[name]["recall"] = recall(results[name], results[name.replace("chroma", "numpy")])
+    print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
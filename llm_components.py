@@ -1,10 +1,9 @@
 import openai
 import os
-import requests
 # from keybook import keys
-from time import sleep
 from typing import Literal,Optional
 import yaml
+from tsg_copilot.llm_client import openai_client
 
 cloudgpt_available_models = Literal[
     "gpt-35-turbo-20220309",
@@ -17,14 +16,6 @@ cloudgpt_available_models = Literal[
 
 def get_oai_completion_gpt_unified(message_list, gpt_version=4, temperature=0, max_tokens=4800, top_p=0):
     """  cloudgpt   """
-    openai.api_type = "azure"
-    openai.api_base = "https://cloudgpt-openai.azure-api.net/"
-    # openai.api_version = "2022-12-01"
-    openai.api_version = "2023-07-01-preview"
-    # openai.api_version = "2023-12-01-preview"
-
-    # openai.api_key = os.getenv("OPENAI_KEY")  # get openai_key via env var    
-    openai.api_key=get_openai_token()
     if gpt_version == 3.5:
         # engine = "gpt-35-turbo-20220309"       # gpt3.5有 0301  之后还有0613 version
         engine = "gpt-35-turbo-1106"
@@ -35,10 +26,22 @@ def get_oai_completion_gpt_unified(message_list, gpt_version=4, temperature=0, m
         engine="gpt-4-32k-20230321"
     else:
         assert False, "gpt_version should be 3.5 or 4"
-    
+
+    # the client is cheap to build on the pooled http client of the process, which keeps the connections and retries
+    # rate limited and failed calls with capped exponential backoff. The token is refreshed from its cache per call
+    client = openai_client({
+        'model': engine,
+        'api_key': get_openai_token(),
+        'base_url': "https://cloudgpt-openai.azure-api.net/",
+        'api_type': "azure",
+        # 'api_version': "2022-12-01",
+        'api_version': "2023-07-01-preview",
+        # 'api_version': "2023-12-01-preview",
+    })
+
     try: 
-        response = openai.ChatCompletion.create(
-            engine=engine,
+        response = client.chat.completions.create(
+            model=engine,
             # engine="gpt-4-20230321",
             # model="gpt-4-32k-20230321",
             messages=message_list,
@@ -49,38 +52,26 @@ def get_oai_completion_gpt_unified(message_list, gpt_version=4, temperature=0, m
             presence_penalty=0,
             timeout=60
         )
-        gpt_output = response['choices'][0]['message']['content']
+        gpt_output = response.choices[0].message.content
         return gpt_output
-    except requests.exceptions.Timeout:
-        # Handle the timeout error here
-        print("The OpenAI API request timed out. Please try again later.")
-        return None
-    except openai.error.APIConnectionError as e:
-        print(f"The OpenAI API connection failed: {e}")
-        sleep(3)
-        return get_oai_completion_gpt_unified(message_list, gpt_version)
-    except openai.error.InvalidRequestError as e:
+    except openai.BadRequestError as e:
         # Handle the invalid request error here
         print(f"The OpenAI API request was invalid: {e}")
         return None
-    except openai.error.Timeout as e:
+    # the errors below remained after all the retries of the http client
+    except openai.APITimeoutError as e:
         print(f"The OpenAI API read timed out: {e}")
-        sleep(3)
-        return get_oai_completion_gpt_unified(message_list, gpt_version)  
-    except openai.error.RateLimitError as e:
-        print("Token rate limit exceeded. Retrying after 3 second...")
-        sleep(3)
-        return get_oai_completion_gpt_unified(message_list, gpt_version)  
-    except openai.error.APIError as e:
-        if "The operation was timeout" in str(e):
-            # Handle the timeout error here
-            print("The OpenAI API request timed out. Please try again later.")
-            sleep(3)
-            return get_oai_completion_gpt_unified(message_list, gpt_version)           
-        else:
-            # Handle other API errors here
-            print(f"The OpenAI API returned an error: {e}")
-            return None
+        return None
+    except openai.APIConnectionError as e:
+        print(f"The OpenAI API connection failed: {e}")
+        return None
+    except openai.RateLimitError as e:
+        print(f"Token rate limit exceeded after all retries: {e}")
+        return None
+    except openai.APIError as e:
+        # Handle other API errors here
+        print(f"The OpenAI API returned an error: {e}")
+        return None
 
 def get_openai_token(
         token_cache_file: str = "apim-token-cache.bin",
@@ -1,14 +1,34 @@
 import autogen
 import networkx as nx
 from tsg_copilot.group_chat import CustomGroupChat
+from tsg_copilot.speaker_router import SpeakerRouter
+from tsg_copilot.chat_history import ChatHistoryManager, extractive_summarizer, llm_summarizer
 from tsg_copilot.group_chat_manager import GroupChatManager
 from tsg_copilot.conversable_agent import ConversableAgent
 from tsg_copilot.user_proxy_agent import UserProxyAgent
 from tsg_copilot.node_retrieve_agent import RetrieveAssistantAgent
 from tsg_copilot.intent_understanding_agent import IntentUnderstandingAgent
 from tsg_copilot.planner_agent import PlannerAgent
-from chromadb.utils import embedding_functions
-import json
+from tsg_copilot.agent_pool import AgentPool
+from tsg_copilot.conversation_state import ConversationState
+from tsg_copilot.session_backend import create_session_backend
+from tsg_copilot.embedding_cache import CachedEmbeddingFunction
+from tsg_copilot.rerank_cache import RerankCache
+from tsg_copilot.reranker import create_reranker
+from tsg_copilot.speculation import SpeculativeRetrieval
+from tsg_copilot.fast_path import SEED_EXAMPLES, FastPath, NaiveBayesIntent, load_examples
+from tsg_copilot.llm_client import (
+    OpenAIEmbeddingFunction,
+    PooledHTTPClient,
+    RateLimiter,
+    RetryPolicy,
+    set_http_client,
+)
+from tsg_copilot.message_json import parse_message
+from tsg_copilot.request_context import conversation_scope
+from tsg_copilot.streaming import TokenStreamer, a_stream_events, sse_event, stream_events
+from tsg_copilot.tracing import Tracer, get_tracer, set_tracer
+from tsg_copilot.usage import UsageTracker
 
 import random
 from typing import List, Dict
@@ -20,7 +40,7 @@ import sys
 current_directory = os.path.dirname(os.path.realpath(__file__))
 # Add the parent directory to sys.path
 sys.path.append(os.path.join(current_directory, ".."))
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from tsg_copilot.utils import OutputResultsError, DeleteConversationError, MitigateConversationError
 from llm_components import get_openai_token
 
@@ -64,6 +84,49 @@ else:
     tsg_path = config['TSG_PATH']
 
 
+def get_config(key, default=None, cast=str):
+    # optional settings: the system environment variable wins over config.yaml, then the default
+    if key in os.environ:
+        return cast(os.environ[key])
+    if config.get(key) is not None:
+        return cast(config[key])
+    return default
+
+
+agent_pool_size = get_config('AGENT_POOL_SIZE', 8, int)
+agent_pool_warmup = get_config('AGENT_POOL_WARMUP', 2, int)
+conversation_max_entries = get_config('CONVERSATION_MAX_ENTRIES', 1000, int)
+conversation_ttl = get_config('CONVERSATION_TTL', 3600, float)
+conversation_max_bytes = get_config('CONVERSATION_MAX_BYTES', 256 * 1024 * 1024, int)
+conversation_spill_dir = get_config('CONVERSATION_SPILL_DIR', None)
+session_backend = get_config('SESSION_BACKEND', 'memory')
+session_db_path = get_config('SESSION_DB_PATH', 'sessions.sqlite3')
+embedding_cache_path = get_config('EMBEDDING_CACHE_PATH', 'embedding_cache.sqlite3')
+embedding_cache_size = get_config('EMBEDDING_CACHE_SIZE', 10000, int)
+ingest_max_workers = get_config('INGEST_MAX_WORKERS', None, int)
+async_max_workers = get_config('ASYNC_MAX_WORKERS', 64, int)
+history_max_tokens = get_config('HISTORY_MAX_TOKENS', 2000, int)
+history_keep_last = get_config('HISTORY_KEEP_LAST', 6, int)
+history_summarizer = get_config('HISTORY_SUMMARIZER', 'llm')
+rerank_cache_path = get_config('RERANK_CACHE_PATH', 'rerank_cache.sqlite3')
+rerank_cache_ttl = get_config('RERANK_CACHE_TTL', 7 * 24 * 3600, float)
+reranker_kind = get_config('RERANKER', 'llm')
+rerank_margin = get_config('RERANK_MARGIN', 0.15, float)
+vector_backend = get_config('VECTOR_BACKEND', 'chroma')
+usage_export_path = get_config('USAGE_EXPORT_PATH', None)
+trace_export_path = get_config('TRACE_EXPORT_PATH', None)
+hybrid_retrieval = get_config('HYBRID_RETRIEVAL', False, lambda value: str(value).lower() in ('1', 'true', 'yes'))
+speculative = get_config('SPECULATIVE_RETRIEVAL', False, lambda value: str(value).lower() in ('1', 'true', 'yes'))
+speculative_workers = get_config('SPECULATIVE_WORKERS', 4, int)
+fast_path_enabled = get_config('FAST_PATH', False, lambda value: str(value).lower() in ('1', 'true', 'yes'))
+fast_path_min_confidence = get_config('FAST_PATH_MIN_CONFIDENCE', 0.9, float)
+fast_path_examples = get_config('FAST_PATH_EXAMPLES', None)
+llm_max_retries = get_config('LLM_MAX_RETRIES', 6, int)
+llm_requests_per_minute = get_config('LLM_REQUESTS_PER_MINUTE', None, float)
+llm_tokens_per_minute = get_config('LLM_TOKENS_PER_MINUTE', None, float)
+llm_max_connections = get_config('LLM_MAX_CONNECTIONS', 64, int)
+
+
 seed = 45
 max_round = 50
 
@@ -71,19 +134,22 @@ l_user=["user_proxy", "chat_manager"]
 l_exclude_assistant=["node_retrieve_agent"]
 l_oneway_assistant=["planner_agent"]
 
-copilot_state={}
+# conversation states, use the sqlite backend to serve conversations from several worker processes
+if session_backend == 'sqlite':
+    copilot_state = create_session_backend('sqlite', db_path=session_db_path, ttl=conversation_ttl)
+else:
+    copilot_state = create_session_backend(
+        session_backend,
+        max_entries=conversation_max_entries,
+        ttl=conversation_ttl,
+        max_bytes=conversation_max_bytes,
+        spill_dir=conversation_spill_dir,
+    )
 
 
 if not api_key:
     api_key = get_openai_token()
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-                api_key=api_key,
-                api_base=api_base,
-                api_type=api_type,
-                api_version=api_version,
-                model_name="text-embedding-ada-002"
-            )
 if api_type and api_type.startswith("azure"):
     config_list_json = [
         {
@@ -128,12 +194,38 @@ else:
         },
     ]
 
+# the llm calls of all agent sets share a pool of connections, with their retries and the quotas of the deployment.
+# The openai clients of autogen and of the streamer are built on it, and leave the retries to it
+llm_http_client = PooledHTTPClient(
+    retry=RetryPolicy(max_retries=llm_max_retries),
+    limiter=RateLimiter(llm_requests_per_minute, llm_tokens_per_minute),
+    max_connections=llm_max_connections,
+    timeout=600,
+)
+set_http_client(llm_http_client)
+
+# the embeddings of queries and nodes go through the same pool, retries and quotas
+openai_ef = OpenAIEmbeddingFunction(
+                config_list[0],
+                model_name="text-embedding-ada-002",
+                http_client=llm_http_client,
+            )
+# repeated queries skip the embedding round trip
+openai_ef = CachedEmbeddingFunction(
+                openai_ef,
+                model_name="text-embedding-ada-002",
+                cache_path=embedding_cache_path,
+                max_items=embedding_cache_size,
+            )
+
 llm_config={
         "timeout": 600,
         "cache_seed": seed,
         "config_list": config_list,
         "temperature": 0,
         "top_p": 0,
+        "http_client": llm_http_client,
+        "max_retries": 0,
     }
 
 llm_config_json={
@@ -142,10 +234,24 @@ llm_config_json={
         "config_list": config_list_json,
         "temperature": 0,
         "top_p": 0,
+        "http_client": llm_http_client,
+        "max_retries": 0,
     }
 
+# LLM clients are stateless, share them across all agent sets
+llm_client = autogen.OpenAIWrapper(**{**ConversableAgent.DEFAULT_CONFIG, **llm_config})
+llm_client_json = autogen.OpenAIWrapper(**{**ConversableAgent.DEFAULT_CONFIG, **llm_config_json})
+# the json replies of the intent agent and the planner are streamed to the clients of /api/tsg_copilot/stream, the
+# routing fields of the intent as soon as they are generated and the planner's answer token by token
+json_streamer = TokenStreamer(
+    config_list_json[0],
+    temperature=llm_config_json["temperature"],
+    top_p=llm_config_json["top_p"],
+    timeout=llm_config_json["timeout"],
+)
 
-def init_TSG_Copilot():
+
+def build_speaker_graph():
     graph = nx.DiGraph()
     graph.add_node("user_proxy", label="user proxy")
     graph.add_node("node_retrieve_agent", label="node retrieve agent")
@@ -162,7 +268,42 @@ def init_TSG_Copilot():
 
     # Set entry point
     graph.nodes["user_proxy"]["first_round_speaker"] = True
-                
+    return graph
+
+
+# the speaker graph and its routing table are read-only, share them across all agent sets
+speaker_graph = build_speaker_graph()
+speaker_router = SpeakerRouter(speaker_graph)
+# rerank answers are shared by all conversations and worker processes, disable the cache with an empty path
+rerank_cache = RerankCache(rerank_cache_path, ttl=rerank_cache_ttl) if rerank_cache_path else None
+# the reranker only holds settings and counters, share it across all agent sets
+reranker_kwargs = {'margin': rerank_margin} if reranker_kind == 'local' else {}
+reranker = create_reranker(reranker_kind, **reranker_kwargs)
+# the searches of the user's messages run concurrently with the intent llm call, on threads shared by all agent sets
+speculative_retrieval = SpeculativeRetrieval(max_workers=speculative_workers) if speculative else None
+# the obvious messages of the user are answered without the intent llm call, the classifier is shared by all agent sets
+fast_path = None
+if fast_path_enabled:
+    fast_path_model = NaiveBayesIntent(SEED_EXAMPLES + (load_examples(fast_path_examples) if fast_path_examples else []))
+    fast_path = FastPath(min_confidence=fast_path_min_confidence, model=fast_path_model)
+
+# spans of the stages of each turn, e.g. speaker selection, retrieval and llm calls
+set_tracer(Tracer(export_path=trace_export_path))
+
+# llm usage of all agent sets, per agent and per conversation
+usage_tracker = UsageTracker(max_conversations=conversation_max_entries, export_path=usage_export_path)
+
+# the history manager only holds settings, the summary of each conversation lives in its ConversationState
+history_manager = ChatHistoryManager(
+    max_tokens=history_max_tokens,
+    keep_last=history_keep_last,
+    model=config_list[0]["model"],
+    summarizer=llm_summarizer(llm_client, usage_tracker) if history_summarizer == 'llm' else extractive_summarizer(),
+)
+
+
+def init_TSG_Copilot():
+    graph = speaker_graph
 
     # Termination message detection
     def is_termination_msg(content) -> bool:
@@ -175,6 +316,9 @@ def init_TSG_Copilot():
         have_content = content.get("content", None) is not None
         if have_content and content["content"].lower() == "exit":
             return True
+        # "bye" or "end the chat" of the user ends the conversation like "exit"
+        if have_content and fast_path is not None and content.get("name") == "user_proxy":
+            return fast_path.terminates(content["content"])
         return False
 
     agents = []
@@ -185,7 +329,9 @@ def init_TSG_Copilot():
         system_message="An attentive HUMAN user who can answer questions about the task, and can perform tasks such as running Python code or inputting command line commands at a Linux terminal and reporting back the execution results.",
         code_execution_config=False,
         is_termination_msg=is_termination_msg,
-        llm_config=llm_config
+        llm_config=llm_config,
+        llm_client=llm_client,
+        usage_tracker=usage_tracker,
     )
 
     node_retrieve_agent = RetrieveAssistantAgent(
@@ -197,21 +343,37 @@ def init_TSG_Copilot():
             "model": config_list[0]["model"],
             "embedding_function": openai_ef,
             "n_results": 5,
+            "ingest_max_workers": ingest_max_workers,
+            "rerank_cache": rerank_cache,
+            "reranker": reranker,
+            "vector_backend": vector_backend,
+            "hybrid_retrieval": hybrid_retrieval,
+            "speculative_retrieval": speculative_retrieval,
         },
         code_execution_config=False, # set to False if you don't want to execute the code
-        llm_config=llm_config_json
+        llm_config=llm_config_json,
+        llm_client=llm_client_json,
+        usage_tracker=usage_tracker,
     )
 
     intent_understanding_agent = IntentUnderstandingAgent(
         name="intent_understanding_agent",
         human_input_mode="NEVER",
         llm_config=llm_config_json,
+        llm_client=llm_client_json,
+        usage_tracker=usage_tracker,
+        token_streamer=json_streamer,
+        retriever=node_retrieve_agent,
+        fast_path=fast_path,
     )
 
     planner_agent = PlannerAgent(
         name="planner_agent",
         human_input_mode="NEVER",
         llm_config=llm_config_json,
+        llm_client=llm_client_json,
+        usage_tracker=usage_tracker,
+        token_streamer=json_streamer,
     )
 
     def print_messages(recipient, messages, sender, config):
@@ -219,9 +381,8 @@ def init_TSG_Copilot():
         print(f"Messages from: {sender.name} sent to: {recipient.name} | num messages: {len(messages)} | message: {messages[-1]}")
 
         last_message=messages[-1]
-        content=last_message['content']
         try:
-            content=json.loads(content)
+            content=parse_message(last_message, strict=True)
             if 'RESPONSE' in content.keys():
                 try:
                     from termcolor import colored
@@ -274,12 +435,16 @@ def init_TSG_Copilot():
         l_user=l_user,
         l_exclude_assistant=l_exclude_assistant,
         l_oneway_assistant=l_oneway_assistant,
+        router=speaker_router,
+        history_manager=history_manager,
     )
 
     manager = GroupChatManager(
         name="chat_manager", 
         groupchat=group_chat, 
         llm_config=llm_config,
+        llm_client=llm_client,
+        usage_tracker=usage_tracker,
         is_termination_msg=is_conversation_terminated)
 
     state = TSG_Copilot_State(agents, manager)
@@ -293,65 +458,134 @@ class TSG_Copilot_State:
         self.agents = agents        
         self.manager = manager
 
-def TSG_Copilot_Chat(user_query, conversation_id, state, is_initial_conversation=False):
+    def reset(self):
+        # drop everything of the previous conversation before the agent set goes back to the pool
+        for agent in self.agents:
+            agent.reset()
+        self.manager.reset()
+        self.manager.groupchat.messages = []
+        self.manager.groupchat.memory = []
+        self.manager.groupchat.history_summary = history_manager.new_state()
+        self.manager.chat_round = 0
+        self.agents[1].previous_node = None
+
+
+agent_pool = AgentPool(init_TSG_Copilot, size=agent_pool_size, warmup=agent_pool_warmup)
+
+def conversation_results(error, conversation_id, state):
+    """Turn the error that ends a turn of the group chat into the results returned to the user."""
     agents=state.agents
     manager=state.manager
-    try:
-        if is_initial_conversation:
-            agents[0].initiate_chat(manager, message=user_query)
-        else:
-            agents[0].continue_chat(manager, user_query=user_query)
-    except OutputResultsError as output_results_error:
-        prompt=output_results_error.message
+    if isinstance(error, OutputResultsError):
+        prompt=error.message
         last_message = manager.groupchat.messages[-1]
-        content=json.loads(last_message["content"])         
+        content=dict(parse_message(last_message, strict=True))
         content['prompt']=prompt
         if agents[1].previous_node != None:
             content['tsg'] = agents[1].previous_node["#title#"]
         else:
             content['tsg'] = ""
         return content
-    except DeleteConversationError as delete_conversation_error:
-        message=delete_conversation_error.message
+    if isinstance(error, DeleteConversationError):
+        message=error.message
         # delete the conversation
-        assert conversation_id in copilot_state, "conversation_id not in copilot_state"
-        del copilot_state[conversation_id]
+        copilot_state.pop(conversation_id, None)
         content={}
         content['prompt']='The conversation is over.'               
         content['RESPONSE']=message
         content['tsg'] = ""
         return content
-    except MitigateConversationError as mitigate_conversation_error:
-        prompt=mitigate_conversation_error.message
-        last_message = manager.groupchat.messages[-1]
-        content=json.loads(last_message["content"])         
-        content['prompt']=prompt
-        content['tsg'] = ""
-        return content
-    
-def TSG_Copilot(user_input):
-    user_query = user_input['query']
-    conversation_id = user_input['conversation_id']
-    if conversation_id not in copilot_state:
+    # MitigateConversationError
+    prompt=error.message
+    last_message = manager.groupchat.messages[-1]
+    content=dict(parse_message(last_message, strict=True))
+    content['prompt']=prompt
+    content['tsg'] = ""
+    return content
+
+
+def TSG_Copilot_Chat(user_query, conversation_id, state, is_initial_conversation=False):
+    agents=state.agents
+    manager=state.manager
+    try:
+        if is_initial_conversation:
+            agents[0].initiate_chat(manager, message=user_query)
+        else:
+            agents[0].continue_chat(manager, user_query=user_query)
+    except (OutputResultsError, DeleteConversationError, MitigateConversationError) as error:
+        return conversation_results(error, conversation_id, state)
+
+
+async def a_TSG_Copilot_Chat(user_query, conversation_id, state, is_initial_conversation=False):
+    agents=state.agents
+    manager=state.manager
+    try:
+        if is_initial_conversation:
+            await agents[0].a_initiate_chat(manager, message=user_query)
+        else:
+            await agents[0].a_continue_chat(manager, user_query=user_query)
+    except (OutputResultsError, DeleteConversationError, MitigateConversationError) as error:
+        return conversation_results(error, conversation_id, state)
+
+
+def begin_turn(conversation_id):
+    conversation = copilot_state.get(conversation_id)
+    is_initial_conversation = conversation is None
+    if is_initial_conversation:
         # initialize the conversation
-        state = init_TSG_Copilot()        
-        results = TSG_Copilot_Chat(user_query, conversation_id, state, is_initial_conversation=True)        
-    else:
-        # load the conversation
-        state = copilot_state[conversation_id]            
-        assert state is not None, "state is None"
-        results = TSG_Copilot_Chat(user_query, conversation_id, state)
+        conversation = ConversationState()
+    # save state, a finished conversation removes itself in conversation_results
+    copilot_state[conversation_id] = conversation
+    return conversation, is_initial_conversation
+
+
+def end_turn(conversation_id, conversation, results):
+    # write the state of this turn back, unless the conversation was deleted
+    if conversation_id in copilot_state:
+        copilot_state[conversation_id] = conversation
 
     output={
         "prompt": results['prompt'],
         "response": results['RESPONSE'],
         "title": results['tsg'],
     }    
-    # save state dict
-    copilot_state[conversation_id] = state
     return output
 
 
+def TSG_Copilot(user_input):
+    user_query = user_input['query']
+    conversation_id = user_input['conversation_id']
+    conversation, is_initial_conversation = begin_turn(conversation_id)
+
+    with agent_pool.lease() as state, conversation_scope(conversation_id):
+        conversation.restore(state)
+        try:
+            results = TSG_Copilot_Chat(user_query, conversation_id, state, is_initial_conversation=is_initial_conversation)
+        finally:
+            conversation.capture(state)
+
+    return end_turn(conversation_id, conversation, results)
+
+
+async def a_TSG_Copilot(user_input):
+    """Serve one turn of a conversation on the running event loop, see `main_async.py`."""
+    user_query = user_input['query']
+    conversation_id = user_input['conversation_id']
+    conversation, is_initial_conversation = begin_turn(conversation_id)
+
+    async with agent_pool.a_lease() as state:
+        conversation.restore(state)
+        try:
+            with conversation_scope(conversation_id):
+                results = await a_TSG_Copilot_Chat(
+                    user_query, conversation_id, state, is_initial_conversation=is_initial_conversation
+                )
+        finally:
+            conversation.capture(state)
+
+    return end_turn(conversation_id, conversation, results)
+
+
 @app.route('/api/tsg_copilot', methods=['POST'])
 def copilot_handler():
     try:
@@ -365,6 +599,59 @@ def copilot_handler():
         return jsonify({'error': 'Index out of range error.'}), 500 
     return jsonify(results)
 
+def copilot_metrics():
+    return {
+        'conversations': copilot_state.metrics(),
+        'agent_pool': agent_pool.stats(),
+        'embedding_cache': openai_ef.stats(),
+        'speaker_selection': speaker_router.stats(),
+        'rerank_cache': rerank_cache.stats() if rerank_cache is not None else {},
+        'reranker': reranker.stats(),
+        'llm_usage': usage_tracker.stats(),
+        'stages': get_tracer().stats(),
+        'speculative_retrieval': speculative_retrieval.stats() if speculative_retrieval is not None else {},
+        'fast_path': fast_path.stats() if fast_path is not None else {},
+        'llm_http': llm_http_client.stats(),
+    }
+
+def TSG_Copilot_stream(user_input):
+    """Serve one turn, yielding its events as they happen: the selected speakers, the retrieval, the selected tsg, the
+    tokens of the planner's answer and, last, the results of `TSG_Copilot` or an error."""
+    return stream_events(lambda: TSG_Copilot(user_input))
+
+
+def a_TSG_Copilot_stream(user_input):
+    """Serve one turn on the running event loop, yielding its events as they happen, see `TSG_Copilot_stream`."""
+    return a_stream_events(lambda: a_TSG_Copilot(user_input))
+
+
+@app.route('/api/tsg_copilot/stream', methods=['POST'])
+def copilot_stream_handler():
+    try:
+        input_json = request.get_json(force=True)
+    except KeyError:
+        return jsonify({'error': 'Invalid input JSON format. Required keys: query, conversation_id.'}), 400
+
+    events = (sse_event(event, data) for event, data in TSG_Copilot_stream(input_json))
+    # no buffering by proxies, the events are only useful as they happen
+    return Response(events, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/tsg_copilot/metrics', methods=['GET'])
+def metrics_handler():
+    return jsonify(copilot_metrics())
+
+def conversation_usage(conversation_id):
+    usage = usage_tracker.conversation(conversation_id)
+    return {'conversation_id': conversation_id, **(usage or {'total': {}, 'agents': {}})}
+
+@app.route('/api/tsg_copilot/usage', methods=['GET'])
+def usage_handler():
+    return jsonify(usage_tracker.stats())
+
+@app.route('/api/tsg_copilot/usage/<conversation_id>', methods=['GET'])
+def conversation_usage_handler(conversation_id):
+    return jsonify(conversation_usage(conversation_id))
+
 @app.errorhandler(500)
 def internal_server_error(error):
     return jsonify({'error': 'Internal Server Error.'}), 500
@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from main import (
+    a_TSG_Copilot,
+    a_TSG_Copilot_stream,
+    async_max_workers,
+    conversation_usage,
+    copilot_metrics,
+    usage_tracker,
+)
+from tsg_copilot.streaming import sse_event
+
+# every conversation is served on the event loop of this app, run it with a single worker process per host core, e.g.
+# uvicorn main_async:app --host 0.0.0.0 --port 2000
+app = FastAPI()
+
+
+@app.on_event("startup")
+async def set_default_executor():
+    # blocking work of the agents (sync reply functions, retrieval, kusto lookups, llm calls) runs in this executor
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=async_max_workers))
+
+
+@app.post('/api/tsg_copilot')
+async def copilot_handler(request: Request):
+    try:
+        input_json = await request.json()
+    except ValueError:
+        return JSONResponse({'error': 'Invalid input JSON format. Required keys: query, conversation_id.'}, status_code=400)
+
+    try:
+        results = await a_TSG_Copilot(input_json)
+    except IndexError:
+        return JSONResponse({'error': 'Index out of range error.'}, status_code=500)
+    return results
+
+
+@app.post('/api/tsg_copilot/stream')
+async def copilot_stream_handler(request: Request):
+    try:
+        input_json = await request.json()
+    except ValueError:
+        return JSONResponse({'error': 'Invalid input JSON format. Required keys: query, conversation_id.'}, status_code=400)
+
+    async def events():
+        async for event, data in a_TSG_Copilot_stream(input_json):
+            yield sse_event(event, data)
+
+    # no buffering by proxies, the events are only useful as they happen
+    return StreamingResponse(
+        events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.get('/api/tsg_copilot/metrics')
+async def metrics_handler():
+    return copilot_metrics()
+
+
+@app.get('/api/tsg_copilot/usage')
+async def usage_handler():
+    return usage_tracker.stats()
+
+
+@app.get('/api/tsg_copilot/usage/{conversation_id}')
+async def conversation_usage_handler(conversation_id: str):
+    return conversation_usage(conversation_id)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(app, host='0.0.0.0', port=2000)
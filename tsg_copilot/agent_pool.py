@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import queue
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AgentPool:
+    """A pool of pre-warmed agent sets shared by all conversations.
+
+    Building an agent set (speaker graph, agents, group chat and manager) is done by `factory`. Agent sets do not keep
+    any conversation state between checkouts, callers restore a `ConversationState` into the checked-out set and
+    capture it back before releasing it.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        size: int = 4,
+        warmup: int = 1,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Args:
+            factory (Callable): builds a new agent set, e.g. `init_TSG_Copilot`.
+            size (int): the maximum number of agent sets in the pool.
+            warmup (int): the number of agent sets built up front. Capped by `size`.
+            timeout (float or None): seconds to wait for a free agent set when the pool is exhausted.
+                None waits forever.
+        """
+        if size < 1:
+            raise ValueError("size of the agent pool should be at least 1.")
+        self._factory = factory
+        self._size = size
+        self._timeout = timeout
+        self._idle = queue.LifoQueue()  # reuse the most recently released set first, it is the warmest
+        self._lock = threading.Lock()
+        self._created = 0
+        self._checkouts = 0
+        self._waits = 0
+        for _ in range(min(max(warmup, 0), size)):
+            self._reserve()
+            self._idle.put(self._create())
+        logger.info(f"Agent pool warmed up with {self._created} agent sets.")
+
+    def _reserve(self) -> bool:
+        with self._lock:
+            if self._created >= self._size:
+                return False
+            self._created += 1
+            return True
+
+    def _create(self):
+        try:
+            return self._factory()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def checkout(self):
+        """Take an agent set from the pool, building a new one if the pool is not full yet."""
+        with self._lock:
+            self._checkouts += 1
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        if self._reserve():
+            return self._create()
+        with self._lock:
+            self._waits += 1
+        try:
+            return self._idle.get(timeout=self._timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No free agent set in the pool after {self._timeout} seconds.")
+
+    def release(self, agent_set):
+        """Reset an agent set and return it to the pool."""
+        agent_set.reset()
+        self._idle.put(agent_set)
+
+    @contextmanager
+    def lease(self):
+        agent_set = self.checkout()
+        try:
+            yield agent_set
+        finally:
+            self.release(agent_set)
+
+    @asynccontextmanager
+    async def a_lease(self):
+        """(async) Same as `lease`. Waiting for a free agent set or building one happens in the default executor, so
+        the event loop keeps serving other conversations meanwhile."""
+        try:
+            agent_set = self._idle.get_nowait()
+            with self._lock:
+                self._checkouts += 1
+        except queue.Empty:
+            agent_set = await asyncio.get_event_loop().run_in_executor(None, self.checkout)
+        try:
+            yield agent_set
+        finally:
+            self.release(agent_set)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": self._size,
+                "created": self._created,
+                "idle": self._idle.qsize(),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+            }
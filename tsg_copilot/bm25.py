@@ -0,0 +1,57 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens. Identifiers such as table names or monitor ids stay whole, e.g. `cluster_health`."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def node_text(node: Dict, fields=("#intent#", "#action#")) -> str:
+    """The text of the given fields of a tsg node, non-string values are serialized."""
+    parts = []
+    for field in fields:
+        value = node.get(field)
+        if value:
+            parts.append(value if isinstance(value, str) else str(value))
+    return "\n".join(parts)
+
+
+class BM25:
+    """Okapi BM25 over a small list of documents, e.g. the candidates of one retrieval."""
+
+    def __init__(self, documents: List[List[str]], k1: float = 1.5, b: float = 0.75, idf: Optional[Dict[str, float]] = None):
+        """
+        Args:
+            documents (List[List[str]]): the tokenized documents.
+            k1 (float): term frequency saturation.
+            b (float): length normalization.
+            idf (dict or None): idf of the terms, e.g. computed over the whole node db. Default is None, the idf is
+                computed over `documents`.
+        """
+        self.k1 = k1
+        self.b = b
+        self._tfs = [Counter(document) for document in documents]
+        self._lengths = [len(document) for document in documents]
+        self._avg_length = (sum(self._lengths) / len(documents)) if documents else 0.0
+        if idf is None:
+            df = Counter(term for tf in self._tfs for term in tf)
+            n = len(documents)
+            idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+        self._idf = idf
+
+    def scores(self, query: List[str]) -> List[float]:
+        scores = []
+        for tf, length in zip(self._tfs, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self._avg_length) if self._avg_length else self.k1
+            for term in query:
+                freq = tf.get(term)
+                if freq:
+                    score += self._idf.get(term, 0.0) * freq * (self.k1 + 1) / (freq + norm)
+            scores.append(score)
+        return scores
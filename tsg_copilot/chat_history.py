@@ -0,0 +1,159 @@
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from autogen.token_count_utils import count_token
+
+logger = logging.getLogger(__name__)
+
+# CustomGroupChat.update_memory prefixes the node handed to the planner with it
+NODE_PREFIX = "Node Retrieval:"
+
+SUMMARY_PROMPT = """Summarize the troubleshooting conversation between the user and TSG Copilot. Update <PREVIOUS_SUMMARY> with <NEW_CHAT>, keep the incident details, the parameters given by the user (such as cluster, container or ids), the steps already taken and their results. Answer with the summary only.
+<PREVIOUS_SUMMARY>:
+{summary}
+<NEW_CHAT>:
+{chat}
+"""
+
+
+def extractive_summarizer(max_chars: int = 200) -> Callable[[str, List[str]], str]:
+    """A summarizer without llm calls: append the new chats, truncated to `max_chars` characters each."""
+
+    def summarize(summary: str, chats: List[str]) -> str:
+        lines = [summary] if summary else []
+        lines += [chat if len(chat) <= max_chars else chat[:max_chars] + "..." for chat in chats]
+        return "\n".join(lines)
+
+    return summarize
+
+
+def llm_summarizer(client, usage_tracker=None) -> Callable[[str, List[str]], str]:
+    """A summarizer asking the llm to fold the new chats into the previous summary.
+
+    Args:
+        client (OpenAIWrapper): the llm client, e.g. the one shared by the agents.
+        usage_tracker (UsageTracker or None): accounts the calls as "chat_history". Default is None, not accounted.
+    """
+
+    def summarize(summary: str, chats: List[str]) -> str:
+        start = time.perf_counter()
+        response = client.create(
+            messages=[
+                {"role": "user", "content": SUMMARY_PROMPT.format(summary=summary or "(empty)", chat="\n".join(chats))}
+            ]
+        )
+        if usage_tracker is not None:
+            usage_tracker.record("chat_history", response, time.perf_counter() - start)
+        return client.extract_text_or_completion_object(response)[0]
+
+    return summarize
+
+
+class ChatHistoryManager:
+    """Build the <CHAT_HISTORY> of the intent understanding and planner prompts within a token budget.
+
+    The last `keep_last` chats of the group chat memory are kept verbatim, as well as the latest retrieved node. Older
+    chats are folded into a rolling summary, `fold_batch` chats at a time, so the summarizer runs once every few turns
+    and only on the new chats. Chats are folded earlier if the history would exceed `max_tokens`.
+
+    The manager holds no conversation state and can be shared by all group chats. The summary and the number of
+    chats it covers live in the `state` dict passed to `render`, which is part of the conversation state.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 2000,
+        keep_last: int = 6,
+        fold_batch: int = 4,
+        max_summary_tokens: int = 500,
+        model: str = "gpt-4",
+        summarizer: Optional[Callable[[str, List[str]], str]] = None,
+    ):
+        """
+        Args:
+            max_tokens (int): the token budget of the history, measured with `count_token`.
+            keep_last (int): the number of most recent chats kept verbatim.
+            fold_batch (int): the number of older chats folded into the summary at a time.
+            max_summary_tokens (int): the summary is trimmed from its start beyond this number of tokens.
+            model (str): the model passed to `count_token`.
+            summarizer (Callable or None): takes the previous summary and the chats to fold, returns the new summary.
+                Default is None, `extractive_summarizer()`.
+        """
+        self.max_tokens = max_tokens
+        self.keep_last = max(keep_last, 1)
+        self.fold_batch = max(fold_batch, 1)
+        self.max_summary_tokens = max_summary_tokens
+        self.model = model
+        self.summarizer = extractive_summarizer() if summarizer is None else summarizer
+        self._fallback = extractive_summarizer()
+
+    @staticmethod
+    def new_state() -> Dict:
+        return {"summary": "", "covered": 0}
+
+    def _count(self, text: str) -> int:
+        return count_token(text, self.model) if text else 0
+
+    def _trim(self, summary: str) -> str:
+        while summary and self._count(summary) > self.max_summary_tokens:
+            lines = summary.split("\n")
+            summary = "\n".join(lines[1:]) if len(lines) > 1 else summary[len(summary) // 4 :]
+        return summary
+
+    def _fold(self, state: Dict, chats: List[str], end: int):
+        new_chats = chats[state["covered"] : end]
+        if not new_chats:
+            return
+        try:
+            summary = self.summarizer(state["summary"], new_chats)
+        except Exception as e:
+            logger.warning(f"Failed to summarize the chat history, fall back to the extractive summary: {e}")
+            summary = self._fallback(state["summary"], new_chats)
+        state["summary"] = self._trim(summary)
+        state["covered"] = end
+
+    def _compose(self, state: Dict, chats: List[str], node_index: Optional[int]) -> str:
+        parts = []
+        if state["summary"]:
+            parts.append(f"Summary of the earlier conversation: {state['summary']}")
+        if node_index is not None and node_index < state["covered"]:
+            # the latest node is needed verbatim to refine the plan, even when it is already summarized
+            parts.append(chats[node_index])
+        parts.extend(chats[state["covered"] :])
+        return "\n".join(parts)
+
+    def render(self, memory: List[Dict], state: Dict) -> str:
+        """Return the chat history of the memory, folding older chats into the summary of `state` as needed.
+
+        Args:
+            memory (list): `CustomGroupChat.memory`, dicts with a "chat" key.
+            state (dict): the summary state of the conversation, see `new_state`. It is updated in place.
+        """
+        chats = [entry["chat"] for entry in memory]
+        if state.get("covered", 0) > len(chats):
+            # the memory was reset, the summary belongs to another conversation
+            state.update(self.new_state())
+        state.setdefault("summary", "")
+        state.setdefault("covered", 0)
+        node_index = next((i for i in range(len(chats) - 1, -1, -1) if chats[i].startswith(NODE_PREFIX)), None)
+
+        window_start = max(state["covered"], len(chats) - self.keep_last)
+        if window_start - state["covered"] >= self.fold_batch:
+            self._fold(state, chats, window_start)
+
+        history = self._compose(state, chats, node_index)
+        if self._count(history) <= self.max_tokens:
+            return history
+
+        # over budget: fold the oldest verbatim chats in one go, always keeping the latest chat
+        budget = self.max_tokens - self.max_summary_tokens
+        if node_index is not None:
+            budget -= self._count(chats[node_index])
+        end = len(chats) - 1
+        used = self._count(chats[end])
+        while end > state["covered"] and used + self._count(chats[end - 1]) <= budget:
+            end -= 1
+            used += self._count(chats[end])
+        self._fold(state, chats, end)
+        return self._compose(state, chats, node_index)
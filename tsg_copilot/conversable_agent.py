@@ -1,14 +1,18 @@
 import asyncio
 import copy
-import functools
 import json
 import logging
+import time
 from collections import defaultdict
 from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Type, Union
 
 from autogen import OpenAIWrapper
 from autogen import Agent
 from autogen.code_utils import DEFAULT_MODEL, UNKNOWN, content_str, execute_code, extract_code, infer_lang
+from tsg_copilot.message_json import ROUTING_FIELDS, ChatMessage, StreamingJSONParser
+from tsg_copilot.streaming import TokenStreamer, emit_event, streaming
+from tsg_copilot.tracing import span
+from tsg_copilot.usage import UsageTracker, default_usage_tracker
 
 
 try:
@@ -45,30 +49,6 @@ class ConversableAgent(Agent):
 
     llm_config: Union[Dict, Literal[False]]
 
-    _registry: Dict[str, float] = {}
-
-    @classmethod
-    def tokens_usage(cls,total_usage):
-        if 'cost' not in cls._registry:
-            cls._registry['cost'] = 0.0
-        if 'prompt_tokens' not in cls._registry:
-            cls._registry['prompt_tokens'] = 0
-        if 'completion_tokens' not in cls._registry:
-            cls._registry['completion_tokens'] = 0
-        if 'total_tokens' not in cls._registry:
-            cls._registry['total_tokens'] = 0
-        cls._registry['cost'] += total_usage[0]['cost']
-        cls._registry['prompt_tokens'] += total_usage[0]['prompt_tokens']
-        cls._registry['completion_tokens'] += total_usage[0]['completion_tokens']
-        cls._registry['total_tokens'] += total_usage[0]['total_tokens']
-
-    @classmethod
-    def clear_tokens_usage(cls):
-        for k,_ in cls._registry.items():
-            cls._registry[k] = 0.0
-
-
-
     def __init__(
         self,
         name: str,
@@ -81,6 +61,9 @@ class ConversableAgent(Agent):
         llm_config: Optional[Union[Dict, Literal[False]]] = None,
         default_auto_reply: Optional[Union[str, Dict, None]] = "",
         description: Optional[str] = None,
+        llm_client: Optional[OpenAIWrapper] = None,
+        usage_tracker: Optional[UsageTracker] = None,
+        token_streamer: Optional[TokenStreamer] = None,
     ):
         """
         Args:
@@ -124,6 +107,12 @@ class ConversableAgent(Agent):
             default_auto_reply (str or dict or None): default auto reply when no code execution or llm-based reply is generated.
             description (str): a short description of the agent. This description is used by other agents
                 (e.g. the GroupChatManager) to decide when to call upon this agent. (Default: system_message)
+            llm_client (OpenAIWrapper): a pre-built client to share across agents with the same llm_config.
+                If None, a new client is created from llm_config.
+            usage_tracker (UsageTracker): accounts the tokens, cost and latency of every llm call of the agent.
+                If None, the process-wide `default_usage_tracker` is used.
+            token_streamer (TokenStreamer): if given, the llm replies of the agent are streamed token by token to
+                the client of a streamed turn. Default is None, replies are sent whole.
         """
         super().__init__(name)
         # a dictionary of conversations, default value is list
@@ -143,7 +132,10 @@ class ConversableAgent(Agent):
             self.llm_config = self.DEFAULT_CONFIG.copy()
             if isinstance(llm_config, dict):
                 self.llm_config.update(llm_config)
-            self.client = OpenAIWrapper(**self.llm_config)
+            self.client = llm_client if llm_client is not None else OpenAIWrapper(**self.llm_config)
+        self.usage_tracker = usage_tracker if usage_tracker is not None else default_usage_tracker
+        self.token_streamer = token_streamer
+        self._field_hooks: List[Callable] = []
 
         self._code_execution_config: Union[Dict, Literal[False]] = (
             {} if code_execution_config is None else code_execution_config
@@ -295,7 +287,7 @@ class ConversableAgent(Agent):
         The message can be a string or a dictionary. The string will be put in the "content" field of the new dictionary.
         """
         if isinstance(message, str):
-            return {"content": message}
+            return ChatMessage(content=message)
         elif isinstance(message, dict):
             return message
         else:
@@ -319,7 +311,9 @@ class ConversableAgent(Agent):
         """
         message = self._message_to_dict(message)
         # create oai message to be appended to the oai conversation that can be passed to oai directly.
-        oai_message = {k: message[k] for k in ("content", "function_call", "name", "context") if k in message}
+        oai_message = ChatMessage({k: message[k] for k in ("content", "function_call", "name", "context") if k in message})
+        # the json content is parsed once for the sender and all receivers
+        oai_message.carry_parsed(message)
         if conversation_id.name:
             oai_message["name"] = conversation_id.name
         if "content" not in oai_message:
@@ -605,6 +599,21 @@ class ConversableAgent(Agent):
         # self._prepare_chat(recipient, clear_history)
         self.send(user_query, recipient, silent=silent)
 
+    async def a_continue_chat(
+        self,
+        recipient: "ConversableAgent",
+        user_query: str,
+        silent: Optional[bool] = False,
+    ):
+        """(async) Continue the chat with the recipient agent with a new user query.
+
+        Args:
+            recipient: the recipient agent.
+            user_query (str): the new query of the user.
+            silent (bool or None): (Experimental) whether to print the messages for this conversation.
+        """
+        await self.a_send(user_query, recipient, silent=silent)
+
     async def a_initiate_chat(
         self,
         recipient: "ConversableAgent",
@@ -673,12 +682,11 @@ class ConversableAgent(Agent):
         client = self.client if config is None else config
         if client is None:
             return ""
-        response = client.create(context=None, messages=message_list)
-        print("generate_oai_reply_self token count\n")
-        total_usage = [v for k,v in client.total_usage_summary.items() if k!='total_cost']
-        self.tokens_usage(total_usage)
+        start = time.perf_counter()
+        with span("generate_oai_reply_self", agent=self.name):
+            response = client.create(context=None, messages=message_list)
+        self.usage_tracker.record(self.name, response, time.perf_counter() - start)
 
-        
         extracted_response = client.extract_text_or_completion_object(response)[0]
         if not isinstance(extracted_response, str):
             extracted_response = extracted_response.model_dump(mode="dict")
@@ -702,14 +710,29 @@ class ConversableAgent(Agent):
         # # print(messages[-1], self._oai_system_message, sender, self.name, len(messages))
         # print(self._oai_system_message + [messages[-1]])
         # TODO: #1143 handle token limit exceeded error
-        response = client.create(
-            # context=messages[-1].pop("context", None), messages=self._oai_system_message + messages
-            # use our own memory module, not its original directly add all history messages again
-            messages=self._oai_system_message + [messages[-1]]
-        )
-        print("generate_oai_reply token count\n")
-        total_usage = [v for k,v in client.total_usage_summary.items() if k!='total_cost']
-        self.tokens_usage(total_usage)
+        start = time.perf_counter()
+        streamer = self.token_streamer if streaming() else None
+        with span("generate_oai_reply", agent=self.name, stream=streamer is not None):
+            if streamer is not None:
+                parser = StreamingJSONParser()
+                emit_event("generating", agent=self.name)
+                response = streamer.create(
+                    self._oai_system_message + [messages[-1]],
+                    on_token=lambda text: self._forward_token(parser, text),
+                )
+            else:
+                response = client.create(
+                    # context=messages[-1].pop("context", None), messages=self._oai_system_message + messages
+                    # use our own memory module, not its original directly add all history messages again
+                    messages=self._oai_system_message + [messages[-1]]
+                )
+        self.usage_tracker.record(self.name, response, time.perf_counter() - start)
+        if streamer is not None:
+            reply = ChatMessage(content=response.choices[0].message.content)
+            if parser.done:
+                # the fields were parsed as the reply was streamed, carry them with it
+                reply.set_parsed(parser.fields)
+            return True, reply
 
         # TODO: line 301, line 271 is converting messages to dict. Can be removed after ChatCompletionMessage_to_dict is merged.
         extracted_response = client.extract_text_or_completion_object(response)[0]
@@ -718,6 +741,24 @@ class ConversableAgent(Agent):
         return True, extracted_response
         # return True, client.extract_text_or_function_call(response)[0]
 
+    def register_field_hook(self, hook: Callable[["ConversableAgent", str, Any], None]):
+        """Call `hook(agent, name, value)` as each top level field of a streamed reply of the agent is complete, e.g.
+        to act on its NEXT field before the rest of the reply is generated."""
+        self._field_hooks.append(hook)
+
+    def _forward_token(self, parser: StreamingJSONParser, text: str):
+        """Send a token of a streamed reply to the client, with the text it adds to the RESPONSE and the routing
+        fields it completes."""
+        emit_event("token", agent=self.name, text=text)
+        completed, deltas = parser.feed(text)
+        if deltas.get("RESPONSE"):
+            emit_event("response", agent=self.name, text=deltas["RESPONSE"])
+        for name, value in completed:
+            if name in ROUTING_FIELDS:
+                emit_event("field", agent=self.name, name=name, value=value)
+            for hook in self._field_hooks:
+                hook(self, name, value)
+
     async def a_generate_oai_reply(
         self,
         messages: Optional[List[Dict]] = None,
@@ -725,9 +766,7 @@ class ConversableAgent(Agent):
         config: Optional[Any] = None,
     ) -> Tuple[bool, Union[str, Dict, None]]:
         """Generate a reply using autogen.oai asynchronously."""
-        return await asyncio.get_event_loop().run_in_executor(
-            None, functools.partial(self.generate_oai_reply, messages=messages, sender=sender, config=config)
-        )
+        return await asyncio.to_thread(self.generate_oai_reply, messages=messages, sender=sender, config=config)
 
     def generate_code_execution_reply(
         self,
@@ -1040,16 +1079,17 @@ class ConversableAgent(Agent):
         if messages is None:
             messages = self._oai_messages[sender]
 
-        for reply_func_tuple in self._reply_func_list:
-            reply_func = reply_func_tuple["reply_func"]
-            if exclude and reply_func in exclude:
-                continue
-            if asyncio.coroutines.iscoroutinefunction(reply_func):
-                continue
-            if self._match_trigger(reply_func_tuple["trigger"], sender):
-                final, reply = reply_func(self, messages=messages, sender=sender, config=reply_func_tuple["config"])
-                if final:
-                    return reply
+        with span("generate_reply", agent=self.name):
+            for reply_func_tuple in self._reply_func_list:
+                reply_func = reply_func_tuple["reply_func"]
+                if exclude and reply_func in exclude:
+                    continue
+                if asyncio.coroutines.iscoroutinefunction(reply_func):
+                    continue
+                if self._match_trigger(reply_func_tuple["trigger"], sender):
+                    final, reply = reply_func(self, messages=messages, sender=sender, config=reply_func_tuple["config"])
+                    if final:
+                        return reply
         return self._default_auto_reply
 
     async def a_generate_reply(
@@ -1091,19 +1131,32 @@ class ConversableAgent(Agent):
         if messages is None:
             messages = self._oai_messages[sender]
 
-        for reply_func_tuple in self._reply_func_list:
-            reply_func = reply_func_tuple["reply_func"]
-            if exclude and reply_func in exclude:
-                continue
-            if self._match_trigger(reply_func_tuple["trigger"], sender):
-                if asyncio.coroutines.iscoroutinefunction(reply_func):
-                    final, reply = await reply_func(
-                        self, messages=messages, sender=sender, config=reply_func_tuple["config"]
-                    )
-                else:
-                    final, reply = reply_func(self, messages=messages, sender=sender, config=reply_func_tuple["config"])
-                if final:
-                    return reply
+        with span("generate_reply", agent=self.name):
+            # a sync reply function with an async version registered, e.g. run_chat and a_run_chat, is skipped here
+            async_names = {
+                reply_func_tuple["reply_func"].__name__
+                for reply_func_tuple in self._reply_func_list
+                if asyncio.coroutines.iscoroutinefunction(reply_func_tuple["reply_func"])
+            }
+            for reply_func_tuple in self._reply_func_list:
+                reply_func = reply_func_tuple["reply_func"]
+                if exclude and reply_func in exclude:
+                    continue
+                if not asyncio.coroutines.iscoroutinefunction(reply_func) and f"a_{reply_func.__name__}" in async_names:
+                    continue
+                if self._match_trigger(reply_func_tuple["trigger"], sender):
+                    if asyncio.coroutines.iscoroutinefunction(reply_func):
+                        final, reply = await reply_func(
+                            self, messages=messages, sender=sender, config=reply_func_tuple["config"]
+                        )
+                    else:
+                        # sync reply functions block on retrieval, kusto and llm calls, keep them off the event
+                        # loop. The thread inherits the context, e.g. the conversation the calls are accounted to
+                        final, reply = await asyncio.to_thread(
+                            reply_func, self, messages=messages, sender=sender, config=reply_func_tuple["config"]
+                        )
+                    if final:
+                        return reply
         return self._default_auto_reply
 
     def _match_trigger(self, trigger: Union[None, str, type, Agent, Callable, List], sender: Agent) -> bool:
@@ -0,0 +1,85 @@
+import copy
+from typing import Any, Dict, List, Optional
+
+
+class ConversationState:
+    """The per-conversation state of TSG Copilot.
+
+    Agents, LLM clients and the node db are shared through the agent pool, so the only things that belong to a
+    conversation are the group chat messages, memory and history summary, the last retrieved node, the chat round and
+    the llm message history of each agent with the chat manager, which the agents send to the llm with every call. A
+    state is restored into a checked-out agent set before a turn and captured back from it afterwards.
+    """
+
+    def __init__(
+        self,
+        messages: Optional[List[Dict]] = None,
+        memory: Optional[List[Dict]] = None,
+        previous_node: Optional[Dict] = None,
+        chat_round: int = 0,
+        history_summary: Optional[Dict] = None,
+        oai_messages: Optional[Dict[str, List[Dict]]] = None,
+    ):
+        self.messages = [] if messages is None else messages  # CustomGroupChat.messages
+        self.memory = [] if memory is None else memory  # CustomGroupChat.memory
+        self.previous_node = previous_node  # RetrieveAssistantAgent.previous_node
+        self.chat_round = chat_round  # GroupChatManager.chat_round
+        self.history_summary = {} if history_summary is None else history_summary  # CustomGroupChat.history_summary
+        # ConversableAgent._oai_messages by agent name: of each agent with the manager, of the manager with the user
+        self.oai_messages = {} if oai_messages is None else oai_messages
+
+    def restore(self, copilot_state: Any):
+        """Load this conversation into a freshly reset agent set."""
+        manager = copilot_state.manager
+        user_proxy = copilot_state.agents[0]
+        manager.groupchat.messages = list(self.messages)
+        manager.groupchat.memory = list(self.memory)
+        manager.groupchat.history_summary = dict(self.history_summary)
+        manager.chat_round = self.chat_round
+        copilot_state.agents[1].previous_node = self.previous_node
+        # the agent set may have served other conversations, make sure the manager replies to the user again
+        user_proxy._prepare_chat(manager, clear_history=True)
+        for agent, peer in self._histories(copilot_state):
+            agent._oai_messages[peer] = list(self.oai_messages.get(agent.name, []))
+
+    def capture(self, copilot_state: Any):
+        """Save the conversation from the agent set it ran on."""
+        manager = copilot_state.manager
+        self.messages = list(manager.groupchat.messages)
+        self.memory = list(manager.groupchat.memory)
+        self.history_summary = dict(manager.groupchat.history_summary)
+        self.chat_round = manager.chat_round
+        self.previous_node = copilot_state.agents[1].previous_node
+        self.oai_messages = {
+            agent.name: list(agent._oai_messages.get(peer, [])) for agent, peer in self._histories(copilot_state)
+        }
+
+    @staticmethod
+    def _histories(copilot_state: Any):
+        """The (agent, peer) pairs whose `_oai_messages` belong to the conversation."""
+        manager = copilot_state.manager
+        pairs = [(agent, manager) for agent in copilot_state.agents]
+        pairs.append((manager, copilot_state.agents[0]))
+        return pairs
+
+    def to_dict(self) -> Dict:
+        return {
+            "messages": self.messages,
+            "memory": self.memory,
+            "previous_node": self.previous_node,
+            "chat_round": self.chat_round,
+            "history_summary": self.history_summary,
+            "oai_messages": self.oai_messages,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ConversationState":
+        data = copy.deepcopy(data)
+        return cls(
+            messages=data.get("messages"),
+            memory=data.get("memory"),
+            previous_node=data.get("previous_node"),
+            chat_round=data.get("chat_round", 0),
+            history_summary=data.get("history_summary"),
+            oai_messages=data.get("oai_messages"),
+        )
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from tsg_copilot.conversation_state import ConversationState
+
+logger = logging.getLogger(__name__)
+
+
+class SessionBackend:
+    """Interface of the stores that keep `ConversationState` between requests.
+
+    A backend behaves like a dict keyed by conversation id. Values read from a backend may be copies, so callers
+    must write a state back with `backend[conversation_id] = state` after changing it.
+    """
+
+    def get(self, conversation_id: str, default=None) -> Optional[ConversationState]:
+        raise NotImplementedError
+
+    def __setitem__(self, conversation_id: str, state: ConversationState):
+        raise NotImplementedError
+
+    def __contains__(self, conversation_id: str) -> bool:
+        raise NotImplementedError
+
+    def pop(self, conversation_id: str, default=None) -> Optional[ConversationState]:
+        raise NotImplementedError
+
+    def __getitem__(self, conversation_id: str) -> ConversationState:
+        state = self.get(conversation_id)
+        if state is None:
+            raise KeyError(conversation_id)
+        return state
+
+    def __delitem__(self, conversation_id: str):
+        if self.pop(conversation_id) is None:
+            raise KeyError(conversation_id)
+
+    def metrics(self) -> Dict[str, int]:
+        return {}
+
+    def close(self):
+        pass
+
+
+class ConversationStore(SessionBackend):
+    """A bounded, thread-safe, in-process store of `ConversationState` keyed by conversation id.
+
+    Entries are kept in LRU order and evicted when the store holds more than `max_entries` conversations, when a
+    conversation has been idle for longer than `ttl` seconds, or when the estimated size of all conversations exceeds
+    `max_bytes`. If `spill_dir` is set, evicted conversations are written there as compressed json and rehydrated
+    transparently when the user comes back.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl: Optional[float] = 3600,
+        max_bytes: Optional[int] = 256 * 1024 * 1024,
+        spill_dir: Optional[str] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Args:
+            max_entries (int): the maximum number of conversations kept in memory.
+            ttl (float or None): seconds a conversation may stay idle in memory. None disables the idle eviction.
+            max_bytes (int or None): cap on the estimated serialized size of all conversations in memory.
+                None disables the size eviction.
+            spill_dir (str or None): directory to spill evicted conversations to. None drops evicted conversations.
+            clock (Callable): the time source, monotonic by default.
+        """
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        self._clock = clock
+        self._lock = threading.RLock()
+        # conversation_id -> (state, last access time, estimated size in bytes)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._metrics = {
+            "hits": 0,
+            "misses": 0,
+            "rehydrations": 0,
+            "spills": 0,
+            "evictions_lru": 0,
+            "evictions_ttl": 0,
+            "evictions_memory": 0,
+        }
+        if self._spill_dir is not None:
+            os.makedirs(self._spill_dir, exist_ok=True)
+
+    @staticmethod
+    def _estimate_size(state: ConversationState) -> int:
+        return len(json.dumps(state.to_dict(), default=str))
+
+    def _spill_path(self, conversation_id: str) -> str:
+        digest = hashlib.sha1(str(conversation_id).encode("utf-8")).hexdigest()
+        return os.path.join(self._spill_dir, f"{digest}.json.z")
+
+    def _spill(self, conversation_id: str, state: ConversationState):
+        if self._spill_dir is None:
+            return
+        try:
+            data = json.dumps(state.to_dict(), default=str).encode("utf-8")
+            path = self._spill_path(conversation_id)
+            with open(path + ".tmp", "wb") as f:
+                f.write(zlib.compress(data))
+            os.replace(path + ".tmp", path)
+            self._metrics["spills"] += 1
+        except OSError as e:
+            logger.warning(f"Failed to spill conversation {conversation_id}: {e}")
+
+    def _rehydrate(self, conversation_id: str) -> Optional[ConversationState]:
+        if self._spill_dir is None:
+            return None
+        path = self._spill_path(conversation_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+            os.remove(path)
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Failed to rehydrate conversation {conversation_id}: {e}")
+            return None
+        self._metrics["rehydrations"] += 1
+        return ConversationState.from_dict(data)
+
+    def _remove_spilled(self, conversation_id: str):
+        if self._spill_dir is None:
+            return
+        try:
+            os.remove(self._spill_path(conversation_id))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, conversation_id: str, reason: str):
+        state, _, size = self._entries.pop(conversation_id)
+        self._bytes -= size
+        self._metrics[f"evictions_{reason}"] += 1
+        self._spill(conversation_id, state)
+
+    def _evict_expired(self, now: float):
+        if self._ttl is None:
+            return
+        # entries are in access order, so the expired ones are at the front
+        while self._entries:
+            conversation_id, (_, last_access, _) = next(iter(self._entries.items()))
+            if now - last_access <= self._ttl:
+                break
+            self._evict(conversation_id, "ttl")
+
+    def _enforce_limits(self):
+        while len(self._entries) > self._max_entries:
+            self._evict(next(iter(self._entries)), "lru")
+        if self._max_bytes is not None:
+            # always keep the most recent conversation, even if it alone exceeds the cap
+            while self._bytes > self._max_bytes and len(self._entries) > 1:
+                self._evict(next(iter(self._entries)), "memory")
+
+    def get(self, conversation_id: str, default=None) -> Optional[ConversationState]:
+        with self._lock:
+            now = self._clock()
+            self._evict_expired(now)
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                self._metrics["hits"] += 1
+                state, _, size = entry
+                self._entries[conversation_id] = (state, now, size)
+                self._entries.move_to_end(conversation_id)
+                return state
+            state = self._rehydrate(conversation_id)
+            if state is None:
+                self._metrics["misses"] += 1
+                return default
+            self._put(conversation_id, state, now)
+            return state
+
+    def _put(self, conversation_id: str, state: ConversationState, now: float):
+        if conversation_id in self._entries:
+            self._bytes -= self._entries.pop(conversation_id)[2]
+        size = self._estimate_size(state)
+        self._entries[conversation_id] = (state, now, size)
+        self._bytes += size
+        self._enforce_limits()
+
+    def __setitem__(self, conversation_id: str, state: ConversationState):
+        with self._lock:
+            now = self._clock()
+            self._evict_expired(now)
+            self._remove_spilled(conversation_id)
+            self._put(conversation_id, state, now)
+
+    def __contains__(self, conversation_id: str) -> bool:
+        with self._lock:
+            if conversation_id in self._entries:
+                return True
+            return self._spill_dir is not None and os.path.exists(self._spill_path(conversation_id))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def pop(self, conversation_id: str, default=None) -> Optional[ConversationState]:
+        with self._lock:
+            self._remove_spilled(conversation_id)
+            entry = self._entries.pop(conversation_id, None)
+            if entry is None:
+                return default
+            self._bytes -= entry[2]
+            return entry[0]
+
+    def evict_expired(self):
+        """Evict idle conversations now, instead of waiting for the next access."""
+        with self._lock:
+            self._evict_expired(self._clock())
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["entries"] = len(self._entries)
+            metrics["bytes"] = self._bytes
+            return metrics
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize a text before hashing it, so that trivially different spellings share one embedding."""
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+
+class CachedEmbeddingFunction:
+    """A chromadb compatible embedding function that caches the embeddings of another one.
+
+    Embeddings are content addressed by the model name and the normalized text. Lookups go to an in-memory LRU first,
+    then to an optional SQLite file storing float32 vectors, and only the remaining texts are sent to the wrapped
+    embedding function, in a single call.
+    """
+
+    def __init__(
+        self,
+        embedding_function: Callable,
+        model_name: str,
+        cache_path: Optional[str] = None,
+        max_items: int = 10000,
+    ):
+        """
+        Args:
+            embedding_function (Callable): the embedding function to cache, e.g. `OpenAIEmbeddingFunction`.
+            model_name (str): the name of the embedding model, part of the cache key.
+            cache_path (Optional, str): the path to the SQLite file of the persistent tier. Default is None, which only
+                uses the in-memory tier.
+            max_items (Optional, int): the maximum number of embeddings in the in-memory tier. Default is 10000.
+        """
+        self.embedding_function = embedding_function
+        self._model_name = model_name
+        self._cache_path = cache_path
+        self._max_items = max_items
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "embedding_calls": 0}
+        if self._cache_path is not None:
+            if os.path.dirname(self._cache_path):
+                os.makedirs(os.path.dirname(self._cache_path), exist_ok=True)
+            with self._connection() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._cache_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self._model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, embedding: List[float]):
+        # callers hold self._lock
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_items:
+            self._memory.popitem(last=False)
+
+    def _load(self, keys: List[str]) -> Dict[str, List[float]]:
+        if self._cache_path is None or not keys:
+            return {}
+        found = {}
+        conn = self._connection()
+        # stay below the default limit of sqlite host parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+        return found
+
+    def _save(self, items: Dict[str, List[float]]):
+        if self._cache_path is None or not items:
+            return
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", embedding).tobytes()) for key, embedding in items.items()],
+            )
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        texts = [input] if isinstance(input, str) else list(input)
+        keys = [self._key(text) for text in texts]
+        results: Dict[str, List[float]] = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    results[key] = self._memory[key]
+            self._stats["memory_hits"] += sum(1 for key in keys if key in results)
+
+        missing = [key for key in dict.fromkeys(keys) if key not in results]
+        from_disk = self._load(missing)
+        results.update(from_disk)
+
+        to_embed = {}
+        for text, key in zip(texts, keys):
+            if key not in results and key not in to_embed:
+                to_embed[key] = text
+        if to_embed:
+            embeddings = self.embedding_function(list(to_embed.values()))
+            computed = {key: list(map(float, embedding)) for key, embedding in zip(to_embed.keys(), embeddings)}
+            self._save(computed)
+            results.update(computed)
+
+        with self._lock:
+            self._stats["disk_hits"] += len(from_disk)
+            self._stats["misses"] += len(to_embed)
+            self._stats["embedding_calls"] += 1 if to_embed else 0
+            for key in from_disk:
+                self._remember(key, from_disk[key])
+            for key in to_embed:
+                self._remember(key, results[key])
+        return [results[key] for key in keys]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_items"] = len(self._memory)
+            return stats
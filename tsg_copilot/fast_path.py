@@ -0,0 +1,241 @@
+import json
+import math
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from tsg_copilot.bm25 import tokenize
+
+# the labels of the fast path, LLM is a message the intent agent has to read with the chat history
+TERMINATE, MITIGATE, NOT_RELATED, LLM = "TERMINATE", "MITIGATE", "NOT_RELATED", "LLM"
+LABELS = (TERMINATE, MITIGATE, NOT_RELATED, LLM)
+
+# the replies of the intent agent for the labels decided locally, in the json format of its prompt. TERMINATE has no
+# reply, the message ends the conversation like "exit" does, see `FastPath.terminates`
+REPLIES = {
+    MITIGATE: {
+        "DECISION": "MITIGATED",
+        "NEXT": "user_proxy",
+        "TOKEN": "[MITIGATE]",
+        "RESPONSE": "Glad to hear that the incident is mitigated. If it happens again, or if it needs more help, "
+        "please get in touch with the oncall engineers.",
+    },
+    NOT_RELATED: {
+        "DECISION": "NOT_RELATED",
+        "NEXT": "user_proxy",
+        "RESPONSE": "I am TSG Copilot, I help to troubleshoot incidents with the troubleshooting guides (TSGs). "
+        "Please describe the incident you are troubleshooting, or give its IncidentId.",
+    },
+}
+
+# whole messages, after `normalize`, that leave no doubt
+DEFAULT_RULES = [
+    (TERMINATE, re.compile(
+        r"(exit|quit|bye|bye bye|goodbye|good bye|terminate|"
+        r"(please )?(end|stop|close|quit|exit) (the|this) (chat|conversation|session)( please)?|"
+        r"(that's all|that is all|i'm done|i am done|nothing else)(,? (thanks|thank you))?,? bye)"
+    )),
+    (MITIGATE, re.compile(
+        r"((it's|it is|it has been|the incident is|the incident has been|incident|the issue is|the issue has been|"
+        r"issue|the problem is|the problem has been|problem) )?(now )?(mitigated|resolved|fixed)( now)?"
+        r"(,? (thanks|thank you))?"
+    )),
+    (NOT_RELATED, re.compile(
+        r"(hi|hello|hey|hi there|hello there|good (morning|afternoon|evening)|thanks|thank you|thank you very much|"
+        r"thx|how are you|who are you|what is your name|what's your name|what can you do|nice to meet you)"
+    )),
+]
+
+# a mitigation is never read from a negated message or a question, e.g. "it isn't mitigated yet" or "is it fixed?"
+_NEGATIONS = {"not", "no", "never", "still", "yet", "isn", "didn", "doesn", "wasn", "hasn", "haven", "aren", "weren",
+              "don", "cannot", "won", "nor", "without"}
+
+# the training set of the default model: chit-chat, the ends of conversations, and messages only the intent agent can
+# read, such as the results of a step of the plan or a new incident
+SEED_EXAMPLES = [
+    (TERMINATE, "exit"), (TERMINATE, "quit"), (TERMINATE, "bye"), (TERMINATE, "goodbye"), (TERMINATE, "bye bye"),
+    (TERMINATE, "see you"), (TERMINATE, "see you later"), (TERMINATE, "end the conversation"),
+    (TERMINATE, "end this chat please"), (TERMINATE, "stop the conversation"), (TERMINATE, "close the session"),
+    (TERMINATE, "that's all, bye"), (TERMINATE, "i'm done, bye"), (TERMINATE, "no more questions, bye"),
+    (TERMINATE, "nothing else, thanks, bye"), (TERMINATE, "we can stop here"), (TERMINATE, "let's end here"),
+    (TERMINATE, "exit the chat"), (TERMINATE, "quit please"), (TERMINATE, "terminate the session"),
+    (MITIGATE, "it's mitigated"), (MITIGATE, "mitigated"), (MITIGATE, "the incident is mitigated"),
+    (MITIGATE, "incident mitigated"), (MITIGATE, "issue resolved"), (MITIGATE, "the issue is resolved"),
+    (MITIGATE, "it is fixed now"), (MITIGATE, "fixed"), (MITIGATE, "problem solved"),
+    (MITIGATE, "the incident has been mitigated"), (MITIGATE, "resolved now"), (MITIGATE, "it works now"),
+    (MITIGATE, "everything is back to normal"), (MITIGATE, "the alert is resolved"), (MITIGATE, "the alert cleared"),
+    (MITIGATE, "the service recovered"), (MITIGATE, "the cluster recovered"), (MITIGATE, "mitigated, thanks"),
+    (MITIGATE, "all good now, it's fixed"), (MITIGATE, "the incident auto mitigated"),
+    (MITIGATE, "the oncall mitigated it"), (MITIGATE, "we mitigated the incident"), (MITIGATE, "the problem is gone"),
+    (NOT_RELATED, "hi"), (NOT_RELATED, "hello"), (NOT_RELATED, "hey"), (NOT_RELATED, "hello there"),
+    (NOT_RELATED, "good morning"), (NOT_RELATED, "thanks"), (NOT_RELATED, "thank you"),
+    (NOT_RELATED, "thank you very much"), (NOT_RELATED, "how are you"), (NOT_RELATED, "who are you"),
+    (NOT_RELATED, "what can you do"), (NOT_RELATED, "what is your name"), (NOT_RELATED, "tell me a joke"),
+    (NOT_RELATED, "what's the weather today"), (NOT_RELATED, "nice to meet you"), (NOT_RELATED, "how old are you"),
+    (NOT_RELATED, "write me a poem"), (NOT_RELATED, "what time is it"), (NOT_RELATED, "who won the game yesterday"),
+    (NOT_RELATED, "recommend a movie"),
+    (LLM, "what should i do next"), (LLM, "next"), (LLM, "ok"), (LLM, "yes"), (LLM, "no"), (LLM, "done"),
+    (LLM, "done, the result shows x > 0"), (LLM, "the query returns no rows"), (LLM, "the result is empty"),
+    (LLM, "the cluster is healthy"), (LLM, "the count is 0"), (LLM, "IncidentId 12345"),
+    (LLM, "incident 4521 fired on my cluster"), (LLM, "the node is unhealthy"),
+    (LLM, "how to troubleshoot a failover cluster"), (LLM, "failover cluster failed"),
+    (LLM, "high cpu on the storage node"), (LLM, "the kusto query returns 3 rows"), (LLM, "the container name is abc"),
+    (LLM, "the cluster name is xyz"), (LLM, "it is not mitigated yet"), (LLM, "the issue is not resolved"),
+    (LLM, "still failing"), (LLM, "the plan doesn't work"), (LLM, "what does this alert mean"),
+    (LLM, "i restarted the service but it still fails"), (LLM, "the disk usage is above 90%"),
+    (LLM, "the monitor fired again"), (LLM, "not fixed"), (LLM, "the error persists"), (LLM, "is it mitigated?"),
+    (LLM, "the result is true"), (LLM, "the result is false"), (LLM, "the output shows errors"),
+    (LLM, "the latency is high"), (LLM, "please refine the plan"), (LLM, "i ran the query"),
+    (LLM, "the check passed"), (LLM, "the check failed"),
+]
+
+
+def normalize(text: str) -> str:
+    """Lowercase the message, unify its apostrophes and spaces and drop the punctuation around it."""
+    text = text.lower().replace("’", "'")
+    return re.sub(r"\s+", " ", text).strip(" .!~\t\n")
+
+
+def load_examples(path: str) -> List[Tuple[str, str]]:
+    """Read labeled messages from a JSONL file of {"text": ..., "label": ...} lines, e.g. written by
+    `python -m benchmarks.fast_path --dump-examples`."""
+    examples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            example = json.loads(line)
+            if example["label"] not in LABELS:
+                raise ValueError(f"Unknown label: {example['label']}. Possible values are {', '.join(LABELS)}.")
+            examples.append((example["label"], example["text"]))
+    return examples
+
+
+def features(text: str) -> List[str]:
+    """The word unigrams and bigrams of a message."""
+    tokens = tokenize(normalize(text))
+    return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+
+class NaiveBayesIntent:
+    """A multinomial naive Bayes model of the labels over word unigrams and bigrams, small enough to train on the fly
+    and to predict in microseconds on the CPU. The priors are uniform, the labels are not balanced in any training
+    set."""
+
+    def __init__(self, examples: Iterable[Tuple[str, str]], alpha: float = 0.5):
+        """
+        Args:
+            examples (iterable): the (label, text) training examples.
+            alpha (float): the additive smoothing of the feature counts.
+        """
+        self.alpha = alpha
+        self._counts: Dict[str, Counter] = {label: Counter() for label in LABELS}
+        for label, text in examples:
+            self._counts[label].update(features(text))
+        self._totals = {label: sum(counts.values()) for label, counts in self._counts.items()}
+        self.vocabulary = set().union(*self._counts.values())
+
+    def predict(self, text: str) -> Tuple[str, float, float]:
+        """Return the most probable label of `text`, its probability, and the share of the features of `text` seen in
+        training, below which the probability says little."""
+        feats = features(text)
+        if not feats:
+            return LLM, 0.0, 0.0
+        size = len(self.vocabulary)
+        logs = {}
+        for label, counts in self._counts.items():
+            denominator = math.log(self._totals[label] + self.alpha * size)
+            logs[label] = sum(math.log(counts[feat] + self.alpha) - denominator for feat in feats)
+        top = max(logs.values())
+        norm = sum(math.exp(value - top) for value in logs.values())
+        label = max(logs, key=logs.get)
+        known = sum(feat in self.vocabulary for feat in feats) / len(feats)
+        return label, 1.0 / norm, known
+
+
+class FastPath:
+    """Answer the obvious messages of the user without the intent llm call: the end of the conversation, a mitigated
+    incident, and chit-chat unrelated to incidents.
+
+    A message is matched against whole-message rules first, then a `NaiveBayesIntent` model decides if it is confident,
+    the message is short and most of its words were seen in training. Anything else, e.g. the results of a step of
+    the plan, goes to the intent agent. Only the rules decide when the caller asks for `rules_only`, e.g. for messages
+    the model should not read without the chat history. Decisions are counted by how they were made, "rule", "model"
+    or "llm", and by label.
+    """
+
+    def __init__(
+        self,
+        min_confidence: float = 0.9,
+        max_tokens: int = 8,
+        min_known: float = 0.5,
+        model: Optional[NaiveBayesIntent] = None,
+        rules: Optional[List[Tuple[str, re.Pattern]]] = None,
+    ):
+        """
+        Args:
+            min_confidence (float): the minimum probability of the model's label to decide locally.
+            max_tokens (int): longer messages are left to the intent agent unless a rule matches.
+            min_known (float): the minimum share of the features of the message seen by the model.
+            model (NaiveBayesIntent or None): the model, trained on `SEED_EXAMPLES` if None.
+            rules (list or None): (label, pattern) pairs fully matched against the normalized message, `DEFAULT_RULES`
+                if None.
+        """
+        self.min_confidence = min_confidence
+        self.max_tokens = max_tokens
+        self.min_known = min_known
+        self.model = NaiveBayesIntent(SEED_EXAMPLES) if model is None else model
+        self._rules = DEFAULT_RULES if rules is None else rules
+        self._lock = threading.Lock()
+        self._counts = {"rule": 0, "model": 0, "llm": 0, **{label: 0 for label in LABELS if label != LLM}}
+
+    def label(self, text: str, rules_only: bool = False) -> Tuple[str, float, str]:
+        """Return the label of a message of the user, its confidence and how it was decided, "rule", "model" or "llm".
+        The label is LLM when the message is left to the intent agent."""
+        message = normalize(text)
+        for label, pattern in self._rules:
+            if pattern.fullmatch(message):
+                return label, 1.0, "rule"
+        if rules_only:
+            return LLM, 0.0, "llm"
+        tokens = tokenize(message)
+        if not tokens or len(tokens) > self.max_tokens:
+            return LLM, 0.0, "llm"
+        label, confidence, known = self.model.predict(message)
+        if label == LLM or confidence < self.min_confidence or known < self.min_known:
+            return LLM, confidence, "llm"
+        if label == MITIGATE and (message.endswith("?") or _NEGATIONS.intersection(tokens)):
+            return LLM, confidence, "llm"
+        return label, confidence, "model"
+
+    def terminates(self, text: str) -> bool:
+        """Whether a message of the user ends the conversation, e.g. "bye". Only the rules decide, a wrong guess
+        would delete the conversation. Messages that do not are left uncounted, `classify` counts them."""
+        label, _, how = self.label(text, rules_only=True)
+        if label != TERMINATE:
+            return False
+        with self._lock:
+            self._counts[how] += 1
+            self._counts[label] += 1
+        return True
+
+    def classify(self, text: str, rules_only: bool = False) -> Optional[Dict[str, str]]:
+        """Return the reply of the intent agent to a message of the user if the fast path decides it, else None."""
+        label, _, how = self.label(text, rules_only)
+        if label not in REPLIES:
+            # an end of the conversation the rules did not match is left to the llm too
+            label, how = LLM, "llm"
+        with self._lock:
+            self._counts[how] += 1
+            if label in REPLIES:
+                self._counts[label] += 1
+        return dict(REPLIES[label]) if label in REPLIES else None
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self._counts["rule"] + self._counts["model"] + self._counts["llm"]
+            return {
+                **self._counts,
+                "coverage": (self._counts["rule"] + self._counts["model"]) / total if total else 0.0,
+            }
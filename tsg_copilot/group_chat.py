@@ -1,9 +1,12 @@
 from autogen.agentchat.groupchat import GroupChat
+import asyncio
 import random
-import json
+from tsg_copilot.speaker_router import SpeakerRouter
+from tsg_copilot.chat_history import ChatHistoryManager
+from tsg_copilot.message_json import parse_message
 
 class CustomGroupChat(GroupChat):
-    def __init__(self, agents, messages, max_round=10, graph=None, l_user=[], l_exclude_assistant=[], l_oneway_assistant = []):
+    def __init__(self, agents, messages, max_round=10, graph=None, l_user=[], l_exclude_assistant=[], l_oneway_assistant = [], router=None, history_manager=None):
         super().__init__(agents, messages, max_round)
         self.previous_speaker = None  # Keep track of the previous speaker
         self.graph = graph  # The graph depicting who are the next speakers available
@@ -14,6 +17,11 @@ class CustomGroupChat(GroupChat):
         self.l_user = l_user # The list of users in the group chat
         self.l_exclude_assistant = l_exclude_assistant # The list of assistants that should be excluded from update memory and chat history
         self.l_oneway_assistant = l_oneway_assistant # The list of oneway assistants that should be excluded from update memory and chat history, such as message passing towards planner
+        # The routing table resolving the next speaker without the LLM, compile it once and share it across group chats
+        self.router = router if router is not None else SpeakerRouter(graph, agent_names=[agent.name for agent in agents])
+        # Builds the chat history of the prompts within a token budget, it can be shared across group chats
+        self.history_manager = history_manager if history_manager is not None else ChatHistoryManager()
+        self.history_summary = self.history_manager.new_state()  # The rolling summary of older chats in the memory
 
     def update_memory(self, last_message):
         # Update the memory with the last message
@@ -33,7 +41,7 @@ class CustomGroupChat(GroupChat):
             for oneway_assistant in self.l_oneway_assistant:    # ["planner_agent"]
                 if oneway_assistant in content:
                     # condider to incorporate Node information into Chat_History
-                    content=json.loads(content)
+                    content=parse_message(last_message, strict=True)
                     if "RESPONSE" in content:
                         self.memory.append({"chat": f'Node Retrieval: {content["RESPONSE"]}', "info": info})
                         return 
@@ -43,7 +51,7 @@ class CustomGroupChat(GroupChat):
                     else:
                         return
             # extract the assistant's response after <RESPONSE> in the content string
-            content=json.loads(content)
+            content=parse_message(last_message, strict=True)
             response=content['RESPONSE']
             chat=f'TSG Copilot: {response}'
         else:
@@ -51,70 +59,52 @@ class CustomGroupChat(GroupChat):
 
         self.memory.append({"chat": chat, "info": info})
 
+    def chat_history(self):
+        # The recent chats verbatim, the latest retrieved node and a summary of the older chats
+        return self.history_manager.render(self.memory, self.history_summary)
+
     def select_speaker(self, last_speaker, selector):       
         self.previous_speaker = last_speaker
 
-        # Check if last message suggests a next speaker or termination
+        # Check if last message suggests termination
         last_message = self.messages[-1] if self.messages else None
-        suggested_next = None
         
         if last_message:
             self.update_memory(last_message)
-            if 'NEXT' in last_message['content']:
-                # convert to json
-                last_message = json.loads(last_message['content'])                
-                suggested_next = last_message['NEXT']
-                    
-            elif 'TERMINATE' in last_message['content']:
+            if 'NEXT' not in last_message['content'] and 'TERMINATE' in last_message['content']:
                 try:
                     return self.agent_by_name('User_proxy')
                 except ValueError:
-                    print(f"agent_by_name failed suggested_next: {suggested_next}")
+                    print("agent_by_name failed on TERMINATE")
                 
         # Debugging print for the current previous speaker
         if self.previous_speaker is not None:
             print('Current previous speaker:', self.previous_speaker.name)
 
-        # Selecting first round speaker
-        if self.previous_speaker is None and self.graph is not None:
-            eligible_speakers = [agent for agent in self.agents if self.graph.nodes[agent.name].get('first_round_speaker', False)]
-
-        # Selecting successors of the previous speaker
-        elif self.previous_speaker is not None and self.graph is not None:
-            eligible_speaker_names = [target for target in self.graph.successors(self.previous_speaker.name)]
-            eligible_speakers = [agent for agent in self.agents if agent.name in eligible_speaker_names]
-            # print('Eligible speakers based on previous speaker:', eligible_speaker_names)
-
-        else:
-            eligible_speakers = self.agents
-
-        # Debugging print for the next potential speakers
-        # print(f"Eligible speakers based on graph and previous speaker {self.previous_speaker.name if self.previous_speaker else 'None'}: {[speaker.name for speaker in eligible_speakers]}")
+        # Eligible speakers are the first round speakers or the successors of the previous speaker in the graph
+        eligible_speaker_names = self.router.candidates(self.previous_speaker.name if self.previous_speaker else None)
+        eligible_speakers = [agent for agent in self.agents if agent.name in eligible_speaker_names]
 
         # Three attempts at getting the next_speaker
-        # 1. Using suggested_next if suggested_next is in the eligible_speakers.name
+        # 1. Using the routing rules: the NEXT field, the retriever payload, or a single eligible speaker
         # 2. Using LLM to pick from eligible_speakers, given that there is some context in self.message
         # 3. Random (catch-all)
         next_speaker = None
         
         if eligible_speakers:
-            # print("Selecting from eligible speakers:", [speaker.name for speaker in eligible_speakers])
-            # 1. Using suggested_next if suggested_next is in the eligible_speakers.name
-            if suggested_next in [speaker.name for speaker in eligible_speakers]:
-                # print("suggested_next is in eligible_speakers")
-                next_speaker = self.agent_by_name(suggested_next)
+            name = self.router.route(self.previous_speaker.name if self.previous_speaker else None, last_message)
+            if name is not None:
+                next_speaker = self.agent_by_name(name)
                 
             else:
-                msgs_len = len(self.messages)
-                # print(f"msgs_len is now {msgs_len}")
                 if len(self.messages) > 1:
                     # 2. Using LLM to pick from eligible_speakers, given that there is some context in self.message
-                    # print(f"Using LLM to pick from eligible_speakers: {[speaker.name for speaker in eligible_speakers]}")
                     selector.update_system_message(self.select_speaker_msg(eligible_speakers))
                     _, name = selector.generate_oai_reply(self.messages + [{
                         "role": "system",
                         "content": f"Read the above conversation. Then select the next role from {[agent.name for agent in eligible_speakers]} to play. Only return the role.",
                     }])
+                    self.router.count("llm")
 
                     # If exactly one agent is mentioned, use it. Otherwise, leave the OAI response unmodified
                     mentions = self._mentioned_agents(name, eligible_speakers)
@@ -125,11 +115,16 @@ class CustomGroupChat(GroupChat):
                 if next_speaker is None:
                     # 3. Random (catch-all)
                     next_speaker = random.choice(eligible_speakers)
-                    
+                    if len(self.messages) <= 1:
+                        self.router.count("random")
                 
             print(f"Selected next speaker: {next_speaker.name}")
 
             return next_speaker
         else:
             # Cannot return next_speaker with no eligible speakers
-            raise ValueError("No eligible speakers found based on the graph constraints.")
\ No newline at end of file
+            raise ValueError("No eligible speakers found based on the graph constraints.")
+
+    async def a_select_speaker(self, last_speaker, selector):
+        # the selection may ask the llm, run it in the default executor to keep the event loop free
+        return await asyncio.to_thread(self.select_speaker, last_speaker, selector)
@@ -9,6 +9,10 @@ from autogen.code_utils import content_str
 from autogen import Agent
 from tsg_copilot.conversable_agent import ConversableAgent
 from tsg_copilot.group_chat import CustomGroupChat
+from tsg_copilot.message_json import parse_message
+from tsg_copilot.request_context import round_scope
+from tsg_copilot.streaming import emit_event
+from tsg_copilot.tracing import span
 from tsg_copilot.utils import DeleteConversationError, MitigateConversationError
 
 logger = logging.getLogger(__name__)
@@ -52,6 +56,10 @@ class GroupChatManager(ConversableAgent):
         memory=self.groupchat.memory
         return memory
 
+    def get_chat_history(self) -> str:
+        """Return the chat history of the group chat, bounded by the token budget of its history manager."""
+        return self.groupchat.chat_history()
+
     def run_chat(
         self,
         messages: Optional[List[Dict]] = None,
@@ -79,8 +87,7 @@ class GroupChatManager(ConversableAgent):
 
             # add to check if intent return with [MITIGATE] special token
             if speaker.name == "intent_understanding_agent":
-                import json
-                temp_intent = json.loads(message["content"])
+                temp_intent = parse_message(message, strict=True)
                 try:
                     special_token = temp_intent["TOKEN"]
                     if special_token == "[MITIGATE]" or "MITIGATE" in special_token:
@@ -94,11 +101,14 @@ class GroupChatManager(ConversableAgent):
                 # the last round
                 break
             try:
-                # select the next speaker
-                speaker = groupchat.select_speaker(speaker, self)
-                self.send(message, speaker, request_reply=False, silent=True)
-                # let the speaker speak
-                reply = speaker.generate_reply(sender=self)
+                with round_scope(self.chat_round + i):
+                    # select the next speaker
+                    with span("select_speaker"):
+                        speaker = groupchat.select_speaker(speaker, self)
+                    emit_event("speaker", agent=speaker.name, round=self.chat_round + i)
+                    self.send(message, speaker, request_reply=False, silent=True)
+                    # let the speaker speak
+                    reply = speaker.generate_reply(sender=self)
             except KeyboardInterrupt:
                 # let the admin agent speak if interrupted
                 if groupchat.admin_name in groupchat.agent_names:
@@ -122,13 +132,14 @@ class GroupChatManager(ConversableAgent):
         sender: Optional[Agent] = None,
         config: Optional[CustomGroupChat] = None,
     ):
-        """Run a group chat asynchronously."""
+        """Run a group chat asynchronously. It follows `run_chat`, including the conversation errors it raises."""
         if messages is None:
             messages = self._oai_messages[sender]
         message = messages[-1]
         speaker = sender
         groupchat = config
-        for i in range(groupchat.max_round):
+        group_max_round = groupchat.max_round-self.chat_round
+        for i in range(group_max_round):
             # set the name to speaker's name if the role is not function
             if message["role"] != "function":
                 message["name"] = speaker.name
@@ -137,17 +148,31 @@ class GroupChatManager(ConversableAgent):
 
             if self._is_termination_msg(message):
                 # The conversation is over
-                break
-            
-            if i == groupchat.max_round - 1:
+                raise DeleteConversationError()
+
+            # add to check if intent return with [MITIGATE] special token
+            if speaker.name == "intent_understanding_agent":
+                temp_intent = parse_message(message, strict=True)
+                try:
+                    special_token = temp_intent["TOKEN"]
+                    if special_token == "[MITIGATE]" or "MITIGATE" in special_token:
+                        raise MitigateConversationError()
+                except MitigateConversationError:
+                    raise MitigateConversationError()
+                except:
+                    pass
+            if i == group_max_round - 1:
                 # the last round
-                break
+                raise DeleteConversationError()
             try:
-                # select the next speaker
-                speaker = await groupchat.a_select_speaker(speaker, self)
-                # let the speaker speak
-                self.send(message, speaker, request_reply=False, silent=True)
-                reply = await speaker.a_generate_reply(sender=self)
+                with round_scope(self.chat_round + i):
+                    # select the next speaker
+                    with span("select_speaker"):
+                        speaker = await groupchat.a_select_speaker(speaker, self)
+                    emit_event("speaker", agent=speaker.name, round=self.chat_round + i)
+                    # let the speaker speak
+                    self.send(message, speaker, request_reply=False, silent=True)
+                    reply = await speaker.a_generate_reply(sender=self)
             except KeyboardInterrupt:
                 # let the admin agent speak if interrupted
                 if groupchat.admin_name in groupchat.agent_names:
@@ -1,8 +1,12 @@
-from typing import Callable, Dict, Literal, Optional, Union
+import json
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Union
 
 from .conversable_agent import ConversableAgent
+from .fast_path import FastPath
+from .message_json import ROUTING_FIELDS, ChatMessage, parse_message
+from .streaming import emit_event
+from .tracing import span
 from autogen import Agent
-import json
 
 DEFAULT_SYSTEM_MESSAGE = """You are a helpful troubleshooting guide Copilot, i.e., TSG Copilot, that helps the user to troubleshoot the user's query in <USER_QUERY>, with chat history between TSG Copilot and user in <CHAT_HISTORY> and <INFO> retrieved from the knowledge base that helps to make plan for <USER_QUERY>.
 
@@ -123,6 +127,8 @@ class IntentUnderstandingAgent(ConversableAgent):
         human_input_mode: Optional[str] = "NEVER",
         code_execution_config: Optional[Union[Dict, Literal[False]]] = False,
         description: Optional[str] = None,
+        retriever: Optional[Agent] = None,
+        fast_path: Optional[FastPath] = None,
         **kwargs,
     ):
         """
@@ -139,6 +145,10 @@ class IntentUnderstandingAgent(ConversableAgent):
             max_consecutive_auto_reply (int): the maximum number of consecutive auto replies.
                 default to None (no limit provided, class attribute MAX_CONSECUTIVE_AUTO_REPLY will be used as the limit in this case).
                 The limit only plays a role when human_input_mode is not "ALWAYS".
+            retriever (RetrieveAssistantAgent): the node retrieve agent, asked to `speculate` on the user's message
+                while the agent decides what to retrieve. Default is None, no speculation.
+            fast_path (FastPath): answers the obvious messages of the user, e.g. "bye" or "it's mitigated", without
+                the llm call. Default is None, every message goes to the llm.
             **kwargs (dict): Please refer to other kwargs in
                 [ConversableAgent](conversable_agent#__init__).
         """
@@ -160,6 +170,48 @@ class IntentUnderstandingAgent(ConversableAgent):
             if system_message == DEFAULT_SYSTEM_MESSAGE:
                 self.description = DEFAULT_DESCRIPTION
 
+        self._retriever = retriever
+        self._streamed_next = None  # the NEXT of the reply being streamed
+        if retriever is not None:
+            self.register_field_hook(IntentUnderstandingAgent._speculate_on_field)
+        self._fast_path = fast_path
+        self._fast_path_reply = None  # the reply decided by the fast path for the message received
+        if fast_path is not None:
+            # checked before the llm reply
+            self.register_reply([Agent, None], IntentUnderstandingAgent.generate_fast_path_reply)
+            self.register_reply([Agent, None], IntentUnderstandingAgent.a_generate_fast_path_reply)
+
+    def generate_fast_path_reply(
+        self,
+        messages: Optional[List[Dict]] = None,
+        sender: Optional[Agent] = None,
+        config: Optional[Any] = None,
+    ) -> Tuple[bool, Optional[Dict]]:
+        """Reply with the decision of the fast path, if it decided the message received."""
+        reply, self._fast_path_reply = self._fast_path_reply, None
+        if reply is None:
+            return False, None
+        # a streamed client sees the routing of the decision as if the llm had generated it
+        for name, value in reply.parsed.items():
+            if name in ROUTING_FIELDS:
+                emit_event("field", agent=self.name, name=name, value=value)
+        return True, reply
+
+    async def a_generate_fast_path_reply(
+        self,
+        messages: Optional[List[Dict]] = None,
+        sender: Optional[Agent] = None,
+        config: Optional[Any] = None,
+    ) -> Tuple[bool, Optional[Dict]]:
+        return self.generate_fast_path_reply(messages=messages, sender=sender, config=config)
+
+    def _speculate_on_field(self, name, value):
+        # a streamed decision routed to the retriever is searched as soon as its QUERY is generated
+        if name == "NEXT":
+            self._streamed_next = value
+        elif name == "QUERY" and self._streamed_next == self._retriever.name and isinstance(value, str):
+            self._retriever.speculate(value)
+
     def _process_received_message(self, message: Union[Dict, str], sender: Agent, silent: bool):
         message = self._message_to_dict(message)
 
@@ -172,7 +224,7 @@ class IntentUnderstandingAgent(ConversableAgent):
         no_info = ""
 
         try:
-            update_content=json.loads(update_content)
+            update_content=parse_message(message, strict=True)
             query = update_content.get('query', '')
             info = update_content.get('info', '')
             no_info = update_content.get('no_info', '')
@@ -180,13 +232,28 @@ class IntentUnderstandingAgent(ConversableAgent):
             print('intent agent: failed in converting to json')
             query=update_content
 
+        self._streamed_next = None
+        self._fast_path_reply = None
+
         # get chat history from chat manager
         if sender.name == 'chat_manager':
             memory = sender.get_memory()
-            if memory:
-                chat_history = '\n'.join(conversation['chat'] for conversation in memory)
-            else:
-                chat_history = ''
+            chat_history = sender.get_chat_history()
+
+        if self._fast_path is not None and info == "" and no_info == "" and isinstance(query, str):
+            with span("fast_path", agent=self.name):
+                # the model reads the message without the chat history, so after the first message only the rules
+                # decide, e.g. the results of a step of the plan never end the conversation on a guess
+                decision = self._fast_path.classify(query, rules_only=len(memory) != 1)
+            if decision is not None:
+                # the llm is not asked, the message still goes to the history below as the llm would have read it
+                reply = ChatMessage(content=json.dumps(decision))
+                reply.set_parsed(decision)
+                self._fast_path_reply = reply
+
+        if self._retriever is not None and info == "" and no_info == "" and self._fast_path_reply is None:
+            # the user's message, a NEW_QUERY decision searches it as is
+            self._retriever.speculate(query)
 
         if info == "" and no_info == "" and len(memory) == 1:  # initial call
             self._oai_system_message = [{"content": DEFAULT_SYSTEM_MESSAGE + NEW_QUERY_MESSAGE, "role": "system"}]
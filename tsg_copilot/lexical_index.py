@@ -0,0 +1,146 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from tsg_copilot.bm25 import node_text, tokenize
+from tsg_copilot.node_store import kv_map_signature
+
+LEXICAL_FIELDS = ("#title#", "#intent#", "#action#")
+_FORMAT_VERSION = 1
+
+# lexical indexes loaded by this process, by path
+_index_cache: Dict[str, "LexicalIndex"] = {}
+_index_lock = threading.Lock()
+
+
+def default_lexical_index_path(kv_map_path: str) -> str:
+    """The lexical index lives next to the node db, in the directory of the kv map."""
+    return os.path.join(os.path.dirname(kv_map_path), "nodedb_bm25.json")
+
+
+class LexicalIndex:
+    """An inverted BM25 index over the #title#, #intent# and #action# of the tsg nodes.
+
+    Dense embeddings of #intent# miss exact strings such as error messages, monitor names or kusto table names, which
+    the index matches term by term. Only the postings of the query terms are visited, so a query costs in proportion to
+    the number of nodes sharing a term with it.
+    """
+
+    def __init__(
+        self,
+        postings: Dict[str, List[Tuple[int, int]]],
+        lengths: Dict[int, int],
+        signature: str = "",
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        """
+        Args:
+            postings (dict): term to the list of (node id, term frequency).
+            lengths (dict): node id to its number of tokens.
+            signature (str): the `kv_map_signature` of the kv map the index was built from.
+            k1 (float): term frequency saturation.
+            b (float): length normalization.
+        """
+        self.postings = postings
+        self.lengths = lengths
+        self.signature = signature
+        self.k1 = k1
+        self.b = b
+        n = len(lengths)
+        self._avg_length = (sum(lengths.values()) / n) if n else 0.0
+        self.idf = {term: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for term, p in postings.items()}
+
+    @classmethod
+    def build(cls, nodes: Iterable[Tuple[int, Dict]], signature: str = "", fields=LEXICAL_FIELDS, **kwargs) -> "LexicalIndex":
+        postings = defaultdict(list)
+        lengths = {}
+        for id, node in nodes:
+            tokens = tokenize(node_text(node, fields))
+            lengths[id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings[term].append((id, tf))
+        return cls(dict(postings), lengths, signature, **kwargs)
+
+    def search(self, query: str, n_results: int = 10) -> List[Tuple[int, float]]:
+        """Return the (node id, score) of the best `n_results` nodes, best first. Nodes without a query term are left
+        out, so fewer results may be returned."""
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = self.idf[term]
+            for id, tf in plist:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[id] / self._avg_length)
+                scores[id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:n_results]
+
+    def save(self, path: str):
+        data = {
+            "version": _FORMAT_VERSION,
+            "signature": self.signature,
+            "k1": self.k1,
+            "b": self.b,
+            # json keys are strings, the lengths are stored as pairs to keep the ids as ints
+            "lengths": list(self.lengths.items()),
+            "postings": self.postings,
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LexicalIndex"]:
+        """Return the index saved at `path`, or None if it is missing or in an older format."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != _FORMAT_VERSION:
+            return None
+        postings = {term: [tuple(p) for p in plist] for term, plist in data["postings"].items()}
+        lengths = {id: length for id, length in data["lengths"]}
+        return cls(postings, lengths, data["signature"], data["k1"], data["b"])
+
+
+def load_lexical_index(kv_map_path: str, kv_map: Mapping, index_path: Optional[str] = None) -> LexicalIndex:
+    """Return the lexical index of the kv map, shared by the agents of the process.
+
+    The index saved next to the node db is used if it was built from the current kv map, otherwise it is rebuilt and
+    saved, e.g. after an incremental update of the node db.
+    """
+    index_path = index_path or default_lexical_index_path(kv_map_path)
+    signature = kv_map_signature(kv_map_path, kv_map)
+    with _index_lock:
+        index = _index_cache.get(index_path)
+        if index is not None and index.signature == signature:
+            return index
+        index = LexicalIndex.load(index_path)
+        if index is None or index.signature != signature:
+            start = time.time()
+            index = LexicalIndex.build(kv_map.items(), signature)
+            index.save(index_path)
+            print(f"Built the lexical index of {len(index.lengths)} nodes in {time.time() - start:.2f}s.")
+        _index_cache[index_path] = index
+        return index
+
+
+def reciprocal_rank_fusion(rankings: List[List], k: int = 60) -> List[Tuple[object, float]]:
+    """Fuse rankings of ids into one, scoring each id with the sum of 1 / (k + rank) over the rankings it is in.
+
+    Args:
+        rankings (list): lists of ids, best first.
+        k (int): damps the weight of the top ranks, 60 as in Cormack et al.
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] += 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
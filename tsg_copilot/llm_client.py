@@ -0,0 +1,304 @@
+import email.utils
+import json
+import random
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+from openai import AzureOpenAI, OpenAI
+
+# responses worth another attempt: timeouts, conflicts, rate limits and server errors
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(headers: httpx.Headers) -> Optional[float]:
+    """The delay asked by the server in `retry-after-ms` or `retry-after` (seconds or an HTTP date), if any."""
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Capped exponential backoff with jitter, so that the callers throttled together do not retry together."""
+
+    def __init__(self, max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+        """
+        Args:
+            max_retries (int): the number of retries of a request before its error is returned.
+            base_delay (float): the delay in seconds before the first retry, doubled for each retry.
+            max_delay (float): the maximum delay in seconds, also the maximum `Retry-After` honoured.
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """The seconds to wait before retry number `attempt + 1`."""
+        if retry_after is not None:
+            # the server knows when its quota frees up, the jitter keeps the callers it throttled apart
+            return min(retry_after, self.max_delay) + random.uniform(0, self.base_delay)
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return cap / 2 + random.uniform(0, cap / 2)
+
+
+class TokenBucket:
+    """A bucket refilled at `per_minute` units a minute, holding at most `burst` of them.
+
+    A caller takes what it needs and waits until the bucket would have held it. The bucket may go into debt, so
+    callers are served in the order they asked and no one polls.
+    """
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute if burst is None else burst
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Take `amount` from the bucket and return the seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+            self._updated = now
+            # a request larger than the bucket would never fit, it waits for a full bucket instead
+            self._level -= min(amount, self.capacity)
+            return max(0.0, -self._level / self.rate)
+
+
+class RateLimiter:
+    """Keep the requests and tokens sent to a deployment under its requests and tokens per minute quotas."""
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        """
+        Args:
+            requests_per_minute (float or None): the requests per minute quota, None for no limit.
+            tokens_per_minute (float or None): the tokens per minute quota, None for no limit.
+        """
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens: float = 0) -> float:
+        """Wait until a request of `tokens` tokens fits in the quotas and return the seconds waited."""
+        wait = 0.0
+        if self._requests is not None:
+            wait = self._requests.reserve(1)
+        if self._tokens is not None and tokens:
+            wait = max(wait, self._tokens.reserve(tokens))
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+def estimate_tokens(body: Dict[str, Any], completion_tokens: int = 1000) -> int:
+    """The tokens a completion request counts against the quota, estimated the way the service does before running
+    it: about four characters per prompt token, plus `max_tokens` or `completion_tokens` for the answer."""
+    prompt = 0
+    for message in body.get("messages") or []:
+        content = message.get("content") if isinstance(message, dict) else None
+        prompt += 4 + len(content if isinstance(content, str) else json.dumps(content or "")) // 4
+    if "input" in body:
+        # an embedding request
+        prompt += len(json.dumps(body["input"])) // 4
+        return prompt
+    return prompt + (body.get("max_tokens") or completion_tokens)
+
+
+class RetryingTransport(httpx.BaseTransport):
+    """An httpx transport that waits for the rate limiter before sending a request and retries it on connection
+    errors and retryable statuses, following `RetryPolicy` and the `Retry-After` of the response.
+
+    The openai clients given an httpx client on this transport should not retry on their own, see `openai_client`.
+    """
+
+    def __init__(
+        self,
+        transport: Optional[httpx.BaseTransport] = None,
+        retry: Optional[RetryPolicy] = None,
+        limiter: Optional[RateLimiter] = None,
+        completion_tokens: int = 1000,
+    ):
+        """
+        Args:
+            transport (httpx.BaseTransport or None): the transport sending the requests, a pooled
+                `httpx.HTTPTransport` if None.
+            retry (RetryPolicy or None): the retry policy, the default `RetryPolicy` if None.
+            limiter (RateLimiter or None): the rate limiter, None for no limit.
+            completion_tokens (int): the tokens counted for the answer of a request without `max_tokens`.
+        """
+        self._transport = httpx.HTTPTransport() if transport is None else transport
+        self._retry = RetryPolicy() if retry is None else retry
+        self._limiter = limiter
+        self._completion_tokens = completion_tokens
+        self._lock = threading.Lock()
+        self._counts = {"requests": 0, "retries": 0, "failures": 0}
+        self._seconds = {"throttled": 0.0, "backoff": 0.0}
+
+    def _tokens(self, request: httpx.Request) -> int:
+        try:
+            body = json.loads(request.content)
+        except (httpx.RequestNotRead, ValueError):
+            return 0
+        return estimate_tokens(body, self._completion_tokens) if isinstance(body, dict) else 0
+
+    def _add(self, counts: Optional[Dict[str, int]] = None, seconds: Optional[Dict[str, float]] = None):
+        with self._lock:
+            for key, value in (counts or {}).items():
+                self._counts[key] += value
+            for key, value in (seconds or {}).items():
+                self._seconds[key] += value
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        tokens = self._tokens(request) if self._limiter is not None else 0
+        attempt = 0
+        while True:
+            if self._limiter is not None:
+                # every attempt is a request against the quota, the tokens are only counted once
+                waited = self._limiter.acquire(tokens if attempt == 0 else 0)
+                self._add(seconds={"throttled": waited})
+            self._add(counts={"requests": 1})
+            try:
+                response = self._transport.handle_request(request)
+            except (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError):
+                if attempt >= self._retry.max_retries:
+                    self._add(counts={"failures": 1})
+                    raise
+                delay = self._retry.delay(attempt)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                if attempt >= self._retry.max_retries:
+                    self._add(counts={"failures": 1})
+                    return response
+                delay = self._retry.delay(attempt, retry_after_seconds(response.headers))
+                response.close()
+            self._add(counts={"retries": 1}, seconds={"backoff": delay})
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self._transport.close()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                **self._counts,
+                "throttled_seconds": self._seconds["throttled"],
+                "backoff_seconds": self._seconds["backoff"],
+            }
+
+
+class PooledHTTPClient(httpx.Client):
+    """An httpx client keeping its connections alive across calls, so that the llm calls of all agents and
+    conversations reuse a few TLS connections instead of opening one per call, with the retries and rate limits of
+    `RetryingTransport`."""
+
+    def __init__(
+        self,
+        retry: Optional[RetryPolicy] = None,
+        limiter: Optional[RateLimiter] = None,
+        max_connections: int = 64,
+        max_keepalive_connections: int = 32,
+        completion_tokens: int = 1000,
+        **kwargs,
+    ):
+        """
+        Args:
+            retry (RetryPolicy or None): the retry policy, the default `RetryPolicy` if None.
+            limiter (RateLimiter or None): the rate limiter, None for no limit.
+            max_connections (int): the maximum number of concurrent connections.
+            max_keepalive_connections (int): the number of idle connections kept alive.
+            completion_tokens (int): the tokens counted for the answer of a request without `max_tokens`.
+            **kwargs: other arguments of `httpx.Client`, e.g. timeout.
+        """
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self._retrying = RetryingTransport(httpx.HTTPTransport(limits=limits), retry, limiter, completion_tokens)
+        super().__init__(transport=self._retrying, **kwargs)
+
+    def stats(self) -> Dict[str, float]:
+        return self._retrying.stats()
+
+
+# used by the offline pipeline and the clients built without an http client, replaced by `set_http_client`
+_http_client: Optional[PooledHTTPClient] = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> PooledHTTPClient:
+    """The http client of the process, created with the default retry policy and no rate limit on first use."""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = PooledHTTPClient(timeout=600)
+        return _http_client
+
+
+def set_http_client(http_client: PooledHTTPClient):
+    """Make `http_client` the http client of the process, e.g. one with the rate limits of the deployment."""
+    global _http_client
+    with _http_client_lock:
+        _http_client = http_client
+
+
+def openai_client(config: Dict[str, Any], http_client: Optional[httpx.Client] = None):
+    """The openai client of an entry of the autogen config list, built the way `OpenAIWrapper` builds it, on the
+    http client of the process if `http_client` is None. The http client retries, so the openai client does not."""
+    http_client = get_http_client() if http_client is None else http_client
+    api_type = config.get("api_type")
+    if api_type is not None and api_type.startswith("azure"):
+        return AzureOpenAI(
+            api_key=config.get("api_key"),
+            azure_endpoint=config.get("base_url"),
+            azure_deployment=config.get("model", "").replace(".", "") or None,
+            api_version=config.get("api_version"),
+            http_client=http_client,
+            max_retries=0,
+        )
+    return OpenAI(
+        api_key=config.get("api_key"),
+        base_url=config.get("base_url"),
+        http_client=http_client,
+        max_retries=0,
+    )
+
+
+class OpenAIEmbeddingFunction:
+    """A chromadb compatible embedding function on `openai_client`, so that the embeddings of queries and nodes share
+    the connections, retries and rate limits of the llm calls."""
+
+    def __init__(
+        self,
+        config: Dict[str, Any],
+        model_name: str = "text-embedding-ada-002",
+        http_client: Optional[httpx.Client] = None,
+    ):
+        """
+        Args:
+            config (dict): an entry of the autogen config list, its model is replaced by `model_name`.
+            model_name (str): the embedding model, also the azure deployment.
+            http_client (httpx.Client or None): the http client, the one of the process if None.
+        """
+        self._client = openai_client({**config, "model": model_name}, http_client)
+        self._model_name = model_name
+
+    def __call__(self, input: List[str]) -> List[List[float]]:
+        texts = [input] if isinstance(input, str) else list(input)
+        # newlines lower the quality of the embeddings, as in chromadb's own OpenAIEmbeddingFunction
+        texts = [text.replace("\n", " ") for text in texts]
+        response = self._client.embeddings.create(input=texts, model=self._model_name)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
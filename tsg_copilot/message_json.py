@@ -0,0 +1,237 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+# the top level fields of the agents' json replies that decide the routing of the group chat
+ROUTING_FIELDS = ("NEXT", "TOKEN", "DECISION")
+
+def _parse(content: Any) -> Optional[Dict]:
+    if not isinstance(content, str):
+        return None
+    try:
+        parsed = json.loads(content)
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+class ChatMessage(dict):
+    """A chat message whose json content is parsed at most once.
+
+    The agents reply in json, and the group chat, the router, the memory and the receiving agents all read the fields
+    of the reply. The parsed content is kept as an attribute rather than a key, so the message is still sent to the llm
+    and saved with the conversation as is. Setting the content drops it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # a flag rather than a sentinel object, which would not survive pickling or a copy to another process
+        self._is_parsed = False
+        self._parsed = None
+
+    def __setitem__(self, key, value):
+        if key == "content":
+            self._is_parsed = False
+            self._parsed = None
+        super().__setitem__(key, value)
+
+    def carry_parsed(self, other: Dict):
+        """Reuse the parsed content of `other`, a copy of this message, if it was parsed already."""
+        if not isinstance(other, ChatMessage) or not other._is_parsed:
+            return
+        if other.get("content") == self.get("content"):
+            self._is_parsed = True
+            self._parsed = other._parsed
+
+    def set_parsed(self, parsed: Optional[Dict]):
+        """Set the parsed content, e.g. assembled by a `StreamingJSONParser` while the content was generated."""
+        self._is_parsed = True
+        self._parsed = parsed
+
+    @property
+    def parsed(self) -> Optional[Dict]:
+        if not self._is_parsed:
+            self._parsed = _parse(self.get("content"))
+            self._is_parsed = True
+        return self._parsed
+
+
+def parse_message(message: Any, strict: bool = False) -> Optional[Dict]:
+    """The json object in the content of `message`, a message dict or its content.
+
+    The result is shared by every reader of a `ChatMessage`, copy it before changing it.
+
+    Args:
+        message (dict or str): the message.
+        strict (bool): raise a ValueError if the content is not a json object. Default is False, return None.
+    """
+    if isinstance(message, ChatMessage):
+        parsed = message.parsed
+    elif isinstance(message, dict):
+        parsed = _parse(message.get("content"))
+    else:
+        parsed = _parse(message)
+    if parsed is None and strict:
+        content = message.get("content") if isinstance(message, dict) else message
+        raise ValueError(f"The message is not a json object: {content}")
+    return parsed
+
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+# states of `StreamingJSONParser`
+_START, _KEY, _COLON, _VALUE, _STRING, _RAW, _NEXT, _DONE = range(8)
+
+
+class StreamingJSONParser:
+    """Parse the top level fields of a json object as its text arrives.
+
+    `feed` returns the fields completed by the new text, so a field such as NEXT can be acted on while the rest of the
+    reply is generated, and the text added to string fields, so a long RESPONSE can be shown as it grows. Nested
+    values are returned whole once complete. Anything before the opening brace is skipped, and text the parser cannot
+    follow stops it: the reply is then parsed as usual once complete.
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.failed = False
+        self._state = _START
+        self._key = None
+        self._chars: List[str] = []  # the decoded key or string value
+        self._escape = ""  # the pending escape sequence of a key or string value
+        self._high_surrogate = ""
+        self._raw: List[str] = []  # the text of a non-string value
+        self._depth = 0
+        self._raw_in_string = False
+        self._raw_escape = False
+
+    @property
+    def done(self) -> bool:
+        """Whether the closing brace of the object was read."""
+        return self._state == _DONE
+
+    def feed(self, text: str) -> Tuple[List[Tuple[str, Any]], Dict[str, str]]:
+        """Read more text of the object.
+
+        Returns:
+            list: the (name, value) of the fields completed by `text`, in order.
+            dict: the text added to each string field by `text`, including completed ones.
+        """
+        completed = []
+        deltas: Dict[str, List[str]] = {}
+        for ch in text:
+            if self.failed or self._state == _DONE:
+                break
+            self._step(ch, completed, deltas)
+        return completed, {key: "".join(pieces) for key, pieces in deltas.items()}
+
+    def _fail(self):
+        self.failed = True
+
+    def _decode(self, ch: str) -> Optional[str]:
+        """Decode a character of a key or string value, None while an escape sequence is pending."""
+        if self._escape:
+            self._escape += ch
+            if self._escape[1] == "u":
+                if len(self._escape) < 6:
+                    return None
+                try:
+                    decoded = chr(int(self._escape[2:], 16))
+                except ValueError:
+                    self._fail()
+                    return None
+            elif self._escape[1] in _ESCAPES:
+                decoded = _ESCAPES[self._escape[1]]
+            else:
+                self._fail()
+                return None
+            self._escape = ""
+        elif ch == "\\":
+            self._escape = ch
+            return None
+        else:
+            decoded = ch
+        # a character outside the basic plane is escaped as a surrogate pair
+        if "\ud800" <= decoded <= "\udbff":
+            self._high_surrogate = decoded
+            return None
+        if self._high_surrogate:
+            pair, self._high_surrogate = self._high_surrogate + decoded, ""
+            return pair.encode("utf-16", "surrogatepass").decode("utf-16")
+        return decoded
+
+    def _step(self, ch: str, completed: List, deltas: Dict[str, List[str]]):
+        state = self._state
+        if state == _START:
+            if ch == "{":
+                self._state = _NEXT
+        elif state == _NEXT:
+            # after the opening brace or a value: a comma, a key or the closing brace
+            if ch == '"':
+                self._chars = []
+                self._state = _KEY
+            elif ch == "}":
+                self._state = _DONE
+            elif not (ch.isspace() or ch == ","):
+                self._fail()
+        elif state == _KEY:
+            if ch == '"' and not self._escape:
+                self._key = "".join(self._chars)
+                self._state = _COLON
+            else:
+                decoded = self._decode(ch)
+                if decoded is not None:
+                    self._chars.append(decoded)
+        elif state == _COLON:
+            if ch == ":":
+                self._state = _VALUE
+            elif not ch.isspace():
+                self._fail()
+        elif state == _VALUE:
+            if ch == '"':
+                self._chars = []
+                self._state = _STRING
+            elif not ch.isspace():
+                self._raw = [ch]
+                self._depth = 1 if ch in "{[" else 0
+                self._raw_in_string = False
+                self._raw_escape = False
+                self._state = _RAW
+        elif state == _STRING:
+            if ch == '"' and not self._escape:
+                value = "".join(self._chars)
+                self.fields[self._key] = value
+                completed.append((self._key, value))
+                self._state = _NEXT
+            else:
+                decoded = self._decode(ch)
+                if decoded is not None:
+                    self._chars.append(decoded)
+                    deltas.setdefault(self._key, []).append(decoded)
+        elif state == _RAW:
+            self._step_raw(ch, completed)
+
+    def _step_raw(self, ch: str, completed: List):
+        if self._raw_in_string:
+            if self._raw_escape:
+                self._raw_escape = False
+            elif ch == "\\":
+                self._raw_escape = True
+            elif ch == '"':
+                self._raw_in_string = False
+        elif ch == '"':
+            self._raw_in_string = True
+        elif ch in "{[":
+            self._depth += 1
+        elif ch in "}]" and self._depth > 0:
+            self._depth -= 1
+        elif self._depth == 0 and (ch == "," or ch == "}"):
+            try:
+                value = json.loads("".join(self._raw))
+            except ValueError:
+                self._fail()
+                return
+            self.fields[self._key] = value
+            completed.append((self._key, value))
+            self._state = _DONE if ch == "}" else _NEXT
+            return
+        self._raw.append(ch)
@@ -0,0 +1,82 @@
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from tsg_copilot.node_store import kv_map_signature
+
+# monitor indexes loaded by this process, by path
+_index_cache: Dict[str, "MonitorIndex"] = {}
+_index_lock = threading.Lock()
+
+
+def default_monitor_index_path(kv_map_path: str) -> str:
+    return os.path.join(os.path.dirname(kv_map_path), "nodedb_monitors.json")
+
+
+class MonitorIndex:
+    """The first step nodes of the tsgs of each monitor, from the #monitor# and #isfirst# fields written by
+    `convert2template`.
+
+    An incident names its monitor, so its first troubleshooting step is an exact lookup. Monitor ids are compared as
+    strings, whatever type Kusto or the monitor map gives them.
+    """
+
+    def __init__(self, first_steps: Dict[str, List[int]], signature: str = ""):
+        """
+        Args:
+            first_steps (dict): monitor id to the ids of the first step nodes of its tsgs, in id order.
+            signature (str): the `kv_map_signature` of the kv map the index was built from.
+        """
+        self.first_steps = first_steps
+        self.signature = signature
+
+    @classmethod
+    def build(cls, nodes: Iterable[Tuple[int, Dict]], signature: str = "") -> "MonitorIndex":
+        first_steps = {}
+        for id, node in nodes:
+            if node.get("#monitor#") is not None and node.get("#isfirst#") == "Yes":
+                first_steps.setdefault(str(node["#monitor#"]), []).append(id)
+        for ids in first_steps.values():
+            ids.sort()
+        return cls(first_steps, signature)
+
+    def lookup(self, monitor_id) -> List[int]:
+        """Return the ids of the first step nodes of the monitor, one per tsg, or an empty list."""
+        return self.first_steps.get(str(monitor_id), [])
+
+    def save(self, path: str):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"signature": self.signature, "first_steps": self.first_steps}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["MonitorIndex"]:
+        """Return the index saved at `path`, or None if it is missing or malformed."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return cls(data["first_steps"], data["signature"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def load_monitor_index(kv_map_path: str, kv_map: Mapping, index_path: Optional[str] = None) -> MonitorIndex:
+    """Return the monitor index of the kv map, shared by the agents of the process.
+
+    The index saved next to the kv map is used if it was built from the current kv map, otherwise it is rebuilt and
+    saved, e.g. for a node db built before the index existed.
+    """
+    index_path = index_path or default_monitor_index_path(kv_map_path)
+    signature = kv_map_signature(kv_map_path, kv_map)
+    with _index_lock:
+        index = _index_cache.get(index_path)
+        if index is not None and index.signature == signature:
+            return index
+        index = MonitorIndex.load(index_path)
+        if index is None or index.signature != signature:
+            index = MonitorIndex.build(kv_map.items(), signature)
+            index.save(index_path)
+        _index_cache[index_path] = index
+        return index
@@ -1,15 +1,35 @@
 import os
+import hashlib
+import threading
 try:
     import chromadb
 except ImportError:
     raise ImportError("Please install dependencies first. `pip install pyautogen[retrievechat]`")
 from autogen.agentchat.agent import Agent
 from .conversable_agent import ConversableAgent
-from .node_retrieve_utils import create_vector_db_from_json_node, query_vector_db, TEXT_FORMATS
+from .node_retrieve_utils import (
+    create_vector_db_from_json_node,
+    update_vector_db_from_json_node,
+    default_manifest_path,
+    query_vector_db,
+    query_vector_db_in_batches,
+    load_kv_map,
+    migrate_pickled_kv_map,
+    get_vector_backend,
+    migrate_chroma_to_numpy,
+    invalidate_chroma_cache,
+    TEXT_FORMATS,
+)
+from .reranker import LLMReranker
+from .lexical_index import load_lexical_index, reciprocal_rank_fusion
+from .monitor_index import load_monitor_index
+from .vector_backend import NUMPY_SUFFIX, numpy_backend_path
+from .message_json import parse_message
+from .streaming import emit_event
+from .tracing import span
 from autogen.token_count_utils import count_token
 from autogen.code_utils import extract_code
 from autogen import logger
-import pickle
 import json
 from Kusto.kusto_api import query_kusto_api
 from typing import Callable, Dict, Optional, Union, List, Tuple, Any
@@ -57,6 +77,14 @@ The each element in <INFO_LIST> are in json format and contains the following fi
 } 
 """
 
+RERANK_USER_MESSAGE = "Here is the user's query and information list:\n<USER_QUERY>:\n{user_query}\n<INFO_LIST>:\n{l_node_json}\n<RESPONSE>:\n"
+# part of the rerank cache key, answers cached with an older prompt are never hit
+RERANK_PROMPT_VERSION = hashlib.sha256((SYSTEM_DEFAULT + RERANK_USER_MESSAGE).encode("utf-8")).hexdigest()[:16]
+
+# node dbs already synced with their tsg json files by this process
+_updated_node_dbs = set()
+_node_db_update_lock = threading.Lock()
+
 
 class RetrieveAssistantAgent(ConversableAgent):
     def __init__(
@@ -109,6 +137,37 @@ class RetrieveAssistantAgent(ConversableAgent):
                 - embedding_function (Optional, Callable): the embedding function for creating the vector db. Default is None,
                     SentenceTransformer with the given `embedding_model` will be used. If you want to use OpenAI, Cohere, HuggingFace or
                     other embedding functions, you can pass it here, follow the examples in `https://docs.trychroma.com/embeddings`.
+                    A `CachedEmbeddingFunction` only caches the queries, the node db is built with the function it wraps.
+                - embedding_batch_size (Optional, int): the maximum number of node intents per embedding call when building
+                    the node db. Default is 256.
+                - embedding_max_workers (Optional, int): the maximum number of concurrent embedding calls when building
+                    the node db. Default is 4.
+                - ingest_max_workers (Optional, int): the number of workers parsing tsg json files when
+                    building or updating the node db. Default is None, the number of CPUs.
+                - ingest_processes (Optional, bool): whether the tsg json files are parsed in forked processes
+                    instead of threads. Default is False, forking the threads of a server can deadlock the children.
+                - rerank_cache (Optional, RerankCache): caches the llm answers selecting a node among the retrieved
+                    candidates, shared across conversations and processes. Default is None, no cache.
+                - reranker (Optional, Reranker): selects the node among the retrieved candidates, e.g. a `LocalReranker`
+                    that only asks the llm when the choice is not clear. Default is None, `LLMReranker()`.
+                - vector_backend (Optional, str): "chroma" to query the chromadb collection, or "numpy" for an exact
+                    in-process search over a memory-mapped matrix of the embeddings, faster for up to about a hundred
+                    thousand nodes. An existing chromadb node db is copied into the numpy backend on first use. Default
+                    is "chroma".
+                - retrieve_batch_size (Optional, int): the maximum number of problems embedded and queried per call by
+                    `retrieve_docs_batch`. Default is 64.
+                - hybrid_retrieval (Optional, bool): if True, fuse the vector search with a BM25 index over the #title#,
+                    #intent# and #action# of the nodes by reciprocal rank fusion, so that exact error strings, monitor
+                    names or kusto table names are found. The index is saved next to the node db. Default is False.
+                - hybrid_candidates (Optional, int): the number of candidates taken from each of the vector search and
+                    the BM25 index before fusion. Default is 4 times n_results.
+                - rrf_k (Optional, int): the constant of reciprocal rank fusion. Default is 60.
+                - speculative_retrieval (Optional, SpeculativeRetrieval): if given, `speculate` starts the vector search
+                    of the user's message while the intent agent decides, and the retrieval uses it if the decided query
+                    is the same text. Default is None, no speculation.
+                - incremental_update (Optional, bool): if True, tsg json files added, changed or removed since the node db
+                    was built are synced into it when the agent is created, re-embedding only the nodes of those files.
+                    Default is True. The check runs once per node db in a process, call `refresh_node_db` to run it again.
                 - customized_prompt (Optional, str): the customized prompt for the retrieve chat. Default is None.
                 - customized_answer_prefix (Optional, str): the customized answer prefix for the retrieve chat. Default is "".
                     If not "" and the customized_answer_prefix is not in the answer, `Update Context` will be triggered.
@@ -159,7 +218,7 @@ class RetrieveAssistantAgent(ConversableAgent):
 
         self._retrieve_config = {} if retrieve_config is None else retrieve_config
         # self._task = self._retrieve_config.get("task", "default")
-        self._client = self._retrieve_config.get("client", chromadb.Client())
+        self._client = self._retrieve_config.get("client", None)
         self._tsg_path = self._retrieve_config.get("tsg_path", None)
         if "tsg_path" not in self._retrieve_config:
             logger.warning(
@@ -178,6 +237,24 @@ class RetrieveAssistantAgent(ConversableAgent):
         # self._must_break_at_empty_line = self._retrieve_config.get("must_break_at_empty_line", True)
         self._embedding_model = self._retrieve_config.get("embedding_model", "all-MiniLM-L6-v2")
         self._embedding_function = self._retrieve_config.get("embedding_function", None)
+        # node intents are embedded once per build, caching them would only evict the cached queries
+        self._ingest_embedding_function = getattr(self._embedding_function, "embedding_function", self._embedding_function)
+        self._embedding_batch_size = self._retrieve_config.get("embedding_batch_size", 256)
+        self._embedding_max_workers = self._retrieve_config.get("embedding_max_workers", 4)
+        self._ingest_max_workers = self._retrieve_config.get("ingest_max_workers", None)
+        self._ingest_processes = self._retrieve_config.get("ingest_processes", False)
+        self._incremental_update = self._retrieve_config.get("incremental_update", True)
+        self._rerank_cache = self._retrieve_config.get("rerank_cache", None)
+        self._reranker = self._retrieve_config.get("reranker", None) or LLMReranker()
+        self._vector_backend = self._retrieve_config.get("vector_backend", "chroma")
+        self._retrieve_batch_size = self._retrieve_config.get("retrieve_batch_size", 64)
+        self._hybrid_retrieval = self._retrieve_config.get("hybrid_retrieval", False)
+        self._hybrid_candidates = self._retrieve_config.get("hybrid_candidates", 4 * self._n_results)
+        self._rrf_k = self._retrieve_config.get("rrf_k", 60)
+        self._speculative_retrieval = self._retrieve_config.get("speculative_retrieval", None)
+        self._speculation = None  # the search started by `speculate`, used by the next retrieval if it is the same
+        self._lexical_index = None
+        self._monitor_index = None
         # self.customized_prompt = self._retrieve_config.get("customized_prompt", None)
         # self.customized_answer_prefix = self._retrieve_config.get("customized_answer_prefix", "").upper()
         # self.update_context = self._retrieve_config.get("update_context", True)
@@ -190,15 +267,18 @@ class RetrieveAssistantAgent(ConversableAgent):
         # self._collection = True if self._tsg_path is None else False  # whether the collection is created
         # self._ipython = get_ipython()
         self._parent_path = os.path.dirname(self._tsg_path)
-        self._kv_map_path = os.path.join(self._parent_path, "kv_map.pkl")
+        self._kv_map_path = os.path.join(self._parent_path, "kv_map.nodes")
+        self._legacy_kv_map_path = os.path.join(self._parent_path, "kv_map.pkl")
         self._nodedb_path = os.path.join(self._parent_path, "nodedb")
+        self._manifest_path = default_manifest_path(self._kv_map_path)
         self._doc_idx = -1  # the index of the current used doc
         self._results = {}  # the results of the current query
         # self._intermediate_answers = set()  # the intermediate answers
         self._doc_contents = []  # the contents of the current used doc
         self._doc_ids = []  # the ids of the current used doc
+        self._doc_distances = None  # the vector distances of the current used doc
         self._search_string = ""  # the search string used in the current query
-        self._kv_map = []  # the kv map of tsg nodes
+        self._kv_map = {}  # the node store of tsg nodes, shared by the agents of the process
         self._marker = None  # the marker of the kv map
         self.previous_node = None  # store the previous step's retrievd node
         # update the termination message function
@@ -209,10 +289,23 @@ class RetrieveAssistantAgent(ConversableAgent):
         self.register_reply(Agent, RetrieveAssistantAgent._generate_retrieve_user_reply, position=2)
 
     def _check_nodedb_exists(self):
+        if not os.path.exists(self._kv_map_path) and os.path.exists(self._legacy_kv_map_path):
+            with _node_db_update_lock:
+                if not os.path.exists(self._kv_map_path):
+                    migrate_pickled_kv_map(self._legacy_kv_map_path, self._kv_map_path)
         if not os.path.exists(self._kv_map_path) or not os.path.exists(self._nodedb_path):
             return False
         files = [f for f in os.listdir(self._nodedb_path) if os.path.isfile(os.path.join(self._nodedb_path, f))]
-        if not files:
+        chroma_files = [f for f in files if not f.endswith(NUMPY_SUFFIX)]
+        if self._vector_backend == "numpy":
+            numpy_path = numpy_backend_path(self._nodedb_path, self._collection_name)
+            if not os.path.exists(numpy_path) and chroma_files:
+                # reuse the embeddings of the chromadb node db instead of embedding every node again
+                with _node_db_update_lock:
+                    if not os.path.exists(numpy_path):
+                        migrate_chroma_to_numpy(self._nodedb_path, self._collection_name)
+            return os.path.exists(numpy_path)
+        if not chroma_files:
             return False
         return True
 
@@ -228,16 +321,74 @@ class RetrieveAssistantAgent(ConversableAgent):
                 # client=self._client,
                 collection_name=self._collection_name,                
                 embedding_model=self._embedding_model,
-                embedding_function=self._embedding_function,                
+                embedding_function=self._ingest_embedding_function,
+                embedding_batch_size=self._embedding_batch_size,
+                embedding_max_workers=self._embedding_max_workers,
+                ingest_max_workers=self._ingest_max_workers,
+                ingest_processes=self._ingest_processes,
+                vector_backend=self._vector_backend,
             )
+            # a full build reassigns the node ids, answers about the old ids are wrong now
+            if self._rerank_cache is not None:
+                self._rerank_cache.clear()
+            self._load_node_indexes()
         else:
+            with _node_db_update_lock:
+                # agents of the same node db share the check, the pool creates many of them
+                if self._incremental_update and self._nodedb_path not in _updated_node_dbs:
+                    self._update_node_db()
+                    _updated_node_dbs.add(self._nodedb_path)
             self._load_kv_map()
 
+    def _update_node_db(self):
+        if not os.path.exists(self._manifest_path):
+            # node dbs built before manifests were introduced can only be rebuilt from scratch
+            logger.warning(f"No manifest found at {self._manifest_path}, skip the incremental update of the node db.")
+            return None
+        self._client, self._kv_map, summary = update_vector_db_from_json_node(
+            tsg_path=self._tsg_path,
+            kv_map_path=self._kv_map_path,
+            db_path=self._nodedb_path,
+            manifest_path=self._manifest_path,
+            collection_name=self._collection_name,
+            embedding_model=self._embedding_model,
+            embedding_function=self._ingest_embedding_function,
+            embedding_batch_size=self._embedding_batch_size,
+            embedding_max_workers=self._embedding_max_workers,
+            ingest_max_workers=self._ingest_max_workers,
+            ingest_processes=self._ingest_processes,
+            vector_backend=self._vector_backend,
+        )
+        return summary
+
+    def refresh_node_db(self):
+        """Sync tsg json files added, changed or removed since the last update into the node db, and return the
+        relative paths of the "added", "changed" and "removed" files."""
+        with _node_db_update_lock:
+            summary = self._update_node_db()
+            _updated_node_dbs.add(self._nodedb_path)
+        self._load_kv_map()
+        return summary
+
     def _load_kv_map(self):
         assert self._tsg_path is not None, "tsg_path is not provided."
         # get the parent directory of self._tsg_path
-        with open(self._kv_map_path, "rb") as f:
-            self._kv_map, self._marker = pickle.load(f)
+        # the node store is mapped once per process, every access decodes a fresh copy of the node
+        self._kv_map, self._marker = load_kv_map(self._kv_map_path)
+        self._load_node_indexes()
+
+    def _load_node_indexes(self):
+        # the indexes derived from the kv map are rebuilt if it changed since they were saved, then shared by the
+        # agents of the process
+        self._monitor_index = load_monitor_index(self._kv_map_path, self._kv_map)
+        if self._hybrid_retrieval:
+            self._lexical_index = load_lexical_index(self._kv_map_path, self._kv_map)
+
+    def reload_node_db(self):
+        """Drop the cached vector db handles of the node db and reload the kv map. Call it after the node db is rebuilt
+        outside of this process."""
+        invalidate_chroma_cache(self._nodedb_path)
+        self._load_kv_map()
 
     def _is_termination_msg_retrievechat(self, message):
         """Check if a message is a termination message.
@@ -272,19 +423,35 @@ class RetrieveAssistantAgent(ConversableAgent):
 
     def _get_node_json_list(self, results: Dict[str, Union[List[str], List[List[str]]]]):
         l_node_json=[]
-        for id in results['ids'][0]:
+        self._doc_ids = []
+        distances = (results.get('distances') or [None])[0]
+        l_distances = []
+        for i, id in enumerate(results['ids'][0]):
             # get id from 'node_id'
             # print("id", id, len(self._kv_map))
-            id = id.split('_')[1]
-            if int(id) < 0 or int(id) > len(self._kv_map):
+            id = int(id.split('_')[1])
+            # ids are stable across incremental updates, so they are not contiguous
+            if id not in self._kv_map:
                 continue
-            l_node_json.append(self._kv_map[int(id)])
+            l_node_json.append(self._kv_map[id])
+            self._doc_ids.append(id)
+            if distances is not None:
+                l_distances.append(distances[i])
+        self._doc_distances = l_distances if distances is not None else None
         return l_node_json
 
     def _generate_message(self, l_node_json):
         if not l_node_json:
             print(colored("No more context, will terminate.", "green"), flush=True)
             return "TERMINATE"
+        for node_json in l_node_json:
+            print(node_json)
+            print("=============")
+        return self._reranker.rerank(
+            self.problem, l_node_json, self._doc_distances, lambda: self._llm_rerank(l_node_json)
+        )
+
+    def _llm_rerank(self, l_node_json):
         message_list = [
             {
                 "role": "system",
@@ -292,13 +459,22 @@ class RetrieveAssistantAgent(ConversableAgent):
             },
             {
                 "role": "user",
-                "content": "Here is the user's query and information list:\n<USER_QUERY>:\n{user_query}\n<INFO_LIST>:\n{l_node_json}\n<RESPONSE>:\n".format(user_query=self.problem, l_node_json=l_node_json)
+                "content": RERANK_USER_MESSAGE.format(user_query=self.problem, l_node_json=l_node_json)
             }
         ]
-        for node_json in l_node_json:
-            print(node_json)
-            print("=============")
+        # the answer is deterministic for the same query and candidates, skip the llm if it is cached
+        prompt_version = f"{RERANK_PROMPT_VERSION}:{self.llm_config.get('model', self._model) if self.llm_config else self._model}"
+        if self._rerank_cache is not None:
+            message = self._rerank_cache.get(self.problem, self._doc_ids, prompt_version)
+            if message is not None:
+                return message
         message = self.generate_oai_reply_self(message_list=message_list)
+        if self._rerank_cache is not None:
+            try:
+                json.loads(message)
+                self._rerank_cache.put(self.problem, self._doc_ids, prompt_version, message)
+            except (TypeError, ValueError):
+                pass
 
         return message
 
@@ -318,24 +494,113 @@ class RetrieveAssistantAgent(ConversableAgent):
             problem (str): the problem to be solved.
             n_results (int): the number of results to be retrieved. Default is 20.
             search_string (str): only docs that contain an exact match of this string will be retrieved. Default is "".
+            where (dict): only docs whose metadata match this filter will be retrieved. Default is None.
         """
         # print(f"Search String:\n{search_string}")
         # print(f"Problem:\n{problem}")
-        results = query_vector_db(
-            query_texts=[problem],
-            n_results=n_results,
-            search_string=search_string,
-            # client=self._client,
-            db_path=self._nodedb_path,
-            collection_name=self._collection_name,
+        emit_event("retrieving", query=problem)
+        results = None
+        speculation, self._speculation = self._speculation, None
+        if speculation is not None:
+            if where is None and not search_string:
+                results = self._speculative_retrieval.resolve(speculation, problem, n_results)
+            else:
+                self._speculative_retrieval.discard(speculation)
+        if results is None:
+            results = self._search(problem, n_results, search_string, where)
+
+        self._search_string = search_string
+        self._results = results
+
+    def _search(self, problem: str, n_results: int, search_string: str = "", where: dict = None):
+        """The vector search of `retrieve_docs`, fused with the lexical index in hybrid mode."""
+        with span("retrieve_docs", agent=self.name, hybrid=self._lexical_index is not None):
+            # the lexical index has no metadata, filtered queries only use the vector search
+            hybrid = self._lexical_index is not None and where is None and not search_string
+            # reuse the process-wide collection handle instead of reopening the db on every query
+            results = query_vector_db(
+                query_texts=[problem],
+                n_results=max(n_results, self._hybrid_candidates) if hybrid else n_results,
+                search_string=search_string,
+                collection=get_vector_backend(self._nodedb_path, self._collection_name, self._vector_backend),
+                db_path=self._nodedb_path,
+                collection_name=self._collection_name,
+                embedding_model=self._embedding_model,
+                embedding_function=self._embedding_function,
+                where=where
+            )
+            if hybrid:
+                results = self._fuse_lexical(problem, results, n_results)
+        return results
+
+    def speculate(self, problem: str):
+        """Start the vector search of `problem` in the background, in case the next retrieval is of the same text,
+        e.g. the user's message while the intent agent decides whether to search it. Nothing is done unless
+        `speculative_retrieval` is set in the retrieve config."""
+        if self._speculative_retrieval is None or not problem:
+            return
+        if self._speculation is not None:
+            if self._speculation.matches(problem, self._n_results):
+                return
+            self._speculative_retrieval.discard(self._speculation)
+        n_results = self._n_results
+        self._speculation = self._speculative_retrieval.start(
+            problem, n_results, lambda: self._search(problem, n_results)
+        )
+
+    def reset(self):
+        super().reset()
+        # the speculation belongs to the conversation the agent set served
+        if self._speculation is not None:
+            self._speculative_retrieval.discard(self._speculation)
+            self._speculation = None
+
+
+    def retrieve_docs_batch(
+        self, problems: List[str], n_results: int = None, batch_size: int = None, where: dict = None
+    ) -> List[List[Dict]]:
+        """Retrieve the candidate nodes of many problems at once, e.g. for offline evaluation or the replay of
+        conversations. The problems are embedded and queried `batch_size` at a time. The state of the current
+        conversation (`_results`, `_doc_ids`) is left untouched.
+
+        Args:
+            problems (List[str]): the problems to be solved.
+            n_results (int): the number of nodes per problem. Default is None, the n_results of the retrieve config.
+            batch_size (int): the maximum number of problems per call. Default is None, retrieve_batch_size.
+            where (dict): only docs whose metadata match this filter will be retrieved. Default is None.
+
+        Returns:
+            List[List[Dict]]: the retrieved nodes of each problem, best first, in the order of problems.
+        """
+        n_results = n_results or self._n_results
+        hybrid = self._lexical_index is not None and where is None
+        results = query_vector_db_in_batches(
+            problems,
+            n_results=max(n_results, self._hybrid_candidates) if hybrid else n_results,
+            batch_size=batch_size or self._retrieve_batch_size,
+            collection=get_vector_backend(self._nodedb_path, self._collection_name, self._vector_backend),
             embedding_model=self._embedding_model,
             embedding_function=self._embedding_function,
-            where=where
+            where=where,
         )
-        
-        self._search_string = search_string
-        self._results = results
+        l_nodes = []
+        for i, problem in enumerate(problems):
+            row = {"ids": [results["ids"][i]], "distances": [results["distances"][i]]}
+            if hybrid:
+                row = self._fuse_lexical(problem, row, n_results)
+            ids = [int(id.split('_')[1]) for id in row["ids"][0]]
+            l_nodes.append([self._kv_map[id] for id in ids if id in self._kv_map])
+        return l_nodes
 
+    def _fuse_lexical(self, problem: str, results, n_results: int):
+        """Fuse the vector results with the lexical index by reciprocal rank fusion. The fused results keep the
+        format of `QueryResult`, nodes only found by the lexical index have no distance."""
+        vector_ids = results["ids"][0]
+        distances = (results.get("distances") or [None])[0] or [None] * len(vector_ids)
+        distance_of = dict(zip(vector_ids, distances))
+        lexical_ids = [f"node_{id}" for id, _ in self._lexical_index.search(problem, self._hybrid_candidates)]
+        fused = [id for id, _ in reciprocal_rank_fusion([vector_ids, lexical_ids], k=self._rrf_k)[:n_results]]
+        return {"ids": [fused], "distances": [[distance_of.get(id) for id in fused]]}
 
     def generate_init_message(self, problem: str, search_string: str = ""):
         """Generate an initial message with the given problem and prompt.
@@ -372,7 +637,7 @@ class RetrieveAssistantAgent(ConversableAgent):
         if messages is None:
             messages = self._oai_messages[sender]
         message = messages[-1]
-        content = json.loads(message['content'])
+        content = parse_message(message, strict=True)
 
         if 'QUERY' in content:
             problem = content['QUERY']
@@ -436,6 +701,7 @@ class RetrieveAssistantAgent(ConversableAgent):
                 message['content']=new_message
                 self.clear_history()
                 self.previous_node = l_selected_node_json      # update the current step's retrieved node
+                emit_event("tsg_selected", title=l_selected_node_json.get("#title#", ""))
                 # sender.clear_history()
                 return True, message
             elif "NO_INFO_EXPLANATION" in message:      # no retrieval information, maybe the query is too specific
@@ -471,22 +737,30 @@ class RetrieveAssistantAgent(ConversableAgent):
             end = info["MitigateDate"].values[0]
             self._reset(intermediate=True)
             self.problem = query
-            where={
-                "$and": [
-                    {"monitor": monitorid},
-                    {"isfirst": True}
-                ]
-            }
-            self.retrieve_docs(self.problem, self._n_results, where=where)
-            l_node_json = self._get_node_json_list(self._results)
+            first_steps = self._monitor_index.lookup(monitorid)
+            if len(first_steps) == 1:
+                # the monitor has a single tsg, its first step is the answer, no need to search
+                self._doc_ids = first_steps
+                l_node_json = [self._kv_map[first_steps[0]]]
+            else:
+                # several tsgs share the monitor, let the vector search rank their first steps
+                where={
+                    "$and": [
+                        {"monitor": monitorid},
+                        {"isfirst": True}
+                    ]
+                }
+                self.retrieve_docs(self.problem, self._n_results, where=where)
+                l_node_json = self._get_node_json_list(self._results)
 
             new_message={}
             content = f"There is the incident details: **Incident**: {title}\n **Starttime**: {start}\n **Endtime**: {end}\n **Summary**: {summary}"
-            new_message['info'] = l_node_json[0]
+            new_message['info'] = dict(l_node_json[0])
             new_message['info']['#incident_details#']=content
             new_message['query'] = self.problem
             message = {'content': json.dumps(new_message)}
             self.previous_node = l_node_json[0]
+            emit_event("tsg_selected", title=l_node_json[0].get("#title#", ""))
             return True, message
         else:
             return False, None
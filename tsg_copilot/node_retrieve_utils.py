@@ -7,6 +7,10 @@ import glob
 import chromadb
 import json
 import pickle
+import hashlib
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import os
 import json
@@ -24,12 +28,24 @@ else:
 from chromadb.api.types import QueryResult
 import chromadb.utils.embedding_functions as ef
 import logging
+import multiprocessing
 from chromadb.utils import embedding_functions
 current_directory = os.path.dirname(os.path.realpath(__file__))
 # Add the parent directory to sys.path
 sys.path.append(os.path.join(current_directory, ".."))
 # from llm_components import pass_config
 from autogen.token_count_utils import count_token
+from tsg_copilot.monitor_index import load_monitor_index
+from tsg_copilot.node_store import NodeStore, NodeStoreWriter, write_node_store
+from tsg_copilot.tracing import span
+from tsg_copilot.vector_backend import (
+    ChromaBackend,
+    NumpyBackend,
+    VectorBackend,
+    invalidate_numpy_backends,
+    numpy_backend_path,
+    open_numpy_backend,
+)
 
 try:
     from unstructured.partition.auto import partition
@@ -75,6 +91,15 @@ if HAS_UNSTRUCTURED:
     TEXT_FORMATS = list(set(TEXT_FORMATS))
 VALID_CHUNK_MODES = frozenset({"one_line", "multi_lines"})
 
+# process-wide, read-only node stores shared by all agents, keyed by kv_map_path
+_kv_map_cache = {}
+_kv_map_lock = threading.Lock()
+
+# process-wide chromadb clients keyed by db_path and collections keyed by (db_path, collection_name)
+_chroma_clients = {}
+_chroma_collections = {}
+_chroma_lock = threading.Lock()
+
 
 def split_text_to_chunks(
     text: str,
@@ -313,6 +338,218 @@ def create_vector_db_from_dir(
     return client
 
 
+def get_chroma_client(db_path: str) -> API:
+    """Return the process-wide persistent chromadb client of db_path, opening it on first use."""
+    with _chroma_lock:
+        client = _chroma_clients.get(db_path)
+        if client is None:
+            client = chromadb.PersistentClient(path=db_path)
+            _chroma_clients[db_path] = client
+        return client
+
+
+def get_chroma_collection(db_path: str, collection_name: str):
+    """Return the process-wide handle of a collection in the persistent chromadb at db_path.
+
+    Opening the client and loading the collection are done once, later calls reuse the same handle, which is safe to
+    query from several threads. Call `invalidate_chroma_cache` after the db is rebuilt.
+    """
+    key = (db_path, collection_name)
+    collection = _chroma_collections.get(key)
+    if collection is not None:
+        return collection
+    client = get_chroma_client(db_path)
+    with _chroma_lock:
+        collection = _chroma_collections.get(key)
+        if collection is None:
+            collection = client.get_collection(collection_name)
+            _chroma_collections[key] = collection
+        return collection
+
+
+def invalidate_chroma_cache(db_path: str = None, collection_name: str = None, drop_client: bool = True):
+    """Drop cached chromadb handles so that the next query reopens them, e.g. after the node db is rebuilt. The numpy
+    backends of db_path are dropped as well.
+
+    Args:
+        db_path (Optional, str): only drop the handles of this db. Default is None, which drops all handles.
+        collection_name (Optional, str): only drop the handle of this collection. Default is None, all collections.
+        drop_client (Optional, bool): whether to drop the client of db_path as well. Default is True. It is kept if
+            collection_name is given.
+    """
+    with _chroma_lock:
+        for key in list(_chroma_collections.keys()):
+            if (db_path is None or key[0] == db_path) and (collection_name is None or key[1] == collection_name):
+                del _chroma_collections[key]
+        if drop_client and collection_name is None:
+            for path in list(_chroma_clients.keys()):
+                if db_path is None or path == db_path:
+                    del _chroma_clients[path]
+    invalidate_numpy_backends(db_path)
+
+
+def get_vector_backend(db_path: str, collection_name: str, kind: str = "chroma") -> VectorBackend:
+    """Return the process-wide backend of a collection of the node db, for queries.
+
+    Args:
+        db_path (str): the path to the node db.
+        collection_name (str): the name of the collection.
+        kind (str): "chroma" for the chromadb collection or "numpy" for the `NumpyBackend` stored in the node db.
+    """
+    if kind == "chroma":
+        return ChromaBackend(get_chroma_collection(db_path, collection_name))
+    if kind == "numpy":
+        return open_numpy_backend(numpy_backend_path(db_path, collection_name))
+    raise ValueError(f"Unknown vector backend: {kind}. Possible values are 'chroma' and 'numpy'.")
+
+
+def _open_vector_backend_for_write(
+    kind: str, client, db_path: str, collection_name: str, embedding_function, fresh: bool = False
+) -> VectorBackend:
+    # writers get their own handle, queries keep using the cached one until the writes are persisted
+    # a fresh collection drops the vectors of a previous build, whose ids the new kv map reassigns
+    if kind == "chroma":
+        if not fresh:
+            return ChromaBackend(
+                client.get_or_create_collection(collection_name, embedding_function=embedding_function)
+            )
+        try:
+            client.delete_collection(collection_name)
+        except ValueError:
+            pass  # no previous build
+        return ChromaBackend(client.create_collection(collection_name, embedding_function=embedding_function))
+    if kind == "numpy":
+        os.makedirs(db_path, exist_ok=True)
+        return NumpyBackend(numpy_backend_path(db_path, collection_name), empty=fresh)
+    raise ValueError(f"Unknown vector backend: {kind}. Possible values are 'chroma' and 'numpy'.")
+
+
+def migrate_chroma_to_numpy(db_path: str, collection_name: str, batch_size: int = 5000) -> NumpyBackend:
+    """Copy the embeddings of a chromadb collection into a `NumpyBackend` in the same node db, without embedding the
+    nodes again."""
+    collection = get_chroma_collection(db_path, collection_name)
+    backend = NumpyBackend(numpy_backend_path(db_path, collection_name))
+    total = collection.count()
+    for offset in range(0, total, batch_size):
+        batch = collection.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+        backend.upsert(batch["ids"], batch["embeddings"], batch["documents"], batch["metadatas"])
+    backend.persist()
+    print(f"Copied {backend.count()} vectors of {collection_name} from chromadb to {backend.path}.")
+    return backend
+
+
+def node_to_record(key, node):
+    """Return the (id, document, metadata) stored in the vector db for a tsg node of the kv map."""
+    metadata = {"title": node["#title#"]}
+    if "#monitor#" in node:
+        metadata["monitor"] = node["#monitor#"]
+        metadata["isfirst"] = node["#isfirst#"] == "Yes"
+    return f"node_{key}", node["#intent#"], metadata
+
+
+def _split_batches(texts: List[str], batch_size: int, max_batch_tokens: int):
+    """Split texts into batches of at most batch_size texts and max_batch_tokens tokens."""
+    batches, batch, batch_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        tokens = count_token(text)
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_batch_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_texts_in_batches(
+    texts: List[str],
+    embedding_function: Callable,
+    batch_size: int = 256,
+    max_batch_tokens: int = 200000,
+    max_workers: int = 4,
+    stats: dict = None,
+) -> List[List[float]]:
+    """Embed texts with a bounded number of concurrent batched calls. Failed calls are not retried here, the openai
+    embedding functions retry on the http client of the process, see `llm_client.RetryingTransport`.
+
+    Args:
+        texts (List[str]): the texts to embed.
+        embedding_function (Callable): the embedding function, it takes a list of texts.
+        batch_size (Optional, int): the maximum number of texts per call. Default is 256, ada-002 accepts up to 2048.
+        max_batch_tokens (Optional, int): the maximum number of tokens per call. Default is 200000.
+        max_workers (Optional, int): the maximum number of concurrent calls. Default is 4.
+        stats (Optional, dict): if given, "embedding_calls" is added to it.
+
+    Returns:
+        List[List[float]]: the embeddings, in the order of texts.
+    """
+    stats = {} if stats is None else stats
+    stats.setdefault("embedding_calls", 0)
+    stats_lock = threading.Lock()
+
+    def embed(batch):
+        with stats_lock:
+            stats["embedding_calls"] += 1
+        return embedding_function([texts[i] for i in batch])
+
+    embeddings = [None] * len(texts)
+    batches = _split_batches(texts, batch_size, max_batch_tokens)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch, batch_embeddings in zip(batches, executor.map(embed, batches)):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+    return embeddings
+
+
+def upsert_nodes(
+    collection,
+    nodes: dict,
+    embedding_function: Callable,
+    embedding_batch_size: int = 256,
+    embedding_max_workers: int = 4,
+    upsert_batch_size: int = 5000,
+):
+    """Embed the #intent# of tsg nodes in batches and upsert them into a collection in chunks.
+
+    Args:
+        collection (VectorBackend or Collection): the vector backend or the chromadb collection.
+        nodes (dict): the tsg nodes to upsert, keyed by their marker in the kv map.
+        embedding_function (Callable): the embedding function.
+        embedding_batch_size (Optional, int): the maximum number of intents per embedding call. Default is 256.
+        embedding_max_workers (Optional, int): the maximum number of concurrent embedding calls. Default is 4.
+        upsert_batch_size (Optional, int): the maximum number of nodes per upsert. Default is 5000.
+    """
+    start = time.time()
+    ids, documents, metadatas = [], [], []
+    for key, node in nodes.items():
+        id, document, metadata = node_to_record(key, node)
+        ids.append(id)
+        documents.append(document)
+        metadatas.append(metadata)
+
+    stats = {}
+    embeddings = embed_texts_in_batches(
+        documents,
+        embedding_function,
+        batch_size=embedding_batch_size,
+        max_workers=embedding_max_workers,
+        stats=stats,
+    )
+    for i in range(0, len(ids), upsert_batch_size):
+        collection.upsert(
+            ids=ids[i : i + upsert_batch_size],
+            embeddings=embeddings[i : i + upsert_batch_size],
+            documents=documents[i : i + upsert_batch_size],
+            metadatas=metadatas[i : i + upsert_batch_size],
+        )
+    elapsed = max(time.time() - start, 1e-6)
+    print(
+        f"Indexed {len(ids)} nodes in {elapsed:.1f}s ({len(ids) / elapsed:.1f} nodes/s), "
+        f"{stats['embedding_calls']} embedding calls."
+    )
+
+
 def create_vector_db_from_json_node(
     tsg_path,
     kv_map_path,
@@ -321,85 +558,191 @@ def create_vector_db_from_json_node(
     collection_name: str = "all-my-documents",
     embedding_model: str = "all-MiniLM-L6-v2",
     embedding_function: Callable = None,
+    embedding_batch_size: int = 256,
+    embedding_max_workers: int = 4,
+    upsert_batch_size: int = 5000,
+    ingest_max_workers: int = None,
+    ingest_processes: bool = True,
+    vector_backend: str = "chroma",
 ) -> API:
-    """Create a vector db from all the files in a given directory, the directory can also be a single file or a url to
-        a single file. We support chromadb compatible APIs to create the vector db, this function is not required if
-        you prepared your own vector db.
+    """Create a vector db from the tsg nodes of all the json files in a given directory. The #intent# of the nodes are
+        embedded in batches and upserted in chunks.
 
     Args:
-        dir_path (Union[str, List[str]]): the path to the directory, file, url or a list of them.
-        max_tokens (Optional, int): the maximum number of tokens per chunk. Default is 4000.
-        client (Optional, API): the chromadb client. Default is None.
-        db_path (Optional, str): the path to the chromadb. Default is "/tmp/chromadb.db".
+        tsg_path (str): the path to the directory of tsg json files.
+        kv_map_path (str): the path to save the kv map of tsg nodes.
+        db_path (str): the path to the chromadb.
+        client (Optional, API): the chromadb client. Default is None, the process-wide client of db_path is used.
         collection_name (Optional, str): the name of the collection. Default is "all-my-documents".
-        get_or_create (Optional, bool): Whether to get or create the collection. Default is False. If True, the collection
-            will be returned if it already exists. Will raise ValueError if the collection already exists and get_or_create is False.
-        chunk_mode (Optional, str): the chunk mode. Default is "multi_lines".
-        must_break_at_empty_line (Optional, bool): Whether to break at empty line. Default is True.
         embedding_model (Optional, str): the embedding model to use. Default is "all-MiniLM-L6-v2". Will be ignored if
             embedding_function is not None.
         embedding_function (Optional, Callable): the embedding function to use. Default is None, SentenceTransformer with
             the given `embedding_model` will be used. If you want to use OpenAI, Cohere, HuggingFace or other embedding
             functions, you can pass it here, follow the examples in `https://docs.trychroma.com/embeddings`.
-        custom_text_split_function (Optional, Callable): a custom function to split a string into a list of strings.
-            Default is None, will use the default function in `autogen.retrieve_utils.split_text_to_chunks`.
-        custom_text_types (Optional, List[str]): a list of file types to be processed. Default is TEXT_FORMATS.
-        recursive (Optional, bool): whether to search documents recursively in the dir_path. Default is True.
+        embedding_batch_size (Optional, int): the maximum number of intents per embedding call. Default is 256.
+        embedding_max_workers (Optional, int): the maximum number of concurrent embedding calls. Default is 4.
+        upsert_batch_size (Optional, int): the maximum number of nodes per upsert. Default is 5000.
+        ingest_max_workers (Optional, int): the number of workers parsing tsg json files. Default is None, the
+            number of CPUs.
+        ingest_processes (Optional, bool): whether the tsg json files are parsed in forked processes or in threads.
+            Default is True, callers in a long running process with threads should pass False, see `read_tsg_files`.
+        vector_backend (Optional, str): "chroma" or "numpy", see `get_vector_backend`. Default is "chroma".
 
     Returns:
-        API: the chromadb client.
+        API: the chromadb client, None for the numpy backend.
+        dict: the kv map of tsg nodes.
     """
 
-    if client is None:
-        client = chromadb.PersistentClient(path=db_path)
+    if client is None and vector_backend == "chroma":
+        client = get_chroma_client(db_path)
         # client = chromadb.Client()
+    kv_map = {}
     try:
         embedding_function = (
             ef.SentenceTransformerEmbeddingFunction(embedding_model)
             if embedding_function is None
             else embedding_function
         )
-        collection = client.get_or_create_collection(
-            collection_name,
-            # get_or_create=get_or_create,
-            embedding_function=embedding_function,
-            # https://github.com/nmslib/hnswlib#supported-distances
-            # https://github.com/chroma-core/chroma/blob/566bc80f6c8ee29f7d99b6322654f32183c368c4/chromadb/segment/impl/vector/local_hnsw.py#L184
-            # https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
-            # metadata={"hnsw:space": "ip", "hnsw:construction_ef": 30, "hnsw:M": 32},  # ip, l2, cosine
+        # https://github.com/nmslib/hnswlib#supported-distances
+        # https://github.com/chroma-core/chroma/blob/566bc80f6c8ee29f7d99b6322654f32183c368c4/chromadb/segment/impl/vector/local_hnsw.py#L184
+        # https://github.com/nmslib/hnswlib/blob/master/ALGO_PARAMS.md
+        # metadata={"hnsw:space": "ip", "hnsw:construction_ef": 30, "hnsw:M": 32},  # ip, l2, cosine
+        collection = _open_vector_backend_for_write(
+            vector_backend, client, db_path, collection_name, embedding_function, fresh=True
         )
      
-        kv_map, marker = build_kv_map(tsg_path, kv_map_path)
+        kv_map, marker = build_kv_map(
+            tsg_path, kv_map_path, max_workers=ingest_max_workers, processes=ingest_processes
+        )
         logger.info(f"build kv map.")
 
-        for key in kv_map.keys():
-            if "#monitor#" not in kv_map[key]:
-                intent = kv_map[key]['#intent#']
-                title = kv_map[key]['#title#']
-                id = f"node_{key}"
-                # meta_data = kv_map[key]
-                collection.upsert(
-                    ids=[id],
-                    documents=[intent],
-                    metadatas=[{"title": title}],
-                )
-            else:
-                intent = kv_map[key]['#intent#']
-                title = kv_map[key]['#title#']
-                monitor = kv_map[key]["#monitor#"]
-                is_first = kv_map[key]["#isfirst#"] == "Yes"
-                id = f"node_{key}"
-                # meta_data = kv_map[key]
-                collection.upsert(
-                    ids=[id],
-                    documents=[intent],
-                    metadatas=[{"title": title, "monitor": monitor, "isfirst": is_first}],
-                )
-            
+        upsert_nodes(
+            collection,
+            kv_map,
+            embedding_function,
+            embedding_batch_size=embedding_batch_size,
+            embedding_max_workers=embedding_max_workers,
+            upsert_batch_size=min(upsert_batch_size, getattr(client, "max_batch_size", upsert_batch_size)),
+        )
+        collection.persist()
+
     except ValueError as e:
         logger.warning(f"{e}")
+    # the collection has changed, make queries reopen it
+    invalidate_chroma_cache(db_path, collection_name)
     return client, kv_map
 
+
+def update_vector_db_from_json_node(
+    tsg_path,
+    kv_map_path,
+    db_path,
+    manifest_path: str = None,
+    client: API = None,
+    collection_name: str = "all-my-documents",
+    embedding_model: str = "all-MiniLM-L6-v2",
+    embedding_function: Callable = None,
+    embedding_batch_size: int = 256,
+    embedding_max_workers: int = 4,
+    upsert_batch_size: int = 5000,
+    ingest_max_workers: int = None,
+    ingest_processes: bool = True,
+    vector_backend: str = "chroma",
+):
+    """Incrementally update a vector db created by `create_vector_db_from_json_node`.
+
+    The manifest records the content hash and node ids of every tsg json file. Nodes of removed or changed files are
+    deleted, and only the nodes of changed or added files are embedded and upserted with new ids. Nodes of unchanged
+    files keep their ids, so their embeddings are never recomputed.
+
+    Args:
+        tsg_path (str): the path to the directory of tsg json files.
+        kv_map_path (str): the path to the kv map of tsg nodes.
+        db_path (str): the path to the chromadb.
+        manifest_path (Optional, str): the path to the manifest. Default is None, `nodedb_manifest.json` next to
+            the kv map.
+        Other arguments are the same as `create_vector_db_from_json_node`.
+
+    Returns:
+        API: the chromadb client.
+        dict: the kv map of tsg nodes.
+        dict: the relative paths of the "added", "changed" and "removed" files.
+    """
+    manifest_path = default_manifest_path(kv_map_path) if manifest_path is None else manifest_path
+    if client is None and vector_backend == "chroma":
+        client = get_chroma_client(db_path)
+    manifest = load_manifest(manifest_path)
+    kv_map, marker = load_kv_map(kv_map_path)
+    marker = manifest.get("next_marker", marker)
+    old_files = manifest["files"]
+
+    current_files = {
+        os.path.relpath(file, tsg_path): file_content_hash(file) for file in list_tsg_files(tsg_path)
+    }
+    added = sorted(f for f in current_files if f not in old_files)
+    changed = sorted(f for f in current_files if f in old_files and old_files[f]["hash"] != current_files[f])
+    removed = sorted(f for f in old_files if f not in current_files)
+    summary = {"added": added, "changed": changed, "removed": removed}
+    if not (added or changed or removed):
+        return client, kv_map, summary
+
+    embedding_function = (
+        ef.SentenceTransformerEmbeddingFunction(embedding_model) if embedding_function is None else embedding_function
+    )
+    collection = _open_vector_backend_for_write(vector_backend, client, db_path, collection_name, embedding_function)
+
+    stale_ids = set(id for f in changed + removed for id in old_files[f]["node_ids"])
+    if stale_ids:
+        collection.delete(ids=[f"node_{id}" for id in sorted(stale_ids)])
+    for f in removed:
+        del old_files[f]
+
+    new_nodes = {}
+    new_records = {}
+    files = [os.path.join(tsg_path, f) for f in changed + added]
+    for file, content_hash, records, error in read_tsg_files(
+        files, max_workers=ingest_max_workers, processes=ingest_processes
+    ):
+        f = os.path.relpath(file, tsg_path)
+        if error is not None:
+            logger.warning(f"Skip malformed tsg file {file}: {error}")
+            old_files.pop(f, None)
+            continue
+        node_ids = []
+        for record in records:
+            new_records[marker] = record
+            new_nodes[marker] = json.loads(record)
+            node_ids.append(marker)
+            marker += 1
+        old_files[f] = {"hash": content_hash, "node_ids": node_ids}
+
+    if new_nodes:
+        upsert_nodes(
+            collection,
+            new_nodes,
+            embedding_function,
+            embedding_batch_size=embedding_batch_size,
+            embedding_max_workers=embedding_max_workers,
+            upsert_batch_size=min(upsert_batch_size, getattr(client, "max_batch_size", upsert_batch_size)),
+        )
+    collection.persist()
+    # copy the encoded nodes that are still valid into the new store, then append the new ones
+    writer = NodeStoreWriter(kv_map_path)
+    for id in kv_map:
+        if id not in stale_ids:
+            writer.add_raw(id, kv_map.raw(id))
+    for id, record in new_records.items():
+        writer.add_raw(id, record)
+    writer.commit(marker)
+    kv_map, marker = load_kv_map(kv_map_path)
+    load_monitor_index(kv_map_path, kv_map)
+    manifest["next_marker"] = marker
+    save_manifest(manifest_path, manifest)
+    invalidate_chroma_cache(db_path, collection_name)
+    print(f"Node db updated: {len(added)} added, {len(changed)} changed, {len(removed)} removed tsg files.")
+    return client, kv_map, summary
+
+
 def query_vector_db(
     query_texts: List[str],
     n_results: int = 10,
@@ -410,6 +753,8 @@ def query_vector_db(
     where: dict = None,
     embedding_model: str = "all-MiniLM-L6-v2",
     embedding_function: Callable = None,
+    collection=None,
+    vector_backend: str = "chroma",
 ) -> QueryResult:
     """Query a vector db. We support chromadb compatible APIs, it's not required if you prepared your own vector db
         and query function.
@@ -417,7 +762,8 @@ def query_vector_db(
     Args:
         query_texts (List[str]): the query texts.
         n_results (Optional, int): the number of results to return. Default is 10.
-        client (Optional, API): the chromadb compatible client. Default is None, a chromadb client will be used.
+        client (Optional, API): the chromadb compatible client. Default is None, the process-wide client of db_path
+            will be used.
         db_path (Optional, str): the path to the vector db. Default is "/tmp/chromadb.db".
         collection_name (Optional, str): the name of the collection. Default is "all-my-documents".
         search_string (Optional, str): the search string. Default is "".
@@ -426,6 +772,10 @@ def query_vector_db(
         embedding_function (Optional, Callable): the embedding function to use. Default is None, SentenceTransformer with
             the given `embedding_model` will be used. If you want to use OpenAI, Cohere, HuggingFace or other embedding
             functions, you can pass it here, follow the examples in `https://docs.trychroma.com/embeddings`.
+        collection (Optional, VectorBackend or Collection): an already opened backend or collection to query. Default
+            is None, the collection is looked up from client or from the process-wide registry.
+        vector_backend (Optional, str): the kind of backend looked up from the registry, see `get_vector_backend`.
+            Default is "chroma".
 
     Returns:
         QueryResult: the query result. The format is:
@@ -436,27 +786,71 @@ def query_vector_db(
                 metadatas: Optional[List[List[Metadata]]]
                 distances: Optional[List[List[float]]]
     """
-    if client is None:
-        client = chromadb.PersistentClient(path=db_path)
     # the collection's embedding function is always the default one, but we want to use the one we used to create the
     # collection. So we compute the embeddings ourselves and pass it to the query function.
-    collection = client.get_collection(collection_name)
+    if collection is None:
+        if client is None:
+            collection = get_vector_backend(db_path, collection_name, vector_backend)
+        else:
+            collection = client.get_collection(collection_name)
     embedding_function = (
         ef.SentenceTransformerEmbeddingFunction(embedding_model) if embedding_function is None else embedding_function
     )
-    query_embeddings = embedding_function(query_texts)
+    with span("embedding", texts=len(query_texts)):
+        query_embeddings = embedding_function(query_texts)
     # Query/search n most similar results. You can also .get by id
-    results = collection.query(
-        query_embeddings=query_embeddings,
-        n_results=n_results,
-        where=where,
-        where_document={"$contains": search_string} if search_string else None,  # optional filter
+    with span("collection.query", queries=len(query_texts), n_results=n_results, filtered=bool(where or search_string)):
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results,
+            where=where,
+            where_document={"$contains": search_string} if search_string else None,  # optional filter
+        )
+    return results
+
+
+def query_vector_db_in_batches(
+    query_texts: List[str],
+    n_results: int = 10,
+    batch_size: int = 64,
+    stats: dict = None,
+    **kwargs,
+) -> QueryResult:
+    """Query a vector db with many texts, embedding and querying `batch_size` texts per call instead of one.
+
+    Args:
+        query_texts (List[str]): the query texts.
+        n_results (Optional, int): the number of results per query text. Default is 10.
+        batch_size (Optional, int): the maximum number of texts per embedding call and collection query. Default is 64.
+        stats (Optional, dict): if given, "queries", "batches" and "seconds" are added to it.
+        **kwargs: the other arguments of `query_vector_db`, e.g. collection, embedding_function or where.
+
+    Returns:
+        QueryResult: the ids, distances, documents and metadatas, one list per query text in the order of query_texts.
+    """
+    stats = {} if stats is None else stats
+    start = time.time()
+    results = {"ids": [], "distances": [], "documents": [], "metadatas": []}
+    batches = 0
+    for i in range(0, len(query_texts), batch_size):
+        batch_texts = query_texts[i : i + batch_size]
+        batch = query_vector_db(batch_texts, n_results=n_results, **kwargs)
+        for key in results:
+            results[key].extend(batch.get(key) or [None] * len(batch_texts))
+        batches += 1
+    elapsed = max(time.time() - start, 1e-6)
+    stats["queries"] = stats.get("queries", 0) + len(query_texts)
+    stats["batches"] = stats.get("batches", 0) + batches
+    stats["seconds"] = stats.get("seconds", 0.0) + elapsed
+    print(
+        f"Retrieved {len(query_texts)} queries in {batches} batches in {elapsed:.1f}s "
+        f"({len(query_texts) / elapsed:.1f} queries/s)."
     )
     return results
 
 
-def build_kv_map(dir_path: str, kv_map_path: str, recursive: bool = True, types: list = ["json"]):
-    # read all json files
+def list_tsg_files(dir_path: str, recursive: bool = True, types: list = ["json"]):
+    """Return the sorted paths of all tsg json files under dir_path."""
     files=[]
     if os.path.exists(dir_path):
         for type in types:
@@ -467,21 +861,161 @@ def build_kv_map(dir_path: str, kv_map_path: str, recursive: bool = True, types:
     else:
         logger.error(f"Directory {dir_path} does not exist.")
         raise ValueError(f"Directory {dir_path} does not exist.")
-    
-    kv_map = {}
+    # sort the files so that markers are assigned deterministically
+    return sorted(set(files))
+
+
+def file_content_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def default_manifest_path(kv_map_path: str) -> str:
+    return os.path.join(os.path.dirname(kv_map_path), "nodedb_manifest.json")
+
+
+def load_manifest(manifest_path: str) -> dict:
+    """Load the manifest of the node db: the content hash and node ids of each tsg file, and the next marker."""
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path: str, manifest: dict):
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def migrate_pickled_kv_map(pickle_path: str, kv_map_path: str):
+    """Convert a kv map pickled by earlier versions into a node store, so existing node dbs need no rebuild."""
+    with open(pickle_path, "rb") as f:
+        kv_map, marker = pickle.load(f)
+    write_node_store(kv_map_path, kv_map, marker)
+    logger.info(f"Migrated {len(kv_map)} nodes from {pickle_path} to {kv_map_path}.")
+
+
+def _read_tsg_file(file: str):
+    # runs in the worker processes of `read_tsg_files`, so it must stay a module level function
+    try:
+        with open(file, "rb") as f:
+            content = f.read()
+        tsg = json.loads(content.decode("utf-8", errors="ignore"))
+        if not isinstance(tsg, list):
+            raise ValueError(f"expected a list of nodes, got {type(tsg).__name__}")
+        records = [json.dumps(node, ensure_ascii=False, separators=(",", ":")).encode("utf-8") for node in tsg]
+    except (OSError, ValueError) as e:
+        return file, None, None, str(e)
+    return file, hashlib.sha256(content).hexdigest(), records, None
+
+
+def read_tsg_files(files: List[str], max_workers: int = None, chunksize: int = 8, processes: bool = True):
+    """Parse tsg json files in a process pool, or a thread pool where processes cannot be forked.
+
+    Args:
+        files (List[str]): the paths to the tsg json files.
+        max_workers (Optional, int): the number of workers. Default is None, the number of CPUs. The files are parsed
+            in this process if it is 1.
+        chunksize (Optional, int): the number of files sent to a worker at a time. Default is 8.
+        processes (Optional, bool): whether to parse in forked processes. Default is True. A long running process
+            with threads, e.g. the server, must use threads: a fork only copies the calling thread and can inherit
+            locks held by the others, e.g. of http connection pools or sqlite connections, forever.
+
+    Yields:
+        Tuple[str, str, List[bytes], str]: the path, the sha256 of the content, the json encoded nodes and the error,
+            in the order of files. The hash and nodes are None and the error is set if the file is malformed.
+    """
+    if max_workers == 1 or len(files) <= 1:
+        yield from map(_read_tsg_file, files)
+        return
+    if processes and "fork" in multiprocessing.get_all_start_methods():
+        # spawned workers would re-import the entry script, which builds the node db when it is imported
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("fork"))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    with executor:
+        # map keeps the order of files, so markers do not depend on which worker finishes first
+        yield from executor.map(_read_tsg_file, files, chunksize=chunksize)
+
+
+def build_kv_map(
+    dir_path: str,
+    kv_map_path: str,
+    recursive: bool = True,
+    types: list = ["json"],
+    manifest_path: str = None,
+    max_workers: int = None,
+    processes: bool = True,
+):
+    """Parse all tsg json files under dir_path in parallel and stream their nodes into the node store at kv_map_path.
+        Markers are assigned in the order of the sorted file paths. Malformed files are skipped and reported.
+
+    Args:
+        max_workers (Optional, int): the number of workers parsing files. Default is None, the number of CPUs.
+        processes (Optional, bool): whether the workers are processes or threads, see `read_tsg_files`.
+
+    Returns:
+        Tuple[NodeStore, int]: the node store and the marker (next unused node id).
+    """
+    # read all json files
+    files = list_tsg_files(dir_path, recursive, types)
+
+    start = time.time()
+    writer = NodeStoreWriter(kv_map_path)
     marker = 0
-    os.makedirs(os.path.dirname(kv_map_path), exist_ok=True)
+    manifest = {"files": {}}
+    failed = []
 
-    for file in files:
-        with open(file, "r", encoding="utf-8", errors="ignore") as f:
-            tsg = json.load(f)
-            
-            for idx, node in enumerate(tsg):
-                kv_map[marker] = node
+    try:
+        for file, content_hash, records, error in read_tsg_files(files, max_workers=max_workers, processes=processes):
+            if error is not None:
+                logger.warning(f"Skip malformed tsg file {file}: {error}")
+                failed.append(file)
+                continue
+            node_ids = []
+            for record in records:
+                writer.add_raw(marker, record)
+                node_ids.append(marker)
                 marker += 1
-    # dump the kv_map and marker to pickle file
-    
-    with open(kv_map_path, "wb") as f:
-        pickle.dump((kv_map,marker), f)
-    
-    return kv_map, marker
\ No newline at end of file
+            manifest["files"][os.path.relpath(file, dir_path)] = {"hash": content_hash, "node_ids": node_ids}
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit(marker)
+    # record which nodes come from which file, for incremental updates
+    manifest["next_marker"] = marker
+    save_manifest(default_manifest_path(kv_map_path) if manifest_path is None else manifest_path, manifest)
+
+    elapsed = max(time.time() - start, 1e-6)
+    print(
+        f"Loaded {marker} nodes from {len(files) - len(failed)} tsg files in {elapsed:.1f}s "
+        f"({len(files) / elapsed:.1f} files/s), {len(failed)} failed."
+    )
+    if failed:
+        print("Failed tsg files:\n" + "\n".join(failed))
+
+    kv_map, marker = load_kv_map(kv_map_path)
+    # the monitor index is derived from the kv map, build it with it
+    load_monitor_index(kv_map_path, kv_map)
+    return kv_map, marker
+
+
+def load_kv_map(kv_map_path: str):
+    """Open the node store of tsg nodes. The store is memory-mapped once per process and shared by all agents, and
+        nodes are decoded when they are accessed by id. The store is reopened if the file on disk is replaced.
+
+    Args:
+        kv_map_path (str): the path to the node store.
+
+    Returns:
+        Tuple[NodeStore, int]: the node store and the marker (next unused node id).
+    """
+    stat = os.stat(kv_map_path)
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _kv_map_lock:
+        cached = _kv_map_cache.get(kv_map_path)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[1].marker
+        # the previous store stays mapped until the agents still using it drop it
+        kv_map = NodeStore(kv_map_path)
+        _kv_map_cache[kv_map_path] = (version, kv_map)
+    return kv_map, kv_map.marker
\ No newline at end of file
@@ -0,0 +1,141 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+from array import array
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator
+
+# header: magic, next marker, number of nodes, offset of the index
+_HEADER = struct.Struct("<8sqqq")
+_MAGIC = b"TSGNODE1"
+
+
+class NodeStore(Mapping):
+    """A read-only mapping of node id to tsg node, backed by a memory-mapped file.
+
+    The file holds the json encoded nodes back to back, followed by an index of sorted ids, offsets and lengths. Only
+    the header is read on open, and a node is decoded when it is accessed, so opening is O(1) and every process
+    reading the same file shares one copy of it in the page cache.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): the path to a node store written by `NodeStoreWriter`.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.marker, self._count, index_offset = _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a node store.")
+        view = memoryview(self._mmap)
+        width = 8 * self._count
+        self._ids = view[index_offset : index_offset + width].cast("q")
+        self._offsets = view[index_offset + width : index_offset + 2 * width].cast("q")
+        self._lengths = view[index_offset + 2 * width : index_offset + 3 * width].cast("q")
+        view.release()
+
+    def _position(self, id: int) -> int:
+        i = bisect.bisect_left(self._ids, id)
+        if i == self._count or self._ids[i] != id:
+            return -1
+        return i
+
+    def raw(self, id: int) -> bytes:
+        """Return the encoded node, without decoding it."""
+        i = self._position(id) if isinstance(id, int) else -1
+        if i < 0:
+            raise KeyError(id)
+        offset = self._offsets[i]
+        return self._mmap[offset : offset + self._lengths[i]]
+
+    def __getitem__(self, id: int) -> Dict[str, Any]:
+        return json.loads(self.raw(id))
+
+    def __contains__(self, id) -> bool:
+        return isinstance(id, int) and self._position(id) >= 0
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._ids.tolist())
+
+    def __len__(self) -> int:
+        return self._count
+
+    def close(self):
+        for view in (self._ids, self._offsets, self._lengths):
+            view.release()
+        self._mmap.close()
+
+
+class NodeStoreWriter:
+    """Stream tsg nodes into a new node store. The store replaces `path` atomically when `commit` is called."""
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._tmp_path = f"{path}.{os.getpid()}.tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(b"\0" * _HEADER.size)
+        self._index: Dict[int, tuple] = {}
+
+    def add_raw(self, id: int, data: bytes):
+        """Add an already encoded node, e.g. one read with `NodeStore.raw`."""
+        if id in self._index:
+            raise ValueError(f"Duplicate node id {id}.")
+        self._index[id] = (self._file.tell(), len(data))
+        self._file.write(data)
+
+    def add(self, id: int, node: Dict[str, Any]):
+        self.add_raw(id, json.dumps(node, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def commit(self, marker: int):
+        """Write the index and replace the store.
+
+        Args:
+            marker (int): the next unused node id.
+        """
+        # keep the index aligned for the int64 views of the reader
+        self._file.write(b"\0" * (-self._file.tell() % 8))
+        index_offset = self._file.tell()
+        ids = sorted(self._index)
+        self._file.write(array("q", ids).tobytes())
+        self._file.write(array("q", [self._index[id][0] for id in ids]).tobytes())
+        self._file.write(array("q", [self._index[id][1] for id in ids]).tobytes())
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(_MAGIC, marker, len(ids), index_offset))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+
+def kv_map_signature(kv_map_path: str, kv_map: Mapping) -> str:
+    """Identify the version of a kv map, for the indexes derived from it. Updates of the node db always rewrite the kv
+    map, adding nodes moves its marker and removing nodes changes its size."""
+    return f"{getattr(kv_map, 'marker', None)}:{len(kv_map)}:{os.path.getsize(kv_map_path)}"
+
+
+def write_node_store(path: str, nodes: Mapping, marker: int):
+    """Write a mapping of node id to tsg node as a node store."""
+    writer = NodeStoreWriter(path)
+    try:
+        for id in nodes:
+            if isinstance(nodes, NodeStore):
+                # copy the encoded nodes, there is no need to decode them
+                writer.add_raw(id, nodes.raw(id))
+            else:
+                writer.add(id, nodes[id])
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit(marker)
@@ -1,8 +1,8 @@
 from typing import Callable, Dict, Literal, Optional, Union
 
 from .conversable_agent import ConversableAgent
+from .message_json import parse_message
 from autogen import Agent
-import json
 
 
 DEFAULT_SYSTEM_MESSAGE = """You are a helpful troubleshooting guide assistant that helps the user to troubleshoot the incident or the query in <USER_QUERY>. You will be provided with information related to the user's incident in <INFO>. <INFO> is in json format and contains the following fields: 
@@ -116,7 +116,7 @@ class PlannerAgent(ConversableAgent):
         query=""
 
         try:
-            update_content=json.loads(update_content)
+            update_content=parse_message(message, strict=True)
             decision = update_content['DECISION']
             if decision == "RELATED":
                 if "QUERY" in update_content.keys():
@@ -135,11 +135,7 @@ class PlannerAgent(ConversableAgent):
 
         # get chat history from chat manager
         if sender.name == 'chat_manager':
-            memory = sender.get_memory()
-            if memory:
-                chat_history = '\n'.join(conversation['chat'] for conversation in memory)
-            else:
-                chat_history = ''
+            chat_history = sender.get_chat_history()
 
         message = DEFAULT_RECEIVE_MESSAGE.format(user_query=query, info=info, chat_history=chat_history)
 
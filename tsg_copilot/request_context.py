@@ -0,0 +1,39 @@
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+
+# the conversation whose turn the current thread or task is serving. Blocking work of the async path runs through
+# `asyncio.to_thread`, which carries the context over to the executor thread.
+_conversation_id: contextvars.ContextVar = contextvars.ContextVar("conversation_id", default=None)
+
+
+def current_conversation_id() -> Optional[str]:
+    return _conversation_id.get()
+
+
+@contextmanager
+def conversation_scope(conversation_id: Optional[str]):
+    """Attribute the work done within the block, such as llm calls, to the conversation."""
+    token = _conversation_id.set(conversation_id)
+    try:
+        yield
+    finally:
+        _conversation_id.reset(token)
+
+
+# the round of the group chat the current thread or task is in, set by `GroupChatManager.run_chat`
+_chat_round: contextvars.ContextVar = contextvars.ContextVar("chat_round", default=None)
+
+
+def current_round() -> Optional[int]:
+    return _chat_round.get()
+
+
+@contextmanager
+def round_scope(chat_round: Optional[int]):
+    """Attribute the work done within the block, such as tracing spans, to the round of the group chat."""
+    token = _chat_round.set(chat_round)
+    try:
+        yield
+    finally:
+        _chat_round.reset(token)
@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+from tsg_copilot.embedding_cache import normalize_text
+
+logger = logging.getLogger(__name__)
+
+
+class RerankCache:
+    """A SQLite cache of the llm answers choosing a node among the retrieved candidates.
+
+    With temperature and top_p at 0 the answer only depends on the query, the candidate nodes and the prompt, so it is
+    keyed by the normalized query, the ordered candidate node ids and a prompt version. The file can be shared by every
+    worker process on the host.
+
+    Node ids are never reused by incremental updates of the node db, so answers about removed nodes simply stop being
+    hit and expire. Call `clear` when the node db is rebuilt from scratch, since a full build reassigns the ids.
+    """
+
+    def __init__(self, db_path: str = "rerank_cache.sqlite3", ttl: Optional[float] = 7 * 24 * 3600, purge_every: int = 100):
+        """
+        Args:
+            db_path (str): the path to the SQLite file. It is created if it does not exist.
+            ttl (float or None): seconds an answer stays valid. None keeps them until they are invalidated.
+            purge_every (int): purge expired answers once every `purge_every` writes.
+        """
+        self._db_path = db_path
+        self._ttl = ttl
+        self._purge_every = purge_every
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "writes": 0, "purged": 0}
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rerank ("
+                "key TEXT PRIMARY KEY, node_ids TEXT NOT NULL, response TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, key: str, value: int = 1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    @staticmethod
+    def _node_ids(node_ids: List) -> str:
+        # delimited on both sides so that `invalidate_nodes` can match a single id
+        return "," + ",".join(str(id) for id in node_ids) + ","
+
+    @classmethod
+    def make_key(cls, query: str, node_ids: List, prompt_version: str) -> str:
+        text = f"{prompt_version}\0{normalize_text(query)}\0{cls._node_ids(node_ids)}"
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, query: str, node_ids: List, prompt_version: str) -> Optional[str]:
+        """Return the cached answer, or None."""
+        sql = "SELECT response FROM rerank WHERE key = ?"
+        params = [self.make_key(query, node_ids, prompt_version)]
+        if self._ttl is not None:
+            sql += " AND created_at >= ?"
+            params.append(time.time() - self._ttl)
+        row = self._connection().execute(sql, params).fetchone()
+        if row is None:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return row[0]
+
+    def put(self, query: str, node_ids: List, prompt_version: str, response: str):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rerank (key, node_ids, response, created_at) VALUES (?, ?, ?, ?)",
+                (self.make_key(query, node_ids, prompt_version), self._node_ids(node_ids), response, time.time()),
+            )
+        self._count("writes")
+        if self._purge_every and self._stats["writes"] % self._purge_every == 0:
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        if self._ttl is None:
+            return 0
+        with self._connection() as conn:
+            cursor = conn.execute("DELETE FROM rerank WHERE created_at < ?", (time.time() - self._ttl,))
+        self._count("purged", cursor.rowcount)
+        return cursor.rowcount
+
+    def invalidate_nodes(self, node_ids: List) -> int:
+        """Drop the answers whose candidates include any of the node ids."""
+        deleted = 0
+        with self._connection() as conn:
+            for id in node_ids:
+                deleted += conn.execute("DELETE FROM rerank WHERE node_ids LIKE ?", (f"%,{id},%",)).rowcount
+        return deleted
+
+    def clear(self):
+        """Drop every answer, e.g. after the node db is rebuilt."""
+        with self._connection() as conn:
+            conn.execute("DELETE FROM rerank")
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["entries"] = self._connection().execute("SELECT COUNT(*) FROM rerank").fetchone()[0]
+        return stats
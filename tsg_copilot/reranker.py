@@ -0,0 +1,119 @@
+import json
+import threading
+from typing import Callable, Dict, List, Optional
+
+from tsg_copilot.bm25 import BM25, node_text, tokenize
+
+
+class Reranker:
+    """Select the node answering the query among the candidates retrieved by `RetrieveAssistantAgent`.
+
+    The answer is a json string in the format asked of the llm by the rerank prompt, e.g.
+    `{"INDEX": 0, "EXPLANATION": "..."}` or `{"NO_INFO_EXPLANATION": "..."}`, so the agent handles every reranker
+    the same way. The llm is passed in as a callable returning its answer, it is only called if the reranker needs it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {"local": 0, "llm": 0}
+
+    def rerank(self, query: str, nodes: List[Dict], distances: Optional[List[float]], llm: Callable[[], str]) -> str:
+        """
+        Args:
+            query (str): the user query.
+            nodes (list): the candidate nodes, in the order of the vector search.
+            distances (list or None): the vector distances of the candidates, None if the search did not return them.
+                A candidate only found by the lexical index of a hybrid search has a None distance.
+            llm (Callable): asks the llm to select the node and returns its answer.
+        """
+        raise NotImplementedError
+
+    def _count(self, kind: str):
+        with self._lock:
+            self._counts[kind] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+class LLMReranker(Reranker):
+    """Always ask the llm, the behaviour of the agent before rerankers were pluggable."""
+
+    def rerank(self, query: str, nodes: List[Dict], distances: Optional[List[float]], llm: Callable[[], str]) -> str:
+        self._count("llm")
+        return llm()
+
+
+class LocalReranker(Reranker):
+    """Select the node on the CPU, escalating to the llm only when the choice is not clear.
+
+    Each candidate is scored with a weighted sum of its BM25 score over #intent# and #action# and its vector distance,
+    both scaled to [0, 1] among the candidates. The best candidate is selected locally if it leads the runner-up by at
+    least `margin`. Otherwise, or if no candidate shares a term with the query, the llm decides, since it can also
+    rephrase the query or answer that no node applies.
+    """
+
+    def __init__(self, margin: float = 0.15, lexical_weight: float = 0.5, escalate: bool = True):
+        """
+        Args:
+            margin (float): the minimum lead of the best candidate's score over the runner-up to skip the llm.
+            lexical_weight (float): the weight of the BM25 score, the vector score gets `1 - lexical_weight`.
+            escalate (bool): if False, never ask the llm and always select the best candidate.
+        """
+        super().__init__()
+        self.margin = margin
+        self.lexical_weight = lexical_weight
+        self.escalate = escalate
+
+    def scores(self, query: str, nodes: List[Dict], distances: Optional[List[float]] = None):
+        """Return the combined scores and the raw BM25 scores of the nodes."""
+        lexical = BM25([tokenize(node_text(node)) for node in nodes]).scores(tokenize(query))
+        top = max(lexical, default=0.0)
+        lexical_scaled = [score / top if top > 0 else 0.0 for score in lexical]
+        if distances is None or len(distances) != len(nodes):
+            return lexical_scaled, lexical
+        known = [d for d in distances if d is not None]
+        if not known:
+            return lexical_scaled, lexical
+        low, high = min(known), max(known)
+        if high > low:
+            # a candidate the vector search did not return counts as the farthest one
+            vector_scaled = [(high - (high if d is None else d)) / (high - low) for d in distances]
+        else:
+            vector_scaled = [0.0 if d is None else 1.0 for d in distances]
+        weight = self.lexical_weight
+        return [weight * lex + (1 - weight) * vec for lex, vec in zip(lexical_scaled, vector_scaled)], lexical
+
+    def rerank(self, query: str, nodes: List[Dict], distances: Optional[List[float]], llm: Callable[[], str]) -> str:
+        combined, lexical = self.scores(query, nodes, distances)
+        ranked = sorted(range(len(nodes)), key=lambda i: combined[i], reverse=True)
+        best = ranked[0]
+        lead = combined[best] - combined[ranked[1]] if len(ranked) > 1 else combined[best]
+        if self.escalate and (lead < self.margin or lexical[best] <= 0):
+            self._count("llm")
+            return llm()
+        self._count("local")
+        return json.dumps(
+            {
+                "INDEX": best,
+                "INTENT": nodes[best].get("#intent#", ""),
+                "EXPLANATION": f"The #intent# and #action# of this node match the query best among the retrieved "
+                f"nodes (score {combined[best]:.2f}, {lead:.2f} ahead of the next one).",
+            }
+        )
+
+
+def create_reranker(kind: str = "llm", **kwargs) -> Reranker:
+    """Create the reranker named by `kind`.
+
+    Args:
+        kind (str): "llm" for `LLMReranker`, which asks the llm on every retrieval, or "local" for `LocalReranker`,
+            which only asks it when the local scores are too close.
+        **kwargs: passed to the reranker constructor.
+    """
+    if kind == "llm":
+        return LLMReranker(**kwargs)
+    if kind == "local":
+        return LocalReranker(**kwargs)
+    raise ValueError(f"Unknown reranker: {kind}. Possible values are 'llm' and 'local'.")
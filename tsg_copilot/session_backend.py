@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Optional
+
+from tsg_copilot.conversation_state import ConversationState
+from tsg_copilot.conversation_store import ConversationStore, SessionBackend
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """A session backend persisted in a SQLite file, shared by every worker process on the host.
+
+    Only the minimal `ConversationState` is stored, as zlib-compressed json, so any worker can pick up a conversation
+    by restoring it into one of its own pooled agent sets. Writes are last-writer-wins.
+    """
+
+    def __init__(self, db_path: str = "sessions.sqlite3", ttl: Optional[float] = 24 * 3600, purge_every: int = 100):
+        """
+        Args:
+            db_path (str): the path to the SQLite file. It is created if it does not exist.
+            ttl (float or None): seconds a conversation may stay idle before it is purged. None keeps them forever.
+            purge_every (int): purge idle conversations once every `purge_every` writes.
+        """
+        self._db_path = db_path
+        self._ttl = ttl
+        self._purge_every = purge_every
+        self._local = threading.local()
+        self._metrics_lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "writes": 0, "deletes": 0, "purged": 0}
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "conversation_id TEXT PRIMARY KEY, state BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self._db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, key: str, value: int = 1):
+        with self._metrics_lock:
+            self._metrics[key] += value
+
+    @staticmethod
+    def _dumps(state: ConversationState) -> bytes:
+        return zlib.compress(json.dumps(state.to_dict(), default=str).encode("utf-8"))
+
+    @staticmethod
+    def _loads(data: bytes) -> ConversationState:
+        return ConversationState.from_dict(json.loads(zlib.decompress(data).decode("utf-8")))
+
+    def get(self, conversation_id: str, default=None) -> Optional[ConversationState]:
+        conn = self._connection()
+        query = "SELECT state FROM sessions WHERE conversation_id = ?"
+        params = [str(conversation_id)]
+        if self._ttl is not None:
+            query += " AND updated_at >= ?"
+            params.append(time.time() - self._ttl)
+        row = conn.execute(query, params).fetchone()
+        if row is None:
+            self._count("misses")
+            return default
+        self._count("hits")
+        return self._loads(row[0])
+
+    def __setitem__(self, conversation_id: str, state: ConversationState):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO sessions (conversation_id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(conversation_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (str(conversation_id), self._dumps(state), time.time()),
+            )
+        self._count("writes")
+        if self._purge_every and self._metrics["writes"] % self._purge_every == 0:
+            self.purge_expired()
+
+    def __contains__(self, conversation_id: str) -> bool:
+        row = self._connection().execute(
+            "SELECT 1 FROM sessions WHERE conversation_id = ?", (str(conversation_id),)
+        ).fetchone()
+        return row is not None
+
+    def pop(self, conversation_id: str, default=None) -> Optional[ConversationState]:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT state FROM sessions WHERE conversation_id = ?", (str(conversation_id),)
+            ).fetchone()
+            if row is None:
+                return default
+            conn.execute("DELETE FROM sessions WHERE conversation_id = ?", (str(conversation_id),))
+        self._count("deletes")
+        return self._loads(row[0])
+
+    def purge_expired(self) -> int:
+        """Delete conversations that have been idle for longer than the ttl."""
+        if self._ttl is None:
+            return 0
+        with self._connection() as conn:
+            cursor = conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self._ttl,))
+        self._count("purged", cursor.rowcount)
+        return cursor.rowcount
+
+    def metrics(self) -> Dict[str, int]:
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics["entries"] = self._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        return metrics
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def create_session_backend(kind: str = "memory", **kwargs) -> SessionBackend:
+    """Create the session backend named by `kind`.
+
+    Args:
+        kind (str): "memory" for the in-process `ConversationStore`, which only works with a single worker process,
+            or "sqlite" for `SQLiteSessionBackend`, which lets several worker processes serve the same conversation.
+        **kwargs: passed to the backend constructor.
+    """
+    if kind == "memory":
+        return ConversationStore(**kwargs)
+    if kind == "sqlite":
+        return SQLiteSessionBackend(**kwargs)
+    raise ValueError(f"Unknown session backend: {kind}. Possible values are 'memory' and 'sqlite'.")
@@ -0,0 +1,100 @@
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import networkx as nx
+
+from tsg_copilot.message_json import parse_message
+
+
+def next_field_rule(speaker: str, content: Optional[dict], candidates: Sequence[str]) -> Optional[str]:
+    """Follow the NEXT field of a json message, e.g. the decision of the intent understanding agent."""
+    if content is not None and content.get("NEXT") in candidates:
+        return content["NEXT"]
+    return None
+
+
+def retrieval_payload_rule(speaker: str, content: Optional[dict], candidates: Sequence[str]) -> Optional[str]:
+    """Hand the info/no_info payload of the node retrieve agent to the intent understanding agent."""
+    if (
+        content is not None
+        and ("info" in content or "no_info" in content)
+        and "intent_understanding_agent" in candidates
+    ):
+        return "intent_understanding_agent"
+    return None
+
+
+def single_candidate_rule(speaker: str, content: Optional[dict], candidates: Sequence[str]) -> Optional[str]:
+    """The graph leaves only one successor."""
+    if len(candidates) == 1:
+        return candidates[0]
+    return None
+
+
+DEFAULT_RULES = [next_field_rule, retrieval_payload_rule, single_candidate_rule]
+
+
+class SpeakerRouter:
+    """A routing table compiled from the speaker graph, resolving the next speaker of the group chat locally.
+
+    Rules are checked in order with the name of the last speaker, the last message parsed as json (None if it is not
+    json) and the eligible successors in the graph. The first rule returning a name decides. The group chat only asks
+    the llm when no rule applies, i.e. several successors remain and the message does not say which one.
+    Decisions are counted by how they were made: "rule", "llm" (the llm was asked) or "random" (neither applied).
+    The router is read-only apart from its counters, so one router can be shared by all agent sets.
+    """
+
+    def __init__(
+        self,
+        graph: Optional[nx.DiGraph] = None,
+        agent_names: Optional[List[str]] = None,
+        rules: Optional[List[Callable]] = None,
+    ):
+        """
+        Args:
+            graph (nx.DiGraph or None): the speaker graph. Nodes marked `first_round_speaker` are the candidates when
+                there is no previous speaker. If None, every agent in `agent_names` may follow every other one.
+            agent_names (list or None): the names of all agents, only used when `graph` is None.
+            rules (list or None): the routing rules, `DEFAULT_RULES` if None. A rule takes the last speaker's name, the
+                parsed message and the candidates, and returns the next speaker's name or None.
+        """
+        if graph is not None:
+            self._successors: Dict[str, Tuple[str, ...]] = {node: tuple(graph.successors(node)) for node in graph.nodes}
+            self._first_round = tuple(
+                node for node, data in graph.nodes(data=True) if data.get("first_round_speaker", False)
+            )
+            self._everyone = None
+        else:
+            self._successors = {}
+            self._first_round = tuple(agent_names or [])
+            self._everyone = tuple(agent_names or [])
+        self._rules = DEFAULT_RULES if rules is None else rules
+        self._lock = threading.Lock()
+        self._counts = {"rule": 0, "llm": 0, "random": 0}
+
+    def candidates(self, last_speaker: Optional[str]) -> Tuple[str, ...]:
+        if last_speaker is None:
+            return self._first_round
+        if self._everyone is not None:
+            return self._everyone
+        return self._successors.get(last_speaker, ())
+
+    def route(self, last_speaker: Optional[str], message: Optional[dict]) -> Optional[str]:
+        """Return the next speaker's name if a rule decides it, else None."""
+        candidates = self.candidates(last_speaker)
+        # parsed once per message, the group chat memory and the receiving agent read it too
+        content = parse_message(message) if message is not None else None
+        for rule in self._rules:
+            name = rule(last_speaker, content, candidates)
+            if name is not None:
+                self.count("rule")
+                return name
+        return None
+
+    def count(self, kind: str):
+        with self._lock:
+            self._counts[kind] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
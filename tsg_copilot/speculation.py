@@ -0,0 +1,96 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+
+class Speculation:
+    """A vector search started before it is known to be needed."""
+
+    def __init__(self, problem: str, n_results: int, future: Future, started: float):
+        self.problem = problem
+        self.n_results = n_results
+        self.future = future
+        self.started = started
+        self.finished: Optional[float] = None
+
+    def matches(self, problem: str, n_results: int) -> bool:
+        return self.problem.strip() == problem.strip() and self.n_results == n_results
+
+
+class SpeculativeRetrieval:
+    """Run the vector search of the user's message while the intent agent decides what to retrieve.
+
+    The intent agent echoes the user's message as the QUERY of a NEW_QUERY decision, so the node retrieve agent can
+    embed and search it concurrently with the intent llm call, and use the candidates if the QUERY is the same text.
+    Otherwise they are discarded. The rerank is not speculated, it needs the decision.
+
+    Speculations are counted as "hits" (used), "misses" (discarded) and "errors" (the search failed, it is redone).
+    The latency saved by a hit is the duration of the search minus the time the retrieval still waited for it.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        """
+        Args:
+            max_workers (int): the number of searches run concurrently, shared by all agent sets of the process.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative_retrieval")
+        self._lock = threading.Lock()
+        self._counts = {"started": 0, "hits": 0, "misses": 0, "errors": 0}
+        self._seconds = {"saved": 0.0, "wasted": 0.0}
+
+    def start(self, problem: str, n_results: int, search: Callable[[], Any]) -> Speculation:
+        """Run `search` in the background. It runs in the context of the caller, e.g. its conversation and span."""
+        context = contextvars.copy_context()
+
+        def run():
+            try:
+                return context.run(search)
+            finally:
+                speculation.finished = time.perf_counter()
+
+        speculation = Speculation(problem, n_results, None, time.perf_counter())
+        speculation.future = self._executor.submit(run)
+        with self._lock:
+            self._counts["started"] += 1
+        return speculation
+
+    def resolve(self, speculation: Speculation, problem: str, n_results: int) -> Optional[Any]:
+        """Return the results of the speculation if it searched `problem`, else discard it and return None."""
+        if not speculation.matches(problem, n_results):
+            self.discard(speculation)
+            return None
+        waited = time.perf_counter()
+        try:
+            results = speculation.future.result()
+        except Exception:
+            with self._lock:
+                self._counts["errors"] += 1
+            return None
+        waited = time.perf_counter() - waited
+        with self._lock:
+            self._counts["hits"] += 1
+            self._seconds["saved"] += max(speculation.finished - speculation.started - waited, 0.0)
+        return results
+
+    def discard(self, speculation: Speculation):
+        """Drop a speculation whose search is not needed. The time it ran, if it did, is counted as wasted."""
+        if not speculation.future.cancel():
+            speculation.future.add_done_callback(lambda _: self._add_wasted(speculation))
+        with self._lock:
+            self._counts["misses"] += 1
+
+    def _add_wasted(self, speculation: Speculation):
+        with self._lock:
+            self._seconds["wasted"] += (speculation.finished or time.perf_counter()) - speculation.started
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            resolved = self._counts["hits"] + self._counts["misses"]
+            return {
+                **self._counts,
+                "hit_rate": self._counts["hits"] / resolved if resolved else 0.0,
+                "seconds_saved": self._seconds["saved"],
+                "seconds_wasted": self._seconds["wasted"],
+            }
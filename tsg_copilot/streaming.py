@@ -0,0 +1,172 @@
+import asyncio
+import contextvars
+import json
+import queue
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Tuple
+
+from autogen.token_count_utils import count_token
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.completion_usage import CompletionUsage
+
+from tsg_copilot.llm_client import openai_client
+
+# the sink of the events of the turn the current thread or task is serving, None if the turn is not streamed
+_event_sink: contextvars.ContextVar = contextvars.ContextVar("event_sink", default=None)
+
+# async turns being streamed, referenced until they finish even if their client went away
+_stream_tasks = set()
+
+
+def streaming() -> bool:
+    """Whether the current turn is streamed to its client."""
+    return _event_sink.get() is not None
+
+
+@contextmanager
+def event_scope(sink: Callable[[str, Dict], None]):
+    """Send the events emitted within the block, e.g. the stages of a turn and the tokens of the planner, to `sink`."""
+    token = _event_sink.set(sink)
+    try:
+        yield
+    finally:
+        _event_sink.reset(token)
+
+
+def emit_event(event: str, **data):
+    """Send an event to the client of the current turn, if it is streamed."""
+    sink = _event_sink.get()
+    if sink is not None:
+        sink(event, data)
+
+
+def sse_event(event: str, data: Dict) -> str:
+    """Format an event as a Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_events(turn: Callable[[], Dict]) -> Iterator[Tuple[str, Dict]]:
+    """Run `turn` in a thread and yield its events as they are emitted. The last event is "result", with the results
+    of the turn, or "error"."""
+    events = queue.Queue()
+
+    def sink(event, data):
+        events.put((event, data))
+
+    def run():
+        with event_scope(sink):
+            try:
+                sink("result", turn())
+            except Exception as e:
+                sink("error", {"error": f"{type(e).__name__}: {e}"})
+            finally:
+                events.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        item = events.get()
+        if item is None:
+            return
+        yield item
+
+
+async def a_stream_events(turn: Callable[[], Awaitable[Dict]]) -> AsyncIterator[Tuple[str, Dict]]:
+    """Run `turn` as a task of the running loop and yield its events as they are emitted, see `stream_events`. Events
+    emitted by the executor threads of the turn are handed over to the loop."""
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def sink(event, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    async def run():
+        with event_scope(sink):
+            try:
+                sink("result", await turn())
+            except Exception as e:
+                sink("error", {"error": f"{type(e).__name__}: {e}"})
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, None)
+
+    # the turn goes on if the client disconnects, so that its state is saved
+    task = asyncio.create_task(run())
+    _stream_tasks.add(task)
+    task.add_done_callback(_stream_tasks.discard)
+    while True:
+        item = await events.get()
+        if item is None:
+            return
+        yield item
+
+
+def _count_tokens(value, model: str) -> int:
+    try:
+        return count_token(value, model)
+    except (KeyError, NotImplementedError):
+        # a deployment name unknown to tiktoken, count as gpt-4
+        return count_token(value, "gpt-4-0613")
+
+
+class TokenStreamer:
+    """Stream a chat completion token by token.
+
+    `OpenAIWrapper` only prints the tokens of a streamed completion, so an agent given a streamer asks it instead when
+    its turn is streamed, and forwards the tokens as they arrive. The tokens are assembled into a `ChatCompletion`, so
+    the reply is handled as if it came from `OpenAIWrapper.create`.
+    """
+
+    def __init__(self, config: Dict[str, Any], **params):
+        """
+        Args:
+            config (dict): an entry of the autogen config list: model, api_key, base_url, api_type, api_version and
+                optionally response_format.
+            **params: other parameters of the completion, e.g. temperature, top_p or timeout.
+        """
+        self._client = openai_client(config)
+        self.model = config["model"]
+        self.params = dict(params)
+        if config.get("response_format"):
+            self.params["response_format"] = config["response_format"]
+
+    def create(self, messages: List[Dict], on_token: Callable[[str], None]) -> ChatCompletion:
+        """Ask for the completion of `messages`, calling `on_token` with every piece of text as it arrives."""
+        pieces = []
+        finish_reason = "stop"
+        model = self.model
+        chunks = self._client.chat.completions.create(model=self.model, messages=messages, stream=True, **self.params)
+        for chunk in chunks:
+            model = chunk.model or model
+            for choice in chunk.choices:
+                if choice.index != 0:
+                    continue
+                if choice.finish_reason is not None:
+                    finish_reason = choice.finish_reason
+                if choice.delta.content:
+                    pieces.append(choice.delta.content)
+                    on_token(choice.delta.content)
+        content = "".join(pieces)
+        # streamed completions carry no usage, count the tokens the way autogen does for them
+        prompt_tokens = _count_tokens(messages, model)
+        completion_tokens = _count_tokens(content, model)
+        return ChatCompletion(
+            id=f"stream-{uuid.uuid4().hex}",
+            model=model,
+            created=int(time.time()),
+            object="chat.completion",
+            choices=[
+                Choice(
+                    index=0,
+                    finish_reason=finish_reason,
+                    message=ChatCompletionMessage(role="assistant", content=content),
+                )
+            ],
+            usage=CompletionUsage(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
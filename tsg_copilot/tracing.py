@@ -0,0 +1,200 @@
+import argparse
+import contextvars
+import json
+import os
+import statistics
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+from tsg_copilot.request_context import current_conversation_id, current_round
+
+# the span the current thread or task is in, as (trace id, span id)
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """Mean, p50 and p95 of latencies in seconds, reported in milliseconds."""
+    ordered = sorted(latencies)
+    return {
+        "n": len(ordered),
+        "mean_ms": 1000 * statistics.fmean(ordered),
+        "p50_ms": 1000 * ordered[len(ordered) // 2],
+        "p95_ms": 1000 * ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+    }
+
+
+def _attribute(key: str, value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        # OTLP/JSON encodes 64 bit integers as strings
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _attribute_value(attribute: Dict) -> Any:
+    (kind, value), = attribute["value"].items()
+    return int(value) if kind == "intValue" else value
+
+
+def stage_name(name: str, attributes: Dict[str, Any]) -> str:
+    """The stage a span is summarized under, e.g. "generate_reply[planner_agent]"."""
+    agent = attributes.get("agent")
+    return f"{name}[{agent}]" if agent else name
+
+
+class Tracer:
+    """Spans timing the stages of a turn: speaker selection, replies, retrieval, embedding, vector queries, llm calls
+    and kusto queries.
+
+    A span is attributed to the conversation of the current `conversation_scope` and the group chat round of the
+    current `round_scope`, and nested spans share the trace of the outermost one. The durations of the last `window`
+    spans of each stage are kept in memory for `stats`. If `export_path` is set, every span is appended to it as a line
+    of OTLP/JSON, an `ExportTraceServiceRequest`, which `summarize_spans` reads back and an OpenTelemetry collector can
+    ingest.
+    """
+
+    def __init__(self, export_path: Optional[str] = None, window: int = 1000, service_name: str = "tsg_copilot"):
+        """
+        Args:
+            export_path (str or None): a JSONL file every span is appended to. Default is None, no export.
+            window (int): the number of recent spans of each stage kept for `stats`.
+            service_name (str): the `service.name` of the exported spans.
+        """
+        self._export_path = export_path
+        self._window = window
+        self._service_name = service_name
+        self._lock = threading.Lock()
+        self._durations: Dict[str, deque] = {}
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the block as a span named `name`. The attributes are exported with it, an "agent" attribute also
+        splits the stage in `stats`."""
+        parent = _current_span.get()
+        trace_id = parent[0] if parent else os.urandom(16).hex()
+        span_id = os.urandom(8).hex()
+        token = _current_span.set((trace_id, span_id))
+        start_ns = time.time_ns()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            _current_span.reset(token)
+            self._finish(name, attributes, trace_id, span_id, parent, start_ns, duration, error)
+
+    def _finish(self, name, attributes, trace_id, span_id, parent, start_ns, duration, error):
+        stage = stage_name(name, attributes)
+        with self._lock:
+            durations = self._durations.get(stage)
+            if durations is None:
+                durations = self._durations[stage] = deque(maxlen=self._window)
+            durations.append(duration)
+        if not self._export_path:
+            return
+        attributes = dict(attributes)
+        attributes["conversation.id"] = current_conversation_id()
+        attributes["chat.round"] = current_round()
+        span = {
+            "traceId": trace_id,
+            "spanId": span_id,
+            "parentSpanId": parent[1] if parent else "",
+            "name": name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(start_ns),
+            "endTimeUnixNano": str(start_ns + int(duration * 1e9)),
+            "attributes": [_attribute(k, v) for k, v in attributes.items() if v is not None],
+            # STATUS_CODE_OK or STATUS_CODE_ERROR
+            "status": {"code": 1} if error is None else {"code": 2, "message": f"{type(error).__name__}: {error}"},
+        }
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [_attribute("service.name", self._service_name)]},
+                    "scopeSpans": [{"scope": {"name": __name__}, "spans": [span]}],
+                }
+            ]
+        }
+        line = json.dumps(request, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self._export_path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """The latency summary of the recent spans of each stage."""
+        with self._lock:
+            durations = {stage: list(values) for stage, values in self._durations.items()}
+        return {stage: latency_summary(values) for stage, values in sorted(durations.items())}
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+
+
+# used by the agents and the retrieval, replaced by `set_tracer`
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def set_tracer(tracer: Tracer):
+    """Make `tracer` the tracer of the process, e.g. one exporting the spans."""
+    global _tracer
+    _tracer = tracer
+
+
+def span(name: str, **attributes):
+    """A span of the tracer of the process, see `Tracer.span`."""
+    return _tracer.span(name, **attributes)
+
+
+def read_spans(path: str) -> Iterable[Dict[str, Any]]:
+    """Yield the spans exported to `path`, with their attributes as a dict and their duration in seconds."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line)["resourceSpans"]:
+                for scope_spans in resource_spans["scopeSpans"]:
+                    for s in scope_spans["spans"]:
+                        yield {
+                            "name": s["name"],
+                            "attributes": {a["key"]: _attribute_value(a) for a in s.get("attributes", [])},
+                            "duration": (int(s["endTimeUnixNano"]) - int(s["startTimeUnixNano"])) / 1e9,
+                            "error": s.get("status", {}).get("code") == 2,
+                        }
+
+
+def summarize_spans(path: str, conversation_id: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+    """The latency summary of each stage of the spans exported to `path`, optionally of one conversation."""
+    durations = defaultdict(list)
+    for s in read_spans(path):
+        if conversation_id is not None and s["attributes"].get("conversation.id") != conversation_id:
+            continue
+        durations[stage_name(s["name"], s["attributes"])].append(s["duration"])
+    return {stage: latency_summary(values) for stage, values in sorted(durations.items())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the p50 and p95 latency of each stage of exported spans.")
+    parser.add_argument("path", help="the TRACE_EXPORT_PATH file")
+    parser.add_argument("--conversation-id", default=None, help="only summarize the spans of this conversation")
+    args = parser.parse_args()
+    for stage, row in summarize_spans(args.path, args.conversation_id).items():
+        print(f"{stage:<48}n={row['n']:<6} mean={row['mean_ms']:9.1f}ms  p50={row['p50_ms']:9.1f}ms  p95={row['p95_ms']:9.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
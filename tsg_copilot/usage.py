@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from tsg_copilot.request_context import current_conversation_id
+
+_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "total_tokens", "cost", "latency")
+
+
+def _empty() -> Dict[str, float]:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cost": 0.0, "latency": 0.0}
+
+
+def response_usage(response) -> Dict[str, Any]:
+    """The usage of one `OpenAIWrapper.create` response. `client.total_usage_summary` is cumulative over all calls of
+    the client, so the usage is read from the response itself."""
+    usage = getattr(response, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    return {
+        "model": getattr(response, "model", None),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": getattr(usage, "total_tokens", None) or prompt_tokens + completion_tokens,
+        "cost": getattr(response, "cost", 0.0) or 0.0,
+    }
+
+
+class UsageTracker:
+    """Token usage, cost and latency of llm calls, aggregated in total, per agent, per model and per conversation.
+
+    Calls are attributed to the conversation of the current `conversation_scope`. The aggregates are updated under a
+    lock, so one tracker can be shared by all agent sets and threads. Only the `max_conversations` most recently active
+    conversations are kept. Each call can also be appended to a JSONL file for offline analysis.
+    """
+
+    def __init__(self, max_conversations: int = 10000, export_path: Optional[str] = None):
+        """
+        Args:
+            max_conversations (int): the number of conversations whose usage is kept.
+            export_path (str or None): a JSONL file every call is appended to. Default is None, no export.
+        """
+        self._max_conversations = max_conversations
+        self._export_path = export_path
+        self._lock = threading.Lock()
+        self._total = _empty()
+        self._agents: Dict[str, Dict] = {}
+        self._models: Dict[str, Dict] = {}
+        self._conversations: "OrderedDict[str, Dict]" = OrderedDict()
+
+    @staticmethod
+    def _add(aggregate: Dict, record: Dict):
+        aggregate["calls"] += 1
+        for field in _FIELDS[1:]:
+            aggregate[field] += record[field]
+
+    def record(self, agent: str, response, latency: float, conversation_id: Optional[str] = None) -> Dict[str, Any]:
+        """Account one llm call.
+
+        Args:
+            agent (str): the name of the agent, or component, making the call.
+            response: the response of `OpenAIWrapper.create`.
+            latency (float): the duration of the call in seconds.
+            conversation_id (str or None): default is None, the conversation of the current `conversation_scope`.
+        """
+        record = response_usage(response)
+        record.update(
+            time=time.time(),
+            agent=agent,
+            conversation_id=current_conversation_id() if conversation_id is None else conversation_id,
+            latency=latency,
+        )
+        with self._lock:
+            self._add(self._total, record)
+            self._add(self._agents.setdefault(agent, _empty()), record)
+            self._add(self._models.setdefault(str(record["model"]), _empty()), record)
+            if record["conversation_id"] is not None:
+                conversation = self._conversations.pop(record["conversation_id"], None)
+                if conversation is None:
+                    conversation = {"total": _empty(), "agents": {}}
+                self._add(conversation["total"], record)
+                self._add(conversation["agents"].setdefault(agent, _empty()), record)
+                self._conversations[record["conversation_id"]] = conversation
+                while len(self._conversations) > self._max_conversations:
+                    self._conversations.popitem(last=False)
+            if self._export_path:
+                with open(self._export_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+        return record
+
+    def conversation(self, conversation_id: str) -> Optional[Dict]:
+        """The usage of a conversation, in total and per agent, or None if it made no call or was evicted."""
+        with self._lock:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None:
+                return None
+            return {
+                "total": dict(conversation["total"]),
+                "agents": {k: dict(v) for k, v in conversation["agents"].items()},
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "total": dict(self._total),
+                "agents": {k: dict(v) for k, v in self._agents.items()},
+                "models": {k: dict(v) for k, v in self._models.items()},
+                "conversations": len(self._conversations),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._total = _empty()
+            self._agents.clear()
+            self._models.clear()
+            self._conversations.clear()
+
+
+# used by the agents unless they are given a tracker
+default_usage_tracker = UsageTracker()
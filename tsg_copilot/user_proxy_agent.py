@@ -49,3 +49,6 @@ class UserProxyAgent(ConversableAgent):
     def get_human_input(self, prompt: str) -> str:
         raise OutputResultsError(prompt)
 
+    async def a_get_human_input(self, prompt: str) -> str:
+        raise OutputResultsError(prompt)
+
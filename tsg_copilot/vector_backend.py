@@ -0,0 +1,288 @@
+import json
+import os
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+# header: magic, number of rows, embedding dimension, offset of the json records
+_HEADER = struct.Struct("<8sqqq")
+_MAGIC = b"TSGVEC01"
+# the matrix starts at a fixed offset, aligned for the float32 view
+_MATRIX_OFFSET = 64
+NUMPY_SUFFIX = ".vectors"
+_MAX_CACHED_MASKS = 1024
+
+# numpy backends opened by this process, by path, with the stat of the file they were opened from
+_numpy_backends: Dict[str, tuple] = {}
+_numpy_lock = threading.Lock()
+
+
+class VectorBackend:
+    """The vector store of the tsg nodes, queried by `query_vector_db` and filled by `upsert_nodes`.
+
+    The methods follow the subset of `chromadb.Collection` used by the node db, so a chroma collection or any backend
+    with the same methods can be used in its place. `query` returns a `QueryResult`: lists of ids, distances, documents
+    and metadatas, one list per query embedding, best first.
+    """
+
+    def upsert(self, ids: List[str], embeddings: Sequence, documents: List[str], metadatas: List[Dict]):
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]):
+        raise NotImplementedError
+
+    def query(
+        self,
+        query_embeddings: Sequence,
+        n_results: int = 10,
+        where: Optional[Dict] = None,
+        where_document: Optional[Dict] = None,
+    ) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def persist(self):
+        """Make the writes durable and visible to other processes. Chroma persists every write itself."""
+
+
+class ChromaBackend(VectorBackend):
+    """A chromadb collection, queried through its sqlite and hnsw index."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def query(self, query_embeddings, n_results=10, where=None, where_document=None):
+        return self.collection.query(
+            query_embeddings=query_embeddings, n_results=n_results, where=where, where_document=where_document
+        )
+
+    def count(self) -> int:
+        return self.collection.count()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class NumpyBackend(VectorBackend):
+    """An exact, in-process vector store for corpora of up to about a hundred thousand nodes.
+
+    The L2-normalized float32 embeddings are one contiguous matrix in a memory-mapped file, followed by the ids,
+    documents and metadatas as json, so every process serving the same node db shares one copy in the page cache. A
+    query is a single matmul over the matrix and an `argpartition` for the top k, and needs no lock. Metadata filters
+    are answered with boolean masks, built from a per-field index of the rows and cached per filter.
+
+    Distances are squared L2 distances between the normalized vectors, `2 - 2 * cosine`, which is what chroma returns
+    for the default "l2" space with normalized embeddings such as ada-002.
+
+    Writes are kept in memory until `persist`, which replaces the file atomically.
+    """
+
+    def __init__(self, path: str, empty: bool = False):
+        """
+        Args:
+            path (str): the path to the vectors file. It is created by `persist` if it does not exist.
+            empty (bool): whether to start empty instead of opening an existing file, e.g. for a full build. The file
+                is only replaced by `persist`. Default is False.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.exists(path) and not empty:
+            self._open()
+        else:
+            self._set(np.zeros((0, 0), dtype=np.float32), [], [], [])
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            magic, rows, dim, records_offset = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError(f"{self.path} is not a vectors file.")
+            f.seek(records_offset)
+            records = json.loads(f.read().decode("utf-8"))
+        matrix = (
+            np.memmap(self.path, dtype=np.float32, mode="r", offset=_MATRIX_OFFSET, shape=(rows, dim))
+            if rows
+            else np.zeros((0, dim), dtype=np.float32)
+        )
+        self._set(matrix, records["ids"], records["documents"], records["metadatas"])
+
+    def _set(self, matrix: np.ndarray, ids: List[str], documents: List[str], metadatas: List[Dict]):
+        # readers take a reference to the tuple, so a write never shows them half-updated state
+        field_rows = {}
+        for row, metadata in enumerate(metadatas):
+            for key, value in (metadata or {}).items():
+                field_rows.setdefault(key, {}).setdefault(value, []).append(row)
+        self._state = (
+            matrix,
+            ids,
+            documents,
+            metadatas,
+            {id: row for row, id in enumerate(ids)},
+            {key: {value: np.asarray(rows) for value, rows in values.items()} for key, values in field_rows.items()},
+            {},  # masks of the filters seen so far
+        )
+
+    def count(self) -> int:
+        return len(self._state[1])
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        embeddings = _normalize(np.asarray(embeddings, dtype=np.float32))
+        with self._lock:
+            matrix, old_ids, old_documents, old_metadatas, row_of, _, _ = self._state
+            matrix = np.array(matrix) if len(old_ids) else np.zeros((0, embeddings.shape[1]), dtype=np.float32)
+            old_ids, old_documents, old_metadatas = list(old_ids), list(old_documents), list(old_metadatas)
+            new_rows = []
+            for i, id in enumerate(ids):
+                row = row_of.get(id)
+                if row is None:
+                    new_rows.append(i)
+                    old_ids.append(id)
+                    old_documents.append(documents[i])
+                    old_metadatas.append(metadatas[i])
+                else:
+                    matrix[row] = embeddings[i]
+                    old_documents[row] = documents[i]
+                    old_metadatas[row] = metadatas[i]
+            matrix = np.vstack([matrix, embeddings[new_rows]]) if new_rows else matrix
+            self._set(matrix, old_ids, old_documents, old_metadatas)
+
+    def delete(self, ids):
+        with self._lock:
+            matrix, old_ids, documents, metadatas, row_of, _, _ = self._state
+            drop = {row_of[id] for id in ids if id in row_of}
+            if not drop:
+                return
+            keep = [row for row in range(len(old_ids)) if row not in drop]
+            self._set(
+                np.array(matrix[keep]),
+                [old_ids[row] for row in keep],
+                [documents[row] for row in keep],
+                [metadatas[row] for row in keep],
+            )
+
+    def persist(self):
+        with self._lock:
+            matrix, ids, documents, metadatas, _, _, _ = self._state
+            records = json.dumps({"ids": ids, "documents": documents, "metadatas": metadatas}, ensure_ascii=False)
+            dim = matrix.shape[1] if matrix.ndim == 2 else 0
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, len(ids), dim, _MATRIX_OFFSET + matrix.nbytes))
+                f.write(b"\0" * (_MATRIX_OFFSET - _HEADER.size))
+                f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+                f.write(records.encode("utf-8"))
+            os.replace(tmp_path, self.path)
+            self._open()
+
+    def _field_mask(self, key: str, condition: Any, size: int, field_rows: Dict) -> np.ndarray:
+        values = field_rows.get(key, {})
+        if isinstance(condition, dict):
+            (operator, operand), = condition.items()
+        else:
+            operator, operand = "$eq", condition
+        mask = np.zeros(size, dtype=bool)
+        if operator == "$eq":
+            if operand in values:
+                mask[values[operand]] = True
+        elif operator == "$ne":
+            mask[:] = True
+            if operand in values:
+                mask[values[operand]] = False
+        elif operator == "$in":
+            for value in operand:
+                if value in values:
+                    mask[values[value]] = True
+        else:
+            raise ValueError(f"Unsupported operator {operator} in the where filter.")
+        return mask
+
+    def _where_mask(self, where: Dict, size: int, field_rows: Dict) -> np.ndarray:
+        masks = []
+        for key, condition in where.items():
+            if key == "$and":
+                masks.append(np.logical_and.reduce([self._where_mask(w, size, field_rows) for w in condition]))
+            elif key == "$or":
+                masks.append(np.logical_or.reduce([self._where_mask(w, size, field_rows) for w in condition]))
+            else:
+                masks.append(self._field_mask(key, condition, size, field_rows))
+        return np.logical_and.reduce(masks)
+
+    def _mask(self, where: Optional[Dict], where_document: Optional[Dict], state) -> Optional[np.ndarray]:
+        if not where and not where_document:
+            return None
+        _, ids, documents, _, _, field_rows, masks = state
+        key = json.dumps([where, where_document], sort_keys=True)
+        mask = masks.get(key)
+        if mask is None:
+            mask = np.ones(len(ids), dtype=bool)
+            if where:
+                mask &= self._where_mask(where, len(ids), field_rows)
+            if where_document:
+                text = where_document.get("$contains", "")
+                mask &= np.fromiter((text in document for document in documents), dtype=bool, count=len(ids))
+            if len(masks) >= _MAX_CACHED_MASKS:
+                masks.clear()
+            masks[key] = mask
+        return mask
+
+    def query(self, query_embeddings, n_results=10, where=None, where_document=None):
+        state = self._state
+        matrix, ids, documents, metadatas, _, _, _ = state
+        queries = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+        mask = self._mask(where, where_document, state)
+        rows = np.arange(len(ids)) if mask is None else np.flatnonzero(mask)
+        k = min(n_results, len(rows))
+        result = {"ids": [], "distances": [], "documents": [], "metadatas": [], "embeddings": None}
+        if k == 0:
+            for key in ("ids", "distances", "documents", "metadatas"):
+                result[key] = [[] for _ in range(len(queries))]
+            return result
+        candidates = matrix if mask is None else matrix[rows]
+        similarities = queries @ candidates.T
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        for q in range(len(queries)):
+            order = top[q][np.argsort(-similarities[q, top[q]])]
+            selected = rows[order]
+            result["ids"].append([ids[row] for row in selected])
+            result["distances"].append(np.maximum(2 - 2 * similarities[q, order], 0).tolist())
+            result["documents"].append([documents[row] for row in selected])
+            result["metadatas"].append([metadatas[row] for row in selected])
+        return result
+
+
+def numpy_backend_path(db_path: str, collection_name: str) -> str:
+    return os.path.join(db_path, f"{collection_name}{NUMPY_SUFFIX}")
+
+
+def open_numpy_backend(path: str) -> NumpyBackend:
+    """Return the process-wide numpy backend of the vectors file at `path`. It is reopened when the file was replaced,
+    e.g. by an update of the node db in another process."""
+    stat = os.stat(path)
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _numpy_backends.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _numpy_lock:
+        cached = _numpy_backends.get(path)
+        if cached is None or cached[0] != version:
+            cached = (version, NumpyBackend(path))
+            _numpy_backends[path] = cached
+        return cached[1]
+
+
+def invalidate_numpy_backends(db_path: str = None):
+    with _numpy_lock:
+        for path in list(_numpy_backends):
+            if db_path is None or os.path.dirname(path) == db_path:
+                del _numpy_backends[path]
@@ -1,33 +1,32 @@
+import functools
 import openai
 import os
-import requests
-from time import sleep
 from openai._types import NotGiven
 import yaml
 import json
+from tsg_copilot.llm_client import openai_client
 
-SLEEP_SEC = 3
-
-def get_oai_completion_gpt_unified(message_list, json_mode=False, temperature=0, max_tokens=4096, top_p=0, frequency_penalty=0, presence_penalty=0, timeout=60):
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """The openai client of the deployment in config.yaml, built once on the pooled http client of the process, which
+    retries rate limited and failed calls with capped exponential backoff."""
     script_dir = os.path.dirname(os.path.abspath(__file__))
     config_path = os.path.join(script_dir, 'config.yaml')
     with open(config_path, 'r') as config_file:
         config = yaml.safe_load(config_file)
-    openai.api_type = config['AOAI_TYPE']
-    openai.api_base = config['AOAI_BASE']
-    openai.api_version = config['AOAI_VERSION']
-    # if no AOAI_KEY is provided, use the Azure OpenAI API
-    if 'AOAI_KEY' in config:
-        openai.api_key=config['AOAI_KEY']
+    client = openai_client({
+        'model': config['AOAI_ENGINE'],
+        'api_key': config.get('AOAI_KEY'),
+        'base_url': config['AOAI_BASE'],
+        'api_type': config['AOAI_TYPE'],
+        'api_version': config['AOAI_VERSION'],
+    })
+    return client, config['AOAI_ENGINE']
 
-    engine = config['AOAI_ENGINE']
-    
+
+def get_oai_completion_gpt_unified(message_list, json_mode=False, temperature=0, max_tokens=4096, top_p=0, frequency_penalty=0, presence_penalty=0, timeout=60):
+    client, engine = get_client()
     try:
-        client=openai.AzureOpenAI(
-            azure_endpoint=openai.api_base,
-            api_key=openai.api_key,
-            api_version=openai.api_version
-        ) 
         response = client.chat.completions.create(
             model=engine,
             response_format={"type": "json_object"} if json_mode else NotGiven(),
@@ -48,28 +47,21 @@ def get_oai_completion_gpt_unified(message_list, json_mode=False, temperature=0,
             return None
         print(f"The OpenAI API request was invalid: {e}")
         return None
+    # the rate limits, timeouts and connection errors below remained after all the retries of the http client
     except openai.APIConnectionError as e:
         print(f"The OpenAI API connection failed: {e}")
-        sleep(SLEEP_SEC)
-        return get_oai_completion_gpt_unified(message_list, json_mode, temperature, max_tokens, top_p, frequency_penalty, presence_penalty, timeout)
+        return None
     except openai.RateLimitError as e:
-        print(f"Token rate limit exceeded. Retrying after {SLEEP_SEC} second...")
-        sleep(SLEEP_SEC)
-        return get_oai_completion_gpt_unified(message_list, json_mode, temperature, max_tokens, top_p, frequency_penalty, presence_penalty, timeout)
+        print(f"Token rate limit exceeded after all retries: {e}")
+        return None
     except openai.APIError as e:
-        if "The operation was timeout" in str(e):
-            # Handle the timeout error here
-            print("The OpenAI API request timed out. Please try again later.")
-            sleep(SLEEP_SEC)
-            return get_oai_completion_gpt_unified(message_list, json_mode, temperature, max_tokens, top_p, frequency_penalty, presence_penalty, timeout)
-        elif "DeploymentNotFound" in str(e):
+        if "DeploymentNotFound" in str(e):
             print("The API deployment for this resource does not exist")
             print(e)
             return None
         else:
             # Handle other API errors here
             print(f"The OpenAI API returned an error: {e}")
-            sleep(SLEEP_SEC)
-            return get_oai_completion_gpt_unified(message_list, json_mode, temperature, max_tokens, top_p, frequency_penalty, presence_penalty, timeout)
+            return None
     except Exception as e:
         print(f"An error occurred: {e}")
\ No newline at end of file